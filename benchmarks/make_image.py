@@ -0,0 +1,198 @@
+"""Generate synthetic docker-save images for benchmarking.
+
+    python -m benchmarks.make_image out.tar --layers 20 --files 5000 --compression layers
+"""
+import io
+import os
+import gzip
+import json
+import random
+import shutil
+import tarfile
+import hashlib
+import argparse
+import tempfile
+
+CORPUS_BYTES = 4 * 1024 * 1024
+WORDS = ('alpha', 'bravo', 'charlie', 'delta', 'echo', 'foxtrot', 'golf', 'hotel', 'india', 'juliett',
+         'kilo', 'lima', 'mike', 'november', 'oscar', 'papa', 'quebec', 'romeo', 'sierra', 'tango')
+NEEDLE = 'needle'  # Appears on roughly one line in a thousand, for content search benchmarks
+MTIME = 1700000000
+COMPRESSIONS = ('none', 'layers', 'image')
+
+
+def make_corpus(rnd, size=CORPUS_BYTES):
+    """Return text lines of random words, with NEEDLE sprinkled in."""
+    lines = []
+    total = 0
+    while total < size:
+        words = [rnd.choice(WORDS) for _ in range(rnd.randint(2, 14))]
+        if rnd.random() < 0.001:
+            words[rnd.randrange(len(words))] = NEEDLE
+        line = ' '.join(words) + '\n'
+        lines.append(line)
+        total += len(line)
+    return ''.join(lines).encode()[:size]
+
+
+class CorpusReader:
+    """File-like object returning size bytes of the corpus from an offset, wrapping around."""
+
+    def __init__(self, corpus, offset, size):
+        self.corpus = corpus
+        self.position = offset % len(corpus)
+        self.remaining = size
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        chunks = []
+        while size:
+            chunk = self.corpus[self.position:self.position + size]
+            chunks.append(chunk)
+            size -= len(chunk)
+            self.remaining -= len(chunk)
+            self.position = (self.position + len(chunk)) % len(self.corpus)
+        return b''.join(chunks)
+
+
+def _add_dir(tar, path):
+    member = tarfile.TarInfo(path)
+    member.type = tarfile.DIRTYPE
+    member.mode = 0o755
+    member.mtime = MTIME
+    tar.addfile(member)
+
+
+def _add_file(tar, path, size, corpus, offset):
+    member = tarfile.TarInfo(path)
+    member.size = size
+    member.mode = 0o644
+    member.mtime = MTIME
+    tar.addfile(member, CorpusReader(corpus, offset, size))
+
+
+def _write_layer(fileobj, layer_idx, rnd, corpus, live_files, files, file_size, depth, fanout, whiteouts,
+                 huge_file_size):
+    """Write one layer tar to fileobj and update live_files, the paths visible after it."""
+    with tarfile.open(fileobj=fileobj, mode='w|', format=tarfile.PAX_FORMAT) as tar:
+        deleted = []
+        if live_files:
+            deleted = rnd.sample(sorted(live_files), min(int(files * whiteouts), len(live_files)))
+        sizes = {}
+        for file_idx in range(files):
+            dirs = [f"dir{rnd.randrange(fanout)}" for _ in range(rnd.randint(0, depth))]
+            sizes['/'.join(dirs + [f"file_{layer_idx}_{file_idx}.txt"])] = rnd.randint(0, 2 * file_size)
+        if huge_file_size:
+            sizes['huge/huge.txt'] = huge_file_size
+
+        # Parent directories come first, as docker writes them.
+        dirs = set()
+        for path in list(sizes) + deleted:
+            parts = path.split('/')[:-1]
+            dirs.update('/'.join(parts[:i + 1]) for i in range(len(parts)))
+        for path in sorted(dirs):
+            _add_dir(tar, path)
+        for path in deleted:
+            dir_path, _, name = path.rpartition('/')
+            _add_file(tar, f"{dir_path}/.wh.{name}" if dir_path else f".wh.{name}", 0, corpus, 0)
+            live_files.discard(path)
+        for path, size in sizes.items():
+            _add_file(tar, path, size, corpus, rnd.randrange(len(corpus)))
+            live_files.add(path)
+
+
+def _sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def make_image(path, layers=10, files=1000, file_size=4096, depth=4, fanout=4, compression='none',
+               whiteouts=0.05, huge_file_size=0, seed=0):
+    """Write a docker-save image and return a description of it.
+
+    Each layer has files regular files of 0 to 2 * file_size bytes of text,
+    placed at random depths up to depth under directories with fanout
+    subdirectories each. From the second layer on, whiteouts is the share of
+    files deleting a path of an earlier layer. With huge_file_size, the last
+    layer also holds huge/huge.txt of that size. compression is 'none',
+    'layers' (gzip each layer blob) or 'image' (gzip the whole image, .tar.gz).
+    """
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"compression must be one of {', '.join(COMPRESSIONS)}")
+    rnd = random.Random(seed)
+    corpus = make_corpus(rnd)
+    live_files = set()
+    layer_paths = []
+    diff_ids = []
+    mode = 'w:gz' if compression == 'image' else 'w'
+    options = {'compresslevel': 6} if compression == 'image' else {}
+    with tempfile.TemporaryDirectory() as work_dir, tarfile.open(path, mode, **options) as image:
+        for layer_idx in range(layers):
+            layer_tar = os.path.join(work_dir, 'layer.tar')
+            with open(layer_tar, 'wb') as f:
+                _write_layer(f, layer_idx, rnd, corpus, live_files, files, file_size, depth, fanout,
+                             whiteouts if layer_idx else 0, huge_file_size if layer_idx == layers - 1 else 0)
+            diff_id = _sha256_file(layer_tar)
+            diff_ids.append(f"sha256:{diff_id}")
+            blob = layer_tar
+            if compression == 'layers':
+                blob = layer_tar + '.gz'
+                with open(layer_tar, 'rb') as src, gzip.open(blob, 'wb', compresslevel=6) as dst:
+                    shutil.copyfileobj(src, dst, 1024 * 1024)
+            layer_path = f"{diff_id}/layer.tar"
+            layer_paths.append(layer_path)
+            image.add(blob, arcname=layer_path)
+
+        config = json.dumps({
+            'architecture': 'amd64',
+            'os': 'linux',
+            'rootfs': {'type': 'layers', 'diff_ids': diff_ids},
+            'history': [{'created_by': f"/bin/sh -c #(nop) synthetic layer {i}"} for i in range(layers)],
+        }).encode()
+        config_name = f"{hashlib.sha256(config).hexdigest()}.json"
+        manifest = json.dumps([{'Config': config_name, 'RepoTags': ['trawler-bench:latest'],
+                                'Layers': layer_paths}]).encode()
+        for name, data in ((config_name, config), ('manifest.json', manifest)):
+            member = tarfile.TarInfo(name)
+            member.size = len(data)
+            member.mtime = MTIME
+            image.addfile(member, io.BytesIO(data))
+
+    return {
+        'path': path, 'size_bytes': os.path.getsize(path), 'layers': layers, 'files': files,
+        'file_size': file_size, 'depth': depth, 'fanout': fanout, 'compression': compression,
+        'whiteouts': whiteouts, 'huge_file_size': huge_file_size, 'seed': seed,
+    }
+
+
+def add_arguments(parser):
+    parser.add_argument('--layers', type=int, default=10, help="number of layers (default: 10)")
+    parser.add_argument('--files', type=int, default=1000, help="regular files per layer (default: 1000)")
+    parser.add_argument('--file-size', type=int, default=4096,
+                        help="mean file size in bytes; sizes are uniform from 0 to twice this (default: 4096)")
+    parser.add_argument('--depth', type=int, default=4, help="maximum directory depth (default: 4)")
+    parser.add_argument('--fanout', type=int, default=4, help="subdirectories per directory (default: 4)")
+    parser.add_argument('--compression', choices=COMPRESSIONS, default='none',
+                        help="gzip nothing, each layer blob, or the whole image (default: none)")
+    parser.add_argument('--whiteouts', type=float, default=0.05,
+                        help="share of files per layer that delete an earlier file (default: 0.05)")
+    parser.add_argument('--huge-file-size', type=int, default=0,
+                        help="size of one extra file in the last layer, for extraction (default: none)")
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def image_options(args):
+    return {name: getattr(args, name) for name in
+            ('layers', 'files', 'file_size', 'depth', 'fanout', 'compression', 'whiteouts', 'huge_file_size', 'seed')}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generate a synthetic docker-save image.")
+    parser.add_argument('output', help="image path to write (use .tar.gz with --compression image)")
+    add_arguments(parser)
+    args = parser.parse_args()
+    print(json.dumps(make_image(args.output, **image_options(args)), indent=2))
@@ -0,0 +1,230 @@
+"""Time the main inspector operations and print the results as JSON.
+
+    python -m benchmarks.run --layers 20 --files 5000 --huge-file-size 500000000 -o results.json
+    python -m benchmarks.run --image some-image.tar --substring libssl --glob '*.so' --regex 'lib.*\\.so\\.3$'
+
+Every case runs in a fresh process, so each one reports its own peak RSS.
+Cases other than the loads open the image from an index cache warmed
+beforehand, so they measure the operation rather than the indexing.
+"""
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+from contextlib import redirect_stdout
+from benchmarks.make_image import NEEDLE, add_arguments, image_options, make_image
+from trawler.container_image_inspector import ContainerImageInspector
+from trawler.index_cache import IndexCache
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Cases whose result the inspector keeps, so each run needs a fresh process.
+FRESH_PROCESS_CASES = ('load', 'load_cached', 'merged_view', 'image_stats')
+
+
+def peak_rss():
+    """Return the peak RSS in bytes of this process and of its finished children, or (None, None)."""
+    if resource is None:
+        return None, None
+    unit = 1 if sys.platform == 'darwin' else 1024  # ru_maxrss is in bytes on macOS, KiB elsewhere
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit)
+
+
+def open_image(image_path, cache_dir, jobs):
+    with redirect_stdout(io.StringIO()):  # The inspector announces the load on stdout
+        return ContainerImageInspector(image_path, index_cache=IndexCache(cache_dir) if cache_dir else None, jobs=jobs)
+
+
+def run_operation(inspector, kind, argument):
+    """Run one benchmarked operation; argument comes from the case list built by plan_cases."""
+    if kind == 'list':
+        layer_idx, path = argument
+        inspector.list_files_in_layer(layer_idx, path)
+    elif kind == 'search_layer':
+        layer_idx, mode, query = argument
+        inspector.search_files_in_layer(layer_idx, query, mode=mode)
+    elif kind == 'search_all':
+        mode, query = argument
+        inspector.search_files_across_layers(query, mode)
+    elif kind == 'grep':
+        inspector.grep_layers(argument)
+    elif kind == 'merged_view':
+        inspector.merged_view()
+    elif kind == 'image_stats':
+        inspector.image_stats()
+    elif kind == 'extract':
+        layer_idx, path = argument
+        output_dir = tempfile.mkdtemp(prefix='trawler-bench-')
+        try:
+            inspector.extract_file_from_layer(layer_idx, path, output_dir)
+        finally:
+            shutil.rmtree(output_dir)
+    else:
+        raise ValueError(f"Unknown operation {kind}")
+
+
+def run_case(image_path, cache_dir, jobs, kind, argument, repeat):
+    """Run a case in this process and return its timings and peak RSS."""
+    if kind == 'load':
+        start = time.perf_counter()
+        open_image(image_path, None, jobs)
+        runs = [time.perf_counter() - start]
+    elif kind == 'load_cached':
+        start = time.perf_counter()
+        open_image(image_path, cache_dir, jobs)
+        runs = [time.perf_counter() - start]
+    else:
+        inspector = open_image(image_path, cache_dir, jobs)
+        runs = []
+        for _ in range(1 if kind in FRESH_PROCESS_CASES else repeat):
+            start = time.perf_counter()
+            run_operation(inspector, kind, argument)
+            runs.append(time.perf_counter() - start)
+    rss, children_rss = peak_rss()
+    return {'runs': runs, 'peak_rss_bytes': rss, 'children_peak_rss_bytes': children_rss}
+
+
+def run_case_in_subprocess(image_path, cache_dir, jobs, kind, argument, repeat):
+    case = json.dumps([image_path, cache_dir, jobs, kind, argument, repeat])
+    output = subprocess.run([sys.executable, '-m', 'benchmarks.run', '--case', case], cwd=REPO_DIR,
+                            check=True, stdout=subprocess.PIPE).stdout
+    return json.loads(output)
+
+
+def find_targets(inspector):
+    """Pick what to list and extract: directories at each depth of the largest layer, a median and the largest file."""
+    layer_idx = max(range(len(inspector.layers)), key=lambda idx: inspector.layer_summary(idx).file_count)
+    dirs = ['']  # dirs[depth] is the first directory found at that depth
+    pending = ['']
+    while pending:
+        children = [entry.name for entry in inspector.list_files_in_layer(layer_idx, pending.pop(0)) if entry.isdir()]
+        if children:
+            depth = children[0].count('/') + 1
+            if depth == len(dirs):
+                dirs.append(children[0])
+            pending.extend(children)
+
+    files = [(entry.size, idx, entry.name)
+             for idx, entries in inspector.search_files_across_layers('').items()
+             for entry in entries if entry.isreg()]
+    files.sort()
+    targets = {'layer': layer_idx, 'dirs': dirs}
+    if files:
+        size, file_layer, path = files[len(files) // 2]
+        targets['small_file'] = [file_layer, path, size]
+        size, file_layer, path = files[-1]
+        targets['huge_file'] = [file_layer, path, size]
+    return targets
+
+
+def plan_cases(targets, args):
+    """Return (name, kind, argument) for every case to run."""
+    layer_idx = targets['layer']
+    cases = [('load', 'load', None), ('load_cached', 'load_cached', None)]
+    cases += [(f'list_depth_{depth}', 'list', [layer_idx, path]) for depth, path in enumerate(targets['dirs'])]
+    for mode, query in (('substring', args.substring), ('glob', args.glob), ('regex', args.regex)):
+        cases.append((f'search_layer_{mode}', 'search_layer', [layer_idx, mode, query]))
+        cases.append((f'search_all_{mode}', 'search_all', [mode, query]))
+    cases += [('grep', 'grep', args.grep), ('merged_view', 'merged_view', None), ('image_stats', 'image_stats', None)]
+    for name in ('small_file', 'huge_file'):
+        if name in targets:
+            file_layer, path, size = targets[name]
+            cases.append((f'extract_{name}', 'extract', [file_layer, path]))
+    return cases
+
+
+def summarize(results):
+    runs = [run for result in results for run in result['runs']]
+    peaks = [result['peak_rss_bytes'] for result in results if result['peak_rss_bytes'] is not None]
+    children = [result['children_peak_rss_bytes'] for result in results if result['children_peak_rss_bytes'] is not None]
+    return {
+        'seconds': statistics.median(runs),
+        'min_seconds': min(runs),
+        'first_seconds': runs[0],
+        'runs': runs,
+        'peak_rss_bytes': max(peaks) if peaks else None,
+        'children_peak_rss_bytes': max(children) if children else None,
+    }
+
+
+def run_benchmarks(args):
+    with tempfile.TemporaryDirectory(prefix='trawler-bench-') as work_dir:
+        if args.image:
+            image_path = os.path.abspath(args.image)
+            image = {'path': image_path, 'size_bytes': os.path.getsize(image_path)}
+        else:
+            suffix = '.tar.gz' if args.compression == 'image' else '.tar'
+            image_path = os.path.join(work_dir, 'image' + suffix)
+            print(f"Generating {image_path}...", file=sys.stderr)
+            image = make_image(image_path, **image_options(args))
+            image['path'] = None  # Deleted with the work directory
+
+        cache_dir = os.path.join(work_dir, 'cache')
+        inspector = open_image(image_path, cache_dir, args.jobs)  # Also warms the index cache
+        targets = find_targets(inspector)
+        inspector.close()
+
+        results = {}
+        for name, kind, argument in plan_cases(targets, args):
+            print(f"Running {name}...", file=sys.stderr)
+            process_count = args.repeat if kind in FRESH_PROCESS_CASES else 1
+            results[name] = summarize([
+                run_case_in_subprocess(image_path, cache_dir, args.jobs, kind, argument, args.repeat)
+                for _ in range(process_count)
+            ])
+
+    return {
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'jobs': args.jobs,
+        },
+        'image': image,
+        'targets': targets,
+        'results': results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the inspector on a generated or existing image.")
+    parser.add_argument('--image', help="benchmark this image instead of generating one")
+    add_arguments(parser)
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help="worker processes used by the inspector (default: number of CPUs)")
+    parser.add_argument('--repeat', type=int, default=3, help="runs of each case (default: 3)")
+    parser.add_argument('--substring', default='file_1_1', help="substring search query")
+    parser.add_argument('--glob', default='*/dir1/*7.txt', help="glob search query")
+    parser.add_argument('--regex', default=r'file_\d+_\d*99\.txt$', help="regex search query")
+    parser.add_argument('--grep', default=NEEDLE, help="text for the content search")
+    parser.add_argument('-o', '--output', help="write the JSON results to this file instead of stdout")
+    parser.add_argument('--case', help=argparse.SUPPRESS)  # Internal: run one case and print its result
+    args = parser.parse_args()
+
+    if args.case:
+        print(json.dumps(run_case(*json.loads(args.case))))
+        return
+
+    report = json.dumps(run_benchmarks(args), indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
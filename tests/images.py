@@ -0,0 +1,68 @@
+"""Build small docker-save images for the tests."""
+import io
+import json
+import hashlib
+import tarfile
+
+MTIME = 1700000000
+
+
+def directory(path):
+    member = tarfile.TarInfo(path)
+    member.type = tarfile.DIRTYPE
+    member.mode = 0o755
+    member.mtime = MTIME
+    return member, None
+
+
+def regular_file(path, data):
+    member = tarfile.TarInfo(path)
+    member.size = len(data)
+    member.mode = 0o644
+    member.mtime = MTIME
+    return member, data
+
+
+def hard_link(path, target):
+    member = tarfile.TarInfo(path)
+    member.type = tarfile.LNKTYPE
+    member.linkname = target
+    member.mode = 0o644
+    member.mtime = MTIME
+    return member, None
+
+
+def _layer_tar(members):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w', format=tarfile.PAX_FORMAT) as tar:
+        for member, data in members:
+            tar.addfile(member, io.BytesIO(data) if data is not None else None)
+    return buffer.getvalue()
+
+
+def _add_bytes(image, name, data):
+    member = tarfile.TarInfo(name)
+    member.size = len(data)
+    member.mtime = MTIME
+    image.addfile(member, io.BytesIO(data))
+
+
+def write_image(path, layers, tag='trawler-test:latest'):
+    """Write a docker-save image to path with one layer per list of (TarInfo, data) pairs."""
+    blobs = [_layer_tar(members) for members in layers]
+    diff_ids = [f"sha256:{hashlib.sha256(blob).hexdigest()}" for blob in blobs]
+    layer_paths = [f"{diff_id[len('sha256:'):]}/layer.tar" for diff_id in diff_ids]
+    config = json.dumps({
+        'architecture': 'amd64',
+        'os': 'linux',
+        'rootfs': {'type': 'layers', 'diff_ids': diff_ids},
+        'history': [{'created_by': f"/bin/sh -c #(nop) test layer {i}"} for i in range(len(layers))],
+    }).encode()
+    config_name = f"{hashlib.sha256(config).hexdigest()}.json"
+    manifest = json.dumps([{'Config': config_name, 'RepoTags': [tag], 'Layers': layer_paths}]).encode()
+    with tarfile.open(path, 'w') as image:
+        for layer_path, blob in zip(layer_paths, blobs):
+            _add_bytes(image, layer_path, blob)
+        _add_bytes(image, config_name, config)
+        _add_bytes(image, 'manifest.json', manifest)
+    return path
@@ -0,0 +1,61 @@
+import os
+import tempfile
+import unittest
+
+from trawler.container_image_inspector import ContainerImageInspector
+from tests.images import directory, hard_link, regular_file, write_image
+
+
+class ExtractTest(unittest.TestCase):
+    def setUp(self):
+        work_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(work_dir.cleanup)
+        self.work_dir = work_dir.name
+        self.output_dir = os.path.join(self.work_dir, 'out')
+
+    def inspector(self, *layers):
+        inspector = ContainerImageInspector(write_image(os.path.join(self.work_dir, 'image.tar'), layers))
+        self.addCleanup(inspector.close)
+        return inspector
+
+    def read_output(self, path):
+        with open(os.path.join(self.output_dir, path), 'rb') as f:
+            return f.read()
+
+    def test_hard_link_to_a_file_outside_the_folder_is_copied(self):
+        inspector = self.inspector([directory('a'), regular_file('a/file', b'hello\n'),
+                                    directory('b'), hard_link('b/hl', 'a/file')])
+        message = inspector.extract_file_from_layer(0, 'b', self.output_dir)
+        self.assertTrue(message.startswith("Extracted"), message)
+        self.assertEqual(self.read_output('b/hl'), b'hello\n')
+        self.assertFalse(os.path.exists(os.path.join(self.output_dir, 'a')))
+
+    def test_hard_link_inside_the_folder_is_linked(self):
+        inspector = self.inspector([directory('a'), regular_file('a/file', b'hello\n'),
+                                    hard_link('a/hl', 'a/file')])
+        message = inspector.extract_file_from_layer(0, 'a', self.output_dir)
+        self.assertTrue(message.startswith("Extracted"), message)
+        self.assertEqual(self.read_output('a/hl'), b'hello\n')
+        self.assertTrue(os.path.samefile(os.path.join(self.output_dir, 'a/file'),
+                                         os.path.join(self.output_dir, 'a/hl')))
+
+    def test_files_with_the_same_base_name_are_not_overwritten(self):
+        inspector = self.inspector([regular_file('etc/app/config', b'etc\n')],
+                                   [regular_file('opt/app/config', b'opt\n'), regular_file('opt/other', b'other\n')])
+        messages = inspector.extract_files([(1, 'opt/app/config'), (0, 'etc/app/config'), (1, 'opt/other')],
+                                           self.output_dir)
+        self.assertTrue(messages[0].startswith("Extracted"), messages[0])
+        self.assertTrue(messages[1].startswith("Not extracted"), messages[1])
+        self.assertTrue(messages[2].startswith("Extracted"), messages[2])
+        self.assertEqual(self.read_output('config'), b'opt\n')
+        self.assertEqual(self.read_output('other'), b'other\n')
+
+    def test_the_same_file_selected_twice_is_extracted(self):
+        inspector = self.inspector([regular_file('etc/config', b'etc\n')])
+        messages = inspector.extract_files([(0, 'etc/config'), (0, 'etc/config')], self.output_dir)
+        self.assertTrue(all(message.startswith("Extracted") for message in messages), messages)
+        self.assertEqual(self.read_output('config'), b'etc\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+import os
+import json
+import asyncio
+import tempfile
+import threading
+import unittest
+import http.client
+
+from trawler.image_session import ImageSession
+from trawler.server import InspectionServer
+from tests.images import directory, regular_file, write_image
+
+
+class ServerTest(unittest.TestCase):
+    """Runs an InspectionServer on an ephemeral port and queries it with http.client."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.work_dir = tempfile.TemporaryDirectory()
+        path = write_image(os.path.join(cls.work_dir.name, 'image.tar'), [
+            [directory('etc'), regular_file('etc/passwd', b'root:x:0:0\n'), regular_file('etc/config', b'old\n')],
+            [directory('etc'), regular_file('etc/config', b'new needle\n'), regular_file('etc/.wh.passwd', b'')],
+        ])
+        cls.session = ImageSession([path])
+        cls.loop = asyncio.new_event_loop()
+        cls.thread = threading.Thread(target=cls.loop.run_forever, daemon=True)
+        cls.thread.start()
+
+        async def start():
+            server = InspectionServer(cls.session, workers=2)
+            return server, await asyncio.start_server(server.handle, '127.0.0.1', 0)
+
+        cls.server, cls.listener = asyncio.run_coroutine_threadsafe(start(), cls.loop).result(10)
+        cls.port = cls.listener.sockets[0].getsockname()[1]
+
+    @classmethod
+    def tearDownClass(cls):
+        async def stop():
+            cls.listener.close()
+            await cls.listener.wait_closed()
+
+        asyncio.run_coroutine_threadsafe(stop(), cls.loop).result(10)
+        cls.server.close()
+        cls.loop.call_soon_threadsafe(cls.loop.stop)
+        cls.thread.join(10)
+        cls.loop.close()
+        for inspector in cls.session.images:
+            inspector.close()
+        cls.work_dir.cleanup()
+
+    def request(self, target, method='GET'):
+        """Return the status, the response for its headers, and the body of a request."""
+        connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=10)
+        try:
+            connection.request(method, target)
+            response = connection.getresponse()
+            return response.status, response, response.read()
+        finally:
+            connection.close()
+
+    def get_json(self, target, status=200):
+        code, response, body = self.request(target)
+        self.assertEqual(code, status, body)
+        self.assertEqual(response.getheader('Content-Type'), 'application/json')
+        return json.loads(body)
+
+    def get_records(self, target):
+        code, response, body = self.request(target)
+        self.assertEqual(code, 200, body)
+        self.assertEqual(response.getheader('Content-Type'), 'application/x-ndjson')
+        self.assertEqual(response.getheader('Transfer-Encoding'), 'chunked')
+        return [json.loads(line) for line in body.decode().splitlines()]
+
+    def test_images(self):
+        [image] = self.get_json('/images')['images']
+        self.assertEqual((image['image'], image['layers'], image['error']), (0, 2, None))
+
+    def test_layers(self):
+        layers = self.get_json('/layers?image=0')
+        self.assertEqual([layer['layer'] for layer in layers], [0, 1])
+        self.assertEqual([layer['file_count'] for layer in layers], [2, 2])
+
+    def test_ls(self):
+        merged = {entry['path']: entry for entry in self.get_json('/ls?path=etc&deleted=1')}
+        self.assertEqual(merged['etc/config']['status'], 'modified')
+        self.assertEqual(merged['etc/passwd']['status'], 'deleted')
+        layer = self.get_json('/ls?path=etc&layer=0')
+        self.assertEqual(sorted(entry['path'] for entry in layer), ['etc/config', 'etc/passwd'])
+
+    def test_find_streams_records(self):
+        records = self.get_records('/find?q=config')
+        self.assertEqual(sorted(record['layer'] for record in records), [0, 1])
+        self.assertTrue(all(record['path'] == 'etc/config' for record in records))
+        self.assertEqual(self.get_records('/find?q=nothing-matches'), [])
+
+    def test_grep_streams_records(self):
+        [record] = self.get_records('/grep?pattern=NEEDLE&ignore_case=1')
+        self.assertEqual((record['layer'], record['path'], record['line']), (1, 'etc/config', 'new needle'))
+
+    def test_stats(self):
+        stats = self.get_json('/stats?image=0')
+        self.assertEqual(len(stats['layers']), 2)
+
+    def test_extract(self):
+        status, response, body = self.request('/extract?path=etc/config')
+        self.assertEqual((status, body), (200, b'new needle\n'))
+        self.assertEqual(response.getheader('Content-Length'), str(len(body)))
+        status, _, body = self.request('/extract?path=etc/config&layer=0')
+        self.assertEqual((status, body), (200, b'old\n'))
+
+    def test_bad_requests(self):
+        for target in ('/find', '/grep?pattern=(&regex=1', '/ls?layer=x', '/extract?path=etc&layer=0'):
+            with self.subTest(target=target):
+                self.assertIn('error', self.get_json(target, status=400))
+        for target in ('/nowhere', '/layers?image=1', '/ls?layer=2', '/ls?path=missing',
+                       '/extract?path=etc/passwd', '/extract?path=missing&layer=0'):
+            with self.subTest(target=target):
+                self.assertIn('error', self.get_json(target, status=404))
+        self.assertEqual(self.request('/images', method='POST')[0], 405)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,414 @@
+import os
+import re
+import sys
+import json
+import posixpath
+import signal
+import tarfile
+import argparse
+from trawler.container_image_inspector import ContainerImageInspector
+from trawler.content_search import DEFAULT_MAX_FILE_SIZE
+from trawler.image_session import ImageSession
+from trawler.index_cache import IndexCache
+from trawler.layer_stats import format_size
+from trawler.profiler import (DEFAULT_TRACE_PATH, PROFILE_ENV, profile_path_from_env, start_profiling,
+                              stop_profiling)
+from trawler.search_index import parse_query
+
+# Exit statuses, as with grep: 1 means the command ran but found nothing (or a
+# check failed), 2 means it could not run.
+EXIT_OK = 0
+EXIT_NOT_FOUND = 1
+EXIT_ERROR = 2
+EXIT_INTERRUPTED = 130
+
+DEFAULT_PORT = 8765  # Port of the serve command
+
+COMMANDS = ('ui', 'layers', 'ls', 'find', 'grep', 'extract', 'stats', 'diff', 'serve')
+
+_TYPE_NAMES = {
+    tarfile.REGTYPE: 'file', tarfile.AREGTYPE: 'file', tarfile.CONTTYPE: 'file', tarfile.GNUTYPE_SPARSE: 'file',
+    tarfile.DIRTYPE: 'dir', tarfile.SYMTYPE: 'symlink', tarfile.LNKTYPE: 'hardlink',
+    tarfile.CHRTYPE: 'char', tarfile.BLKTYPE: 'block', tarfile.FIFOTYPE: 'fifo',
+}
+
+
+def entry_record(layer_idx, entry):
+    """Return the NDJSON record of a file entry."""
+    record = {
+        'layer': layer_idx,
+        'path': entry.name,
+        'type': _TYPE_NAMES.get(entry.type, 'other'),
+        'size': entry.size,
+        'mode': entry.mode,
+        'uid': entry.uid,
+        'gid': entry.gid,
+        'mtime': entry.mtime,
+    }
+    if entry.linkname:
+        record['linkname'] = entry.linkname
+    return record
+
+
+def merged_record(entry):
+    record = entry_record(entry.layer, entry)
+    record['status'] = entry.status
+    record['changed_by'] = entry.changed_by
+    return record
+
+
+def holder_record(session, holders, layer_record):
+    """Add the images holding a layer to a record made for its first copy, in multi-image sessions."""
+    if len(session.images) > 1:
+        layer_record['image'] = session.images[holders[0][0]].local_image_path
+        layer_record['images'] = [{'image': session.images[image_idx].local_image_path, 'layer': layer_idx}
+                                  for image_idx, layer_idx in holders]
+    return layer_record
+
+
+def diff_record(entry, old_layer=None, new_layer=None):
+    """Return the NDJSON record of a DiffEntry; the layers are needed for layer diffs only."""
+    old, new = entry.old, entry.new
+    return {
+        'path': entry.path,
+        'status': entry.status,
+        'size_delta': entry.size_delta,
+        'old': None if old is None else entry_record(getattr(old, 'layer', old_layer), old),
+        'new': None if new is None else entry_record(getattr(new, 'layer', new_layer), new),
+    }
+
+
+def emit(records, out=None):
+    """Write records as NDJSON and flush, so a pipeline sees each batch as soon as it is ready."""
+    out = out or sys.stdout
+    for record in records:
+        out.write(json.dumps(record))
+        out.write('\n')
+    out.flush()
+
+
+def normalize_path(path):
+    return path.strip('/').removeprefix('./') if path not in ('', '.', './', '/') else ''
+
+
+def run_layers(session, args):
+    for inspector in session.images:
+        for layer_idx, layer_name in enumerate(inspector.wait_for_layer_list()):
+            summary = inspector.layer_summary(layer_idx)
+            record = {
+                'layer': layer_idx,
+                'id': layer_name,
+                'digest': inspector.layer_digests[layer_idx],
+                'command': inspector.get_layer_command(layer_name),
+                'size': summary.size,
+                'file_count': summary.file_count,
+            }
+            if len(session.images) > 1:
+                record['image'] = inspector.local_image_path
+            emit([record])
+    return EXIT_OK
+
+
+def _walk(list_dir, path, recursive):
+    """Yield the entries of a directory, and with recursive everything below it, a directory at a time."""
+    pending = [path]
+    while pending:
+        entries = list_dir(pending.pop())
+        yield entries
+        if recursive:
+            pending.extend(entry.name for entry in reversed(entries) if entry.isdir())
+
+
+def _check_layer(layer_idx, layer_count):
+    if layer_idx is not None and not 0 <= layer_idx < layer_count:
+        raise ValueError(f"Layer {layer_idx} does not exist; the image has {layer_count} layers")
+
+
+def _single_image(session, args):
+    """Return the inspector of a session, which --layer needs to have a single image."""
+    if args.layer is not None and len(session.images) > 1:
+        raise ValueError("--layer needs a single image")
+    return session.images[0]
+
+
+def run_ls(inspector, args):
+    path = normalize_path(args.path)
+    _check_layer(args.layer, len(inspector.wait_for_layer_list()))
+    if args.layer is not None:
+        list_dir = lambda dir_path: inspector.list_files_in_layer(args.layer, dir_path)
+        to_record = lambda entry: entry_record(args.layer, entry)
+    else:
+        list_dir = lambda dir_path: inspector.list_merged_files(dir_path, include_deleted=args.deleted)
+        to_record = merged_record
+
+    if path:
+        entry = next((e for e in list_dir(posixpath.dirname(path)) if e.name == path), None)
+        if entry is None:
+            print(f"trawler: {args.path}: no such file or directory", file=sys.stderr)
+            return EXIT_NOT_FOUND
+        if not entry.isdir():
+            emit([to_record(entry)])
+            return EXIT_OK
+    for entries in _walk(list_dir, path, args.recursive):
+        emit(to_record(entry) for entry in entries)
+    return EXIT_OK
+
+
+def run_find(session, args):
+    mode, pattern = parse_query(args.query)
+    inspector = _single_image(session, args)
+    _check_layer(args.layer, len(inspector.wait_for_layer_list()))
+    if args.layer is not None:
+        matches = inspector.search_files_in_layer(args.layer, pattern, mode=mode)
+        emit(entry_record(args.layer, entry) for entry in matches)
+    else:
+        # Each layer is searched once, however many of the images hold it.
+        matches = session.search_files(pattern, mode, on_layer=lambda holders, entries: emit(
+            holder_record(session, holders, entry_record(holders[0][1], entry)) for entry in entries))
+    return EXIT_OK if matches else EXIT_NOT_FOUND
+
+
+def run_grep(session, args):
+    def on_layer(holders, matches):
+        emit(holder_record(session, holders, {'layer': holders[0][1], 'path': match.name,
+                                              'line_number': match.line_number, 'line': match.line})
+             for match in matches)
+
+    matches = session.grep(args.pattern, args.regex, args.ignore_case, args.max_size, on_layer=on_layer)
+    return EXIT_OK if matches else EXIT_NOT_FOUND
+
+
+def run_extract(inspector, args):
+    _check_layer(args.layer, len(inspector.wait_for_layer_list()))
+    records = []
+    selections = []
+    for path in map(normalize_path, args.paths):
+        layer_idx, message = args.layer, None
+        if layer_idx is None:
+            # Without --layer a file is taken from the layer that provides it in the final image.
+            entry = inspector.merged_view().get(path)
+            if entry is None or entry.status == 'deleted':
+                message = f"{path} is not in the image"
+            elif entry.isdir():
+                message = f"{path} is a directory; use --layer to extract it from one layer"
+            else:
+                layer_idx = entry.layer
+        if message is None:
+            selections.append((layer_idx, path))
+        records.append({'layer': layer_idx, 'path': path, 'ok': False, 'message': message})
+
+    os.makedirs(args.output, exist_ok=True)
+    messages = iter(inspector.extract_files(selections, args.output))
+    for record in records:
+        if record['message'] is None:
+            record['message'] = next(messages)
+            record['ok'] = record['message'].startswith("Extracted")
+    emit(records)
+    return EXIT_OK if all(record['ok'] for record in records) else EXIT_NOT_FOUND
+
+
+def run_stats(session, args, as_json=True):
+    status = EXIT_OK
+    for inspector in session.images:
+        if not as_json and len(session.images) > 1:
+            print(f"{inspector.local_image_path}:")
+        status = max(status, _image_stats(inspector, args, as_json))
+    return status
+
+
+def _image_stats(inspector, args, as_json):
+    layers = inspector.wait_for_layer_list()
+    stats = inspector.image_stats()
+    for layer_idx, layer in enumerate(stats.layers):
+        command = inspector.get_layer_command(layers[layer_idx])
+        if as_json:
+            emit([dict(layer=layer_idx, id=layers[layer_idx], command=command, **layer.to_dict())])
+        else:
+            print(f"Layer {layer_idx}: {format_size(layer.size):>9} {layer.file_count:>7} files "
+                  f"{format_size(layer.wasted_bytes):>9} wasted  {command}")
+    summary = stats.to_dict()
+    del summary['layers']
+    if as_json:
+        emit([dict(image=inspector.local_image_path, **summary)])
+    else:
+        print(f"Total size: {format_size(stats.total_bytes)}, wasted: {format_size(stats.wasted_bytes)}, "
+              f"efficiency: {stats.efficiency:.2%}")
+    if args.min_efficiency is not None and stats.efficiency < args.min_efficiency:
+        print(f"Efficiency {stats.efficiency:.2%} is below the minimum of {args.min_efficiency:.2%}", file=sys.stderr)
+        return EXIT_NOT_FOUND
+    return EXIT_OK
+
+
+def run_diff(inspector, args):
+    if not os.path.isfile(args.other):
+        raise ValueError(f"File not found: {args.other}")
+    if os.path.samefile(args.image, args.other):
+        other = inspector
+    else:
+        other = ContainerImageInspector(local_image_path=args.other, index_cache=inspector.index_cache,
+                                        jobs=args.jobs, background=True)
+    try:
+        _check_layer(args.layer, len(inspector.wait_for_layer_list()))
+        _check_layer(args.other_layer, len(other.wait_for_layer_list()))
+        if args.layer_files:
+            if args.layer is None or args.other_layer is None:
+                raise ValueError("--layer-files needs --layer and --other-layer")
+            diff = inspector.diff_layers(args.layer, args.other_layer, other)
+        else:
+            diff = inspector.diff(other, args.layer, args.other_layer)
+        emit(diff_record(entry, args.layer, args.other_layer) for entry in diff.entries)
+        emit([dict(old=args.image, new=args.other, **diff.to_dict())])
+    finally:
+        if other is not inspector:
+            other.cancel_loading(wait=True)
+    return EXIT_NOT_FOUND if diff.entries else EXIT_OK
+
+
+def run_ui(session, args):
+    if args.stats or args.min_efficiency is not None:
+        return run_stats(session, args, as_json=False)
+    # Imported here so batch commands never load curses.
+    from trawler.ui_handler import run_curses_ui
+    run_curses_ui(session.images[0], session.images)
+    return EXIT_OK
+
+
+def run_serve(session, args):
+    # Imported here so other commands never load asyncio.
+    from trawler.server import serve
+    serve(session, args.port)
+    return EXIT_OK
+
+
+def build_parser():
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help="worker processes used to index and search layers (default: number of CPUs)")
+    common.add_argument('--no-cache', action='store_true', help="don't read or write the index cache")
+    common.add_argument('--profile', action='store_true',
+                        help=f"record call times, bytes read and decompressed, members parsed and cache hits, "
+                             f"and write them as a Chrome trace on exit (also enabled by {PROFILE_ENV}=PATH)")
+    common.add_argument('--profile-output', metavar='PATH',
+                        help=f"profile, writing the trace to PATH (default with --profile: {DEFAULT_TRACE_PATH})")
+    # Commands taking several images index the layers they share only once.
+    one_image = argparse.ArgumentParser(add_help=False)
+    one_image.add_argument('image', help="path to a docker-save .tar or .tar.gz image")
+    images_help = "paths to docker-save .tar or .tar.gz images"
+    images = argparse.ArgumentParser(add_help=False)
+    images.add_argument('images', nargs='+', metavar='image', help=images_help)
+
+    parser = argparse.ArgumentParser(
+        prog='trawler.py', description="Inspect the layers of a container image.",
+        epilog="Without a command, the image is opened in the interactive interface. Batch commands write "
+               "one JSON record per line and exit with 0 on success, 1 if nothing matched and 2 on errors. "
+               "ui, layers, find, grep, stats and serve take several images, indexing the layers they share once.")
+    commands = parser.add_subparsers(dest='command', metavar='command')
+
+    ui = commands.add_parser('ui', parents=[images, common], help="browse the image interactively (the default)")
+    ui.add_argument('--stats', action='store_true',
+                    help="print each layer's size, file count and wasted bytes, and the image efficiency, then exit")
+    ui.add_argument('--min-efficiency', type=float, metavar='SCORE',
+                    help="with --stats, exit with status 1 if the efficiency is below SCORE (0.0 to 1.0)")
+    ui.set_defaults(run=run_ui)
+
+    layers = commands.add_parser('layers', parents=[images, common], help="list the layers with their commands and sizes")
+    layers.set_defaults(run=run_layers)
+
+    ls = commands.add_parser('ls', parents=[one_image, common], help="list a directory of the final image or of one layer")
+    ls.add_argument('path', nargs='?', default='', help="directory or file to list (default: the root)")
+    ls.add_argument('--layer', type=int, help="list this layer's own files instead of the merged filesystem")
+    ls.add_argument('-r', '--recursive', action='store_true', help="list everything below the directory")
+    ls.add_argument('--deleted', action='store_true', help="include paths deleted by whiteouts (merged view only)")
+    ls.set_defaults(run=run_ls)
+
+    # find and grep take the pattern before the images, as grep does: argparse can't tell the
+    # pattern from an image when an option sits between the images and a trailing pattern.
+    find = commands.add_parser('find', parents=[common], help="find paths in every layer")
+    find.add_argument('query', help="substring, glob (*, ?, [...]) or 're:' regular expression")
+    find.add_argument('images', nargs='+', metavar='image', help=images_help)
+    find.add_argument('--layer', type=int, help="search only this layer")
+    find.set_defaults(run=run_find)
+
+    grep = commands.add_parser('grep', parents=[common], help="search file contents in every layer")
+    grep.add_argument('pattern', help="text to search for")
+    grep.add_argument('images', nargs='+', metavar='image', help=images_help)
+    grep.add_argument('-E', '--regex', action='store_true', help="treat the pattern as a regular expression")
+    grep.add_argument('-i', '--ignore-case', action='store_true', help="ignore case")
+    grep.add_argument('--max-size', type=int, default=DEFAULT_MAX_FILE_SIZE, metavar='BYTES',
+                      help=f"skip files larger than this (default: {DEFAULT_MAX_FILE_SIZE})")
+    grep.set_defaults(run=run_grep)
+
+    extract = commands.add_parser('extract', parents=[one_image, common], help="extract files or directories")
+    extract.add_argument('paths', nargs='+', metavar='path')
+    extract.add_argument('--layer', type=int,
+                         help="extract from this layer (default: the layer providing each file in the final image)")
+    extract.add_argument('-o', '--output', default='.', help="output directory (default: the current directory)")
+    extract.set_defaults(run=run_extract)
+
+    stats = commands.add_parser('stats', parents=[images, common], help="report layer sizes, wasted bytes and efficiency")
+    stats.add_argument('--min-efficiency', type=float, metavar='SCORE',
+                       help="exit with status 1 if the efficiency is below SCORE (0.0 to 1.0)")
+    stats.set_defaults(run=run_stats)
+
+    diff = commands.add_parser('diff', parents=[one_image, common], help="list paths added, removed or modified by another image",
+                               description="Compare the final filesystem of IMAGE with that of OTHER. Exits with "
+                                           "0 when they match and 1 when they differ, as diff does.")
+    diff.add_argument('other', help="image to compare with (may be IMAGE itself, with --layer/--other-layer)")
+    diff.add_argument('--layer', type=int, help="compare IMAGE as of this layer (default: its last)")
+    diff.add_argument('--other-layer', type=int, help="compare OTHER as of this layer (default: its last)")
+    diff.add_argument('--layer-files', action='store_true',
+                      help="compare only the files of --layer and --other-layer, not the filesystems up to them")
+    diff.set_defaults(run=run_diff)
+
+    serve = commands.add_parser('serve', parents=[images, common], help="serve the images over a local HTTP/JSON API",
+                                description="Index the images once and answer requests from local clients: "
+                                            "/images, /layers, /ls, /find, /grep, /stats and /extract. "
+                                            "The server listens on 127.0.0.1 only.")
+    serve.add_argument('-p', '--port', type=int, default=DEFAULT_PORT,
+                       help=f"port to listen on, 0 for any free one (default: {DEFAULT_PORT})")
+    serve.set_defaults(run=run_serve)
+    return parser
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+    if argv and argv[0] not in COMMANDS and argv[0] not in ('-h', '--help'):
+        argv.insert(0, 'ui')  # trawler.py IMAGE opens the interface, as it always has
+    args = build_parser().parse_args(argv)
+    if args.command is None:
+        build_parser().print_usage(sys.stderr)
+        return EXIT_ERROR
+
+    paths = args.images if 'images' in args else [args.image]
+    for path in paths:
+        if not os.path.isfile(path):
+            print(f"File not found: {path}", file=sys.stderr)
+            return EXIT_ERROR
+    trace_path = args.profile_output or (DEFAULT_TRACE_PATH if args.profile else profile_path_from_env())
+    if trace_path:
+        start_profiling(trace_path)
+    if args.command not in ('ui', 'serve') and hasattr(signal, 'SIGPIPE'):
+        # Stop quietly when the reading end of a pipeline, such as head, goes away.
+        signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+    # Index on background threads: the interface shows layers as soon as the
+    # manifest is read, and batch commands start on layers as they are indexed.
+    session = ImageSession(paths, index_cache=None if args.no_cache else IndexCache(), jobs=args.jobs,
+                           background=True)
+    try:
+        return args.run(session if 'images' in args else session.images[0], args)
+    except KeyboardInterrupt:
+        return EXIT_INTERRUPTED
+    except re.error as e:
+        print(f"trawler: invalid pattern: {e}", file=sys.stderr)
+        return EXIT_ERROR
+    except Exception as e:
+        if args.command == 'ui':
+            raise
+        print(f"trawler: {e}", file=sys.stderr)
+        return EXIT_ERROR
+    finally:
+        # Let an almost finished load write the index cache before the process exits.
+        session.cancel_loading(wait=True)
+        if trace_path:
+            stop_profiling()  # Writes the trace, including the cancelled load
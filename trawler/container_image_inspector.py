@@ -1,30 +1,143 @@
 import os
+import copy
 import json
 import tarfile
+import posixpath
+import threading
+import multiprocessing
+from itertools import groupby
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from trawler.content_search import (DEFAULT_MAX_FILE_SIZE, ContentMatch, compile_pattern, grep_blob_ranges,
+                                    grep_range)
+from trawler.gzip_index import GzipIndex
+from trawler.image_diff import (CHANGED, CHECK_CONTENT, DiffEntry, ImageDiff, changed_paths, compare_entries,
+                                layer_pairs, merged_pairs, shared_layer_count)
+from trawler.image_reader import COPY_CHUNK, ImageReader, blob_compression, open_blob, open_range
+from trawler.index_cache import image_cache_key
+from trawler.file_table import FileTable, PathTable
+from trawler.layer_extractor import open_layer_tar
+from trawler.layer_index import DirectoryTree, OperationCancelled, index_layer_blob, read_table
+from trawler.layer_stats import HASH_BATCH_BYTES, ImageStats, LayerStats, hash_blob_ranges, hash_range
+from trawler.merged_view import MergedView
+from trawler.search_index import SearchIndex
+
+# Worker pools are started from loading and server threads. Forking while other
+# threads hold locks (sqlite, logging, the load condition) can copy a held lock
+# into a child and hang it, so workers come from a fork server, or are spawned
+# where there is none; the functions they run are top-level and picklable. The
+# fork server imports this module once, so new workers start with it loaded.
+POOL_CONTEXT = multiprocessing.get_context(
+    'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+if POOL_CONTEXT.get_start_method() == 'forkserver':
+    POOL_CONTEXT.set_forkserver_preload([__name__])
+MAX_LINK_DEPTH = 40  # Symlinks followed when extracting a link, as with the kernel's limit
 
 class ContainerImageInspector:
-    def __init__(self, local_image_path=None):
+    def __init__(self, local_image_path=None, index_cache=None, jobs=1, background=False, layer_store=None):
         self.layers = []
         self.layer_commands = []  # Store layer commands in order from history
+        self.layer_digests = []  # Digest of each layer's uncompressed tar (config rootfs.diff_ids), or None
         self.local_image_path = local_image_path
+        self.index_cache = index_cache  # Optional IndexCache used to skip re-indexing known images
+        self.jobs = jobs  # Worker processes used to index layers
+        self.layer_store = layer_store  # Optional image_session.LayerStore shared with other images
+        self._reader = None
+        self._image_source = None  # Random-access source over the uncompressed outer tar
+        self._layer_blobs = []  # (offset, size, compression) of each layer blob in the outer tar
+        self._layer_sources = []  # Random-access source over each layer's uncompressed tar
+        # Interned paths shared by every layer's file table (and, with a layer store, every image's)
+        self._path_table = PathTable() if layer_store is None else layer_store.path_table
+        self._layer_tables = []  # FileTable of each layer, or None until it has been indexed
+        self._layer_trees = {}  # DirectoryTree of each layer, built on first navigation
+        self._search_index = None  # SearchIndex over every layer, built on first search
+        self._merged_view = None  # MergedView of the layers, built on first use
+        self._merged_lock = threading.RLock()  # Held while a caller moves or reads the merged view
+        self._image_stats = None  # ImageStats, computed on first request
+        self._digests = {}  # (layer_idx, row) -> SHA-256 of file contents hashed so far
+        self._search_lock = threading.Lock() if layer_store is None else layer_store.search_lock
+        self._state = threading.Condition()  # Notified when the layer list or a layer table is published
+        self._cancel_loading = threading.Event()
+        self.loading = False  # True while a background load is running
+        self.load_error = None  # Exception that ended a background load early
         if local_image_path:
-            self._load_local_image(local_image_path)
+            if background:
+                # Layers become available one by one; see layer_ready and cancel_loading.
+                self.loading = True
+                threading.Thread(target=self._load_in_background, args=(local_image_path,), daemon=True).start()
+            else:
+                print(f"Loading image from {local_image_path}...")
+                self._load_local_image(local_image_path)
+
+    def _load_in_background(self, local_image_path):
+        try:
+            self._load_local_image(local_image_path, self._cancel_loading)
+        except Exception as e:
+            self.load_error = e
+        finally:
+            with self._state:
+                self.loading = False
+                self._state.notify_all()
+
+    def _load_local_image(self, local_image_path, cancel=None):
+        """Load a local container image file, index its layers, and retrieve commands."""
+        self._reader = ImageReader(local_image_path)
+        if local_image_path.endswith(('.tar.gz', '.tgz')):
+            # Inflater checkpoints saved during the first pass make later seeks cheap.
+            self._image_source = GzipIndex(self._reader)
+        else:
+            self._image_source = self._reader
+
+        cache_key = None
+        if self.index_cache is not None:
+            cache_key = image_cache_key(self._reader)
+            cached_index = self.index_cache.get(cache_key)
+            if cached_index is not None:
+                self._restore_index(cached_index)
+                return
+
+        layers = self._read_manifest(cancel)
+        for layer_blob in self._layer_blobs:
+            self._open_layer(layer_blob)
+        self._publish_layers(layers, [None] * len(layers))
+        if self.layer_store is None:
+            self._index_layers(range(len(layers)), cancel)
+        else:
+            self._index_shared_layers(cancel)
 
-    def _load_local_image(self, local_image_path):
-        """Load a local container image file, extract layers, and retrieve commands."""
-        print(f"Loading image from {local_image_path}...")
+        if cache_key is not None:
+            self.index_cache.put(cache_key, self._index_snapshot())
 
-        mode = 'r:gz' if local_image_path.endswith(('.tar.gz', '.tgz')) else 'r'
-        with tarfile.open(local_image_path, mode) as tar:
-            manifest_file = tar.extractfile("manifest.json")
+    def _read_manifest(self, cancel=None):
+        """Locate the layer blobs and their commands from manifest.json and the image config.
+
+        Returns the layer names, which the caller publishes once the layers are opened.
+        """
+        with tarfile.open(fileobj=open_range(self._image_source), mode='r:') as tar:
+            # A single pass over the outer archive records every member's offsets.
+            image_members = {}
+            for member in tar:
+                if cancel is not None and cancel.is_set():
+                    raise OperationCancelled("Loading cancelled")
+                image_members[member.name] = member
+
+            manifest_file = tar.extractfile(image_members["manifest.json"])
             manifest_data = json.load(manifest_file)
             config_file_name = manifest_data[0]["Config"]
             layer_paths = manifest_data[0]["Layers"]
 
-            self.layers = [os.path.dirname(layer_path) for layer_path in layer_paths]
+            layers = [os.path.dirname(layer_path) for layer_path in layer_paths]
+            for layer_path in layer_paths:
+                blob = image_members.get(layer_path)
+                if blob is None:
+                    self._layer_blobs.append(None)
+                else:
+                    compression = blob_compression(self._image_source, blob.offset_data)
+                    self._layer_blobs.append((blob.offset_data, blob.size, compression))
 
-            config_file = tar.extractfile(config_file_name)
+            config_file = tar.extractfile(image_members[config_file_name])
             config_data = json.load(config_file)
+            diff_ids = config_data.get("rootfs", {}).get("diff_ids") or []
+            self.layer_digests = diff_ids if len(diff_ids) == len(layers) else [None] * len(layers)
 
             history = config_data.get("history", [])
             layer_index = 0
@@ -32,11 +145,201 @@ class ContainerImageInspector:
             for history_entry in history:
                 is_empty = history_entry.get("empty_layer", False)
                 if not is_empty:
-                    if layer_index < len(self.layers):
-                        layer_name = self.layers[layer_index]
+                    if layer_index < len(layers):
+                        layer_name = layers[layer_index]
                         created_by = history_entry.get("created_by", "Unknown command")
                         self.layer_commands.append((layer_name, created_by))
                         layer_index += 1
+        return layers
+
+    def _publish_layers(self, layers, tables):
+        with self._state:
+            self._layer_tables = tables
+            self.layers = layers
+            self._state.notify_all()
+
+    def _publish_table(self, layer_idx, table):
+        digest = self._shared_digest(layer_idx)
+        if digest is not None:
+            table = self.layer_store.add(digest, table)
+        with self._state:
+            self._layer_tables[layer_idx] = table
+            self._state.notify_all()
+
+    def _open_layer(self, layer_blob):
+        """Open a random-access source over a layer blob."""
+        if layer_blob is None:
+            self._layer_sources.append(None)
+            return
+        offset, size, compression = layer_blob
+        self._layer_sources.append(open_blob(self._image_source, offset, size, compression))
+
+    def _shared_digest(self, layer_idx):
+        """Return the digest a layer is shared under in the layer store, or None if it is not shared."""
+        if self.layer_store is None or self._layer_blobs[layer_idx] is None:
+            return None
+        return self.layer_digests[layer_idx]
+
+    def _index_layers(self, layer_indexes, cancel=None):
+        """Index the given layers, publishing each table as it is done."""
+        layer_indexes = list(layer_indexes)
+        if self.jobs > 1 and len(layer_indexes) > 1 and self._image_source is self._reader:
+            self._index_layers_in_parallel(layer_indexes, cancel)
+            return
+        for layer_idx in layer_indexes:
+            source = self._layer_sources[layer_idx]
+            if self.layer_store is None:
+                table = read_table(source, self._path_table, cancel)
+            else:
+                table = read_table(source, PathTable(), cancel)
+                self.layer_store.intern(table)
+            self._publish_table(layer_idx, table)
+
+    def _index_shared_layers(self, cancel=None):
+        """Index the layers of a session image that no other image has indexed, reusing the rest."""
+        store = self.layer_store
+        claimed = []  # Layers this image has to index
+        elsewhere = []  # Layers another image is indexing right now
+        try:
+            for layer_idx in range(len(self.layers)):
+                digest = self._shared_digest(layer_idx)
+                if digest is None:
+                    claimed.append(layer_idx)
+                    continue
+                table, is_claimed = store.claim(digest, wait=False)
+                if table is not None:
+                    self._publish_table(layer_idx, table)
+                elif is_claimed:
+                    claimed.append(layer_idx)
+                else:
+                    elsewhere.append(layer_idx)
+            self._index_layers(claimed, cancel)
+            # Claims are only waited on while holding none, so two images never wait on each other.
+            for layer_idx in elsewhere:
+                table, is_claimed = store.claim(self._shared_digest(layer_idx), cancel=cancel)
+                if is_claimed:
+                    claimed.append(layer_idx)
+                    self._index_layers([layer_idx], cancel)
+                else:
+                    self._publish_table(layer_idx, table)
+        finally:
+            for layer_idx in claimed:
+                digest = self._shared_digest(layer_idx)
+                if digest is not None and not self.layer_ready(layer_idx):
+                    store.release(digest)
+
+    def _index_layers_in_parallel(self, layer_indexes, cancel=None):
+        """Index each layer blob in its own worker process, publishing tables as they finish."""
+        # Blob offsets are only meaningful to other processes when the image is not compressed.
+        with ProcessPoolExecutor(max_workers=min(self.jobs, len(layer_indexes)), mp_context=POOL_CONTEXT) as pool:
+            pending = {}
+            for layer_idx in layer_indexes:
+                layer_blob = self._layer_blobs[layer_idx]
+                if layer_blob is None:
+                    self._publish_table(layer_idx, FileTable(self._path_table))
+                else:
+                    pending[pool.submit(index_layer_blob, self.local_image_path, *layer_blob)] = layer_idx
+            while pending:
+                done, _ = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+                if cancel is not None and cancel.is_set():
+                    pool.shutdown(wait=False, cancel_futures=True)
+                    raise OperationCancelled("Indexing cancelled")
+                for future in done:
+                    table = future.result()
+                    if self.layer_store is None:
+                        table.rebase(self._path_table)
+                    else:
+                        self.layer_store.intern(table)
+                    self._publish_table(pending.pop(future), table)
+
+    def _index_snapshot(self):
+        """Return the loaded index in the form kept by the index cache."""
+        path_table = self._path_table
+        tables = self._layer_tables
+        if self.layer_store is not None:
+            # The shared path table holds the paths of every image in the session; keep only this one's.
+            path_table = PathTable()
+            tables = [copy.copy(table) for table in tables]
+            for table in tables:
+                table.rebase(path_table)
+        return {
+            'layers': self.layers,
+            'layer_commands': self.layer_commands,
+            'layer_digests': self.layer_digests,
+            'layer_blobs': self._layer_blobs,
+            'path_table': path_table.to_dict(),
+            'layer_tables': [table.to_dict() for table in tables],
+        }
+
+    def _restore_index(self, index):
+        """Load an index previously produced by _index_snapshot."""
+        self.layer_commands = [tuple(entry) for entry in index['layer_commands']]
+        self.layer_digests = index['layer_digests']
+        self._layer_blobs = [tuple(blob) if blob is not None else None for blob in index['layer_blobs']]
+        for layer_blob in self._layer_blobs:
+            self._open_layer(layer_blob)
+        path_table = PathTable.from_dict(index['path_table'])
+        tables = [FileTable.from_dict(table, path_table) for table in index['layer_tables']]
+        if self.layer_store is None:
+            self._path_table = path_table
+        else:
+            for layer_idx, table in enumerate(tables):
+                digest = self._shared_digest(layer_idx)
+                shared = self.layer_store.get(digest) if digest is not None else None
+                if shared is None:
+                    self.layer_store.intern(table)
+                    shared = self.layer_store.add(digest, table) if digest is not None else table
+                tables[layer_idx] = shared
+        self._publish_layers(index['layers'], tables)
+
+    def cancel_loading(self, wait=False):
+        """Stop a background load; layers indexed so far stay available.
+
+        With wait, block until the load thread has stopped. A load that has
+        indexed every layer still writes the index cache first.
+        """
+        self._cancel_loading.set()
+        if wait:
+            with self._state:
+                while self.loading:
+                    self._state.wait(0.1)
+
+    def wait_for_layer_list(self):
+        """Return the layer names, waiting while a background load reads the manifest."""
+        with self._state:
+            while self.loading and not self.layers:
+                self._state.wait(0.1)
+        if not self.layers and self.load_error is not None:
+            raise self.load_error
+        return self.layers
+
+    def layer_ready(self, layer_idx):
+        """Return True once a layer's files can be listed and searched without waiting."""
+        tables = self._layer_tables
+        return layer_idx < len(tables) and tables[layer_idx] is not None
+
+    def indexed_layer_count(self):
+        return sum(table is not None for table in self._layer_tables)
+
+    def _wait_for_layer(self, layer_idx, cancel=None):
+        """Return a layer's file table, waiting while a background load indexes it."""
+        with self._state:
+            while True:
+                if cancel is not None and cancel.is_set():
+                    raise OperationCancelled("Search cancelled")
+                if self.layer_ready(layer_idx):
+                    return self._layer_tables[layer_idx]
+                if not self.loading:
+                    if self.load_error is not None and not isinstance(self.load_error, OperationCancelled):
+                        raise self.load_error
+                    raise OperationCancelled(f"Layer {layer_idx} was not indexed")
+                self._state.wait(0.1)
+
+    def close(self):
+        """Release the open image file."""
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
 
     def get_layer_command(self, layer_name):
         """Return the command associated with a layer, skipping empty layers."""
@@ -45,83 +348,544 @@ class ContainerImageInspector:
                 return command
         return "Unknown command"
 
+    def _layer_tree(self, layer_idx):
+        tree = self._layer_trees.get(layer_idx)
+        if tree is None:
+            tree = self._layer_trees[layer_idx] = DirectoryTree(self._wait_for_layer(layer_idx))
+        return tree
+
     def list_files_in_layer(self, layer_idx, current_path=''):
         """List all files in a specific layer, optionally in a directory."""
-        layer_name = self.layers[layer_idx]
-        mode = 'r:gz' if self.local_image_path.endswith(('.tar.gz', '.tgz')) else 'r'
-        with tarfile.open(self.local_image_path, mode) as tar:
-            layer_files = [m for m in tar.getmembers() if m.name.startswith(layer_name) and 'layer.tar' in m.name]
-            if layer_files:
-                layer_tar = tar.extractfile(layer_files[0])
-                if layer_tar is None:
-                    return []
-                with tarfile.open(fileobj=layer_tar) as layer_tarfile:
-                    files = layer_tarfile.getmembers()
-                    filtered_files = [
-                        f for f in files if f.name.startswith(current_path)
-                        and f.name != current_path
-                        and '/' not in f.name[len(current_path):].strip('/')
-                    ]
-                    return sorted(filtered_files, key=lambda x: (not x.isdir(), x.name.lower()))
-        return []
-
-    def search_files_in_layer(self, layer_idx, query, current_path=''):
-        """Search for files or folders by name in the current layer, showing full paths."""
-        layer_name = self.layers[layer_idx]
-        mode = 'r:gz' if self.local_image_path.endswith(('.tar.gz', '.tgz')) else 'r'
-        with tarfile.open(self.local_image_path, mode) as tar:
-            layer_files = [m for m in tar.getmembers() if m.name.startswith(layer_name) and 'layer.tar' in m.name]
-            if layer_files:
-                layer_tar = tar.extractfile(layer_files[0])
-                if layer_tar is None:
-                    return []
-                with tarfile.open(fileobj=layer_tar) as layer_tarfile:
-                    files = layer_tarfile.getmembers()
-                    filtered_files = [
-                        f for f in files if f.name.startswith(current_path)
-                        and query.lower() in f.name.lower()
-                    ]
-                    return filtered_files
-        return []
+        return list(self._layer_tree(layer_idx).children(current_path))
+
+    def merged_view(self, layer_idx=None):
+        """Return the merged filesystem of layers 0 to layer_idx (default: every layer).
+
+        The view is kept between calls and moved one layer delta at a time, so
+        stepping through the layers never rebuilds it from scratch. It is shared,
+        so callers on other threads should use list_merged_files instead.
+        """
+        with self._merged_lock:
+            if self._merged_view is None:
+                self._merged_view = MergedView(self._path_table, self._wait_for_layer)
+            self._merged_view.seek(len(self.layers) - 1 if layer_idx is None else layer_idx)
+            return self._merged_view
+
+    def list_merged_files(self, current_path='', layer_idx=None, include_deleted=False):
+        """List a directory of the merged filesystem; see merged_view.MergedEntry for provenance."""
+        with self._merged_lock:
+            return self.merged_view(layer_idx).children(current_path, include_deleted)
+
+    def merged_entry(self, path, layer_idx=None):
+        """Return the MergedEntry at a path of the merged filesystem, or None; safe to call from any thread."""
+        with self._merged_lock:
+            return self.merged_view(layer_idx).get(path)
+
+    def layer_summary(self, layer_idx):
+        """Return a LayerStats with a layer's size and file count; wasted bytes need image_stats."""
+        table = self._wait_for_layer(layer_idx)
+        stats = LayerStats()
+        for row in range(table.member_count):
+            if table.isdir(row):
+                continue
+            stats.file_count += 1
+            if table.isreg(row):
+                stats.size += table.sizes[row]
+        return stats
+
+    def image_stats(self, progress=None, cancel=None):
+        """Return the size, file count and wasted bytes of each layer, and the image efficiency.
+
+        Files overwritten or deleted by later layers are found from the merged
+        view without reading any data. Duplicate content is found by hashing
+        only visible files whose size matches another's, in one pass in image
+        order. progress(byte_count) reports hashed data, and setting the cancel
+        event raises OperationCancelled. The result is kept for later calls.
+        """
+        if self._image_stats is not None:
+            return self._image_stats
+        tables = [self._wait_for_layer(layer_idx) for layer_idx in range(len(self.layers))]
+        with self._merged_lock:
+            visible = self.merged_view().visible_rows()
+
+        layer_stats = []
+        same_size = {}  # size -> visible (layer_idx, row) files of that size
+        for layer_idx, table in enumerate(tables):
+            stats = LayerStats()
+            flags = visible[layer_idx]
+            sizes = table.sizes
+            for row in range(table.member_count):
+                if table.isdir(row):
+                    continue
+                stats.file_count += 1
+                if not table.isreg(row):
+                    continue
+                size = sizes[row]
+                stats.size += size
+                if not flags[row]:
+                    stats.shadowed_bytes += size
+                elif size and row not in table.sparse:
+                    same_size.setdefault(size, []).append((layer_idx, row))
+            layer_stats.append(stats)
+
+        candidates = [member for group in same_size.values() if len(group) > 1 for member in group]
+        digests = self._hash_members(candidates, progress, cancel)
+        seen = set()
+        for layer_idx, row in sorted(candidates):
+            key = (tables[layer_idx].sizes[row], digests[(layer_idx, row)])
+            if key in seen:
+                layer_stats[layer_idx].duplicate_bytes += key[0]
+            else:
+                seen.add(key)
+        self._image_stats = ImageStats(layer_stats)
+        return self._image_stats
+
+    def diff(self, other, layer_idx=None, other_layer_idx=None, progress=None, cancel=None):
+        """Return an ImageDiff from this image's merged filesystem to another's.
+
+        layer_idx and other_layer_idx pick the top layer of each side (default:
+        every layer); other may be this inspector. The bottom layers both sides
+        share by digest are skipped: only paths written, deleted or made opaque
+        above them are compared. Files of equal size, mode and mtime count as
+        unchanged; when only the mtime differs, both are hashed, and the hashes
+        are kept in the index cache for later diffs against the same layers.
+        progress(byte_count) reports hashed data, and setting the cancel event
+        raises OperationCancelled.
+        """
+        top = len(self.layers) - 1 if layer_idx is None else layer_idx
+        other_top = len(other.layers) - 1 if other_layer_idx is None else other_layer_idx
+        shared = shared_layer_count(self.layer_digests[:top + 1], other.layer_digests[:other_top + 1])
+        tables = [self._wait_for_layer(idx, cancel) for idx in range(shared, top + 1)]
+        tables += [other._wait_for_layer(idx, cancel) for idx in range(shared, other_top + 1)]
+        paths, cleared = changed_paths(tables)
+
+        # Both views stay locked while their entries are read, taking the locks in a fixed order.
+        first, second = sorted((self, other), key=id)
+        with first._merged_lock, second._merged_lock:
+            old_view = self.merged_view(top)
+            if other is self:
+                new_view = MergedView(self._path_table, self._wait_for_layer)
+                new_view.seek(other_top)
+            else:
+                new_view = other.merged_view(other_top)
+            pairs = list(merged_pairs(old_view, new_view, paths, cleared, cancel))
+        member = lambda entry: (entry.layer, entry.row)
+        return self._diff_pairs(other, pairs, member, member, shared, progress, cancel)
+
+    def diff_layers(self, layer_idx, other_layer_idx, other=None, progress=None, cancel=None):
+        """Return an ImageDiff from the files of one layer to those of another.
+
+        other is the inspector holding other_layer_idx (default: this one).
+        Layers with the same digest are reported equal without being read.
+        """
+        other = self if other is None else other
+        digest = self.layer_digests[layer_idx]
+        if digest is not None and digest == other.layer_digests[other_layer_idx]:
+            return ImageDiff([], 1)
+        pairs = layer_pairs(self._wait_for_layer(layer_idx, cancel), other._wait_for_layer(other_layer_idx, cancel))
+        return self._diff_pairs(other, pairs, lambda entry: (layer_idx, entry.row),
+                                lambda entry: (other_layer_idx, entry.row), 0, progress, cancel)
+
+    def _diff_pairs(self, other, pairs, old_member, new_member, shared_layers, progress=None, cancel=None):
+        """Classify (path, old, new) pairs into an ImageDiff, hashing only files metadata cannot tell apart.
+
+        old_member and new_member return the (layer_idx, row) of an entry on each side.
+        """
+        entries = []
+        ties = []  # (path, old, new, old member, new member) to settle by content
+        for path, old, new in pairs:
+            if cancel is not None and cancel.is_set():
+                raise OperationCancelled("Diff cancelled")
+            if old is None:
+                entries.append(DiffEntry(path, 'added', new=new))
+            elif new is None:
+                entries.append(DiffEntry(path, 'removed', old=old))
+            else:
+                result = compare_entries(old, new)
+                if result == CHANGED:
+                    entries.append(DiffEntry(path, 'modified', old, new))
+                elif result == CHECK_CONTENT:
+                    ties.append((path, old, new, old_member(old), new_member(new)))
+        if ties:
+            old_digests = self._hash_members([tie[3] for tie in ties], progress, cancel)
+            new_digests = other._hash_members([tie[4] for tie in ties], progress, cancel)
+            for path, old, new, old_member, new_member in ties:
+                if old_digests[old_member] != new_digests[new_member]:
+                    entries.append(DiffEntry(path, 'modified', old, new))
+        return ImageDiff(entries, shared_layers)
+
+    def _hash_members(self, members, progress=None, cancel=None):
+        """Return {(layer_idx, row): digest} for regular files.
+
+        Digests computed before, in this session or by any image sharing the
+        layer through the index cache, are reused; the rest are read in image
+        order and remembered.
+        """
+        digests = {member: self._digests[member] for member in members if member in self._digests}
+        missing = [member for member in members if member not in digests]
+        if missing and self.index_cache is not None:
+            for layer_idx, group in groupby(sorted(missing), key=lambda member: member[0]):
+                layer_digest = self.layer_digests[layer_idx]
+                if layer_digest is None:
+                    continue
+                offsets = self._layer_tables[layer_idx].offsets
+                rows = [row for _, row in group]
+                cached = self.index_cache.get_digests(layer_digest, [offsets[row] for row in rows])
+                digests.update(((layer_idx, row), cached[offsets[row]]) for row in rows if offsets[row] in cached)
+            missing = [member for member in missing if member not in digests]
+
+        computed = self._read_digests(missing, progress, cancel) if missing else {}
+        if computed and self.index_cache is not None:
+            for layer_idx, group in groupby(sorted(computed), key=lambda member: member[0]):
+                layer_digest = self.layer_digests[layer_idx]
+                if layer_digest is not None:
+                    offsets = self._layer_tables[layer_idx].offsets
+                    self.index_cache.put_digests(layer_digest, {offsets[row]: computed[(layer_idx, row)]
+                                                                for _, row in group})
+        digests.update(computed)
+        self._digests.update(digests)
+        return digests
+
+    def _read_digests(self, members, progress=None, cancel=None):
+        """Hash regular files, read in image order; see _hash_members."""
+        tables = self._layer_tables
+
+        def image_order(member):
+            layer_idx, row = member
+            return self._layer_blobs[layer_idx][0], tables[layer_idx].offsets[row]
+
+        def hashed(byte_count):
+            if cancel is not None and cancel.is_set():
+                raise OperationCancelled("Analysis cancelled")
+            if progress is not None:
+                progress(byte_count)
+
+        members = sorted(members, key=image_order)
+        if self.jobs <= 1 or self._image_source is not self._reader:
+            return {
+                (layer_idx, row): hash_range(self._layer_sources[layer_idx], tables[layer_idx].offsets[row],
+                                             tables[layer_idx].sizes[row], hashed)
+                for layer_idx, row in members
+            }
+
+        digests = {}
+        with ProcessPoolExecutor(max_workers=self.jobs, mp_context=POOL_CONTEXT) as pool:
+            pending = {}
+            for layer_idx, batch, batch_bytes in self._member_batches(members):
+                table = tables[layer_idx]
+                ranges = [(table.offsets[row], table.sizes[row]) for _, row in batch]
+                future = pool.submit(hash_blob_ranges, self.local_image_path, self._layer_blobs[layer_idx], ranges)
+                pending[future] = (batch, batch_bytes)
+            while pending:
+                done, _ = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+                if cancel is not None and cancel.is_set():
+                    pool.shutdown(wait=False, cancel_futures=True)
+                    raise OperationCancelled("Analysis cancelled")
+                for future in done:
+                    batch, batch_bytes = pending.pop(future)
+                    digests.update(zip(batch, future.result()))
+                    hashed(batch_bytes)
+        return digests
+
+    def _member_batches(self, members):
+        """Split (layer_idx, row) members, already in image order, into worker tasks.
+
+        Yields (layer_idx, members, byte_count). Stored layers are split into
+        batches; a compressed one stays whole, as a worker has to inflate it
+        from the start to reach any member.
+        """
+        for layer_idx, group in groupby(members, key=lambda member: member[0]):
+            sizes = self._layer_tables[layer_idx].sizes
+            compressed = self._layer_blobs[layer_idx][2] is not None
+            batch, batch_bytes = [], 0
+            for member in group:
+                batch.append(member)
+                batch_bytes += sizes[member[1]]
+                if not compressed and batch_bytes >= HASH_BATCH_BYTES:
+                    yield layer_idx, batch, batch_bytes
+                    batch, batch_bytes = [], 0
+            if batch:
+                yield layer_idx, batch, batch_bytes
+
+    def _path_query(self, query, mode):
+        with self._search_lock:
+            if self._search_index is None:
+                if self.layer_store is None:
+                    self._search_index = SearchIndex(self._path_table)
+                else:
+                    self._search_index = self.layer_store.search_index
+        return self._search_index.query(query, mode)
+
+    def _search_layer(self, path_query, layer_idx, cancel=None):
+        """Return the entries of one layer matching a compiled query, indexing the layer on first use."""
+        table = self._wait_for_layer(layer_idx, cancel)
+        key = layer_idx
+        if self.layer_store is not None:
+            # In a session's shared index, a layer several images hold is indexed once, under its digest.
+            key = self._shared_digest(layer_idx) or (id(self), layer_idx)
+        with self._search_lock:
+            if not self._search_index.has_layer(key):
+                self._search_index.add_layer(key, table)
+        return table.entries(path_query.rows(key))
+
+    def search_files_in_layer(self, layer_idx, query, current_path='', mode='substring'):
+        """Search for files or folders by name in the current layer, showing full paths.
+
+        mode is 'substring' (case-insensitive), 'glob' or 'regex'; see search_index.parse_query.
+        """
+        matches = self._search_layer(self._path_query(query, mode), layer_idx)
+        return [f for f in matches if f.name.startswith(current_path)] if current_path else matches
 
     def extract_file_from_layer(self, layer_idx, file_name, output_dir='.'):
         """Extract a specific file or folder from the layer.tar in a given layer."""
+        return self.extract_files([(layer_idx, file_name)], output_dir)[0]
+
+    def extract_files(self, selections, output_dir='.', progress=None, cancel=None):
+        """Extract files and folders, possibly from several layers, in one ordered pass.
+
+        selections is a list of (layer_idx, path) pairs. A file is written to
+        output_dir under its base name and a folder with its full path; a file
+        whose base name an earlier selected file took is not extracted. Layers
+        are visited in image order and their members in tar order, so every
+        blob is read front to back once. progress(byte_count) is called as
+        data is copied, and setting the cancel event raises OperationCancelled.
+        Returns a status message for each selection, in the order given.
+        """
+        messages = [None] * len(selections)
+        by_layer = {}
+        written = {}  # Base name -> (layer_idx, path) of the selected file written under it
+        for selection_idx, (layer_idx, file_name) in enumerate(selections):
+            member = self._layer_tree(layer_idx).get(file_name)
+            if member is not None and not member.isdir():
+                base_name = os.path.basename(file_name)
+                first = written.setdefault(base_name, (layer_idx, file_name))
+                if first != (layer_idx, file_name):
+                    messages[selection_idx] = (f"Not extracted: {file_name} would overwrite {first[1]} of layer "
+                                               f"{first[0]} at {os.path.join(output_dir, base_name)}")
+                    continue
+            by_layer.setdefault(layer_idx, []).append((selection_idx, file_name))
+
+        def copied(byte_count):
+            if cancel is not None and cancel.is_set():
+                raise OperationCancelled("Extraction cancelled")
+            if progress is not None:
+                progress(byte_count)
+
+        def blob_offset(layer_idx):
+            layer_blob = self._layer_blobs[layer_idx]
+            return layer_blob[0] if layer_blob is not None else -1
+
+        for layer_idx in sorted(by_layer, key=blob_offset):
+            self._extract_from_layer(layer_idx, by_layer[layer_idx], output_dir, messages, copied)
+        return messages
+
+    def read_file(self, layer_idx, file_name, cancel=None):
+        """Return (entry, chunks) for a regular file of a layer, following links within the layer.
+
+        chunks yields the file contents in pieces of at most COPY_CHUNK as it
+        is consumed, so a large file can be streamed without holding it in
+        memory. Setting the cancel event raises OperationCancelled. A missing
+        path raises FileNotFoundError, a directory IsADirectoryError, and
+        anything else that is not a file ValueError.
+        """
+        tree = self._layer_tree(layer_idx)
+        member = tree.get(file_name)
+        if member is None:
+            raise FileNotFoundError(f"File {file_name} not found in layer {self.layers[layer_idx]}")
+        if member.isdir():
+            raise IsADirectoryError(f"{file_name} is a directory")
+        target = self._link_target(tree, member)
+        if target is None:
+            raise ValueError(f"{file_name} is not a regular file")
+        layer_source = self._layer_sources[layer_idx]
+        if layer_source is None:
+            raise OSError(f"Could not read layer.tar from layer {self.layers[layer_idx]}")
+        return target, self._file_chunks(layer_source, target, cancel)
+
+    @staticmethod
+    def _file_chunks(layer_source, member, cancel=None):
+        if member.issparse():
+            # tarfile knows how to lay out the data blocks of a sparse member.
+            with open_layer_tar(layer_source) as layer_tarfile:
+                data = layer_tarfile.extractfile(member.to_tarinfo())
+                while chunk := data.read(COPY_CHUNK):
+                    if cancel is not None and cancel.is_set():
+                        raise OperationCancelled("Read cancelled")
+                    yield chunk
+            return
+        offset, remaining = member.offset_data, member.size
+        while remaining > 0:
+            if cancel is not None and cancel.is_set():
+                raise OperationCancelled("Read cancelled")
+            chunk = layer_source.pread(offset, min(remaining, COPY_CHUNK))
+            if not chunk:
+                raise EOFError("Layer ended before the end of the file")
+            yield chunk
+            offset += len(chunk)
+            remaining -= len(chunk)
+
+    def _extract_from_layer(self, layer_idx, selections, output_dir, messages, progress):
         layer_name = self.layers[layer_idx]
-        mode = 'r:gz' if self.local_image_path.endswith(('.tar.gz', '.tgz')) else 'r'
-        with tarfile.open(self.local_image_path, mode) as tar:
-            layer_files = [m for m in tar.getmembers() if m.name.startswith(layer_name) and 'layer.tar' in m.name]
-            if layer_files:
-                layer_tar = tar.extractfile(layer_files[0])
-                if layer_tar is None:
-                    return f"Could not extract layer.tar from layer {layer_name}"
-                with tarfile.open(fileobj=layer_tar) as layer_tarfile:
-                    try:
-                        member = layer_tarfile.getmember(file_name)
-                        if member.isdir():
-                            layer_tarfile.extractall(path=output_dir, members=[m for m in layer_tarfile.getmembers() if m.name.startswith(file_name)])
-                            return f"Extracted directory {file_name} to {output_dir}"
-                        else:
-                            output_path = os.path.join(output_dir, os.path.basename(file_name))
-                            with open(output_path, 'wb') as f:
-                                f.write(layer_tarfile.extractfile(member).read())
-                            return f"Extracted {file_name} to {output_path}"
-                    except KeyError:
-                        return f"File or directory {file_name} not found in layer {layer_name}"
-
-    def search_files_across_layers(self, query):
-        """Search for files across all layers."""
+        tree = self._layer_tree(layer_idx)
+        layer_source = self._layer_sources[layer_idx]
+        members = []
+        for selection_idx, file_name in selections:
+            member = tree.get(file_name)
+            if member is None:
+                messages[selection_idx] = f"File or directory {file_name} not found in layer {layer_name}"
+            elif layer_source is None:
+                messages[selection_idx] = f"Could not extract layer.tar from layer {layer_name}"
+            elif member.isdir():
+                members.extend(self._directory_members(tree, file_name))
+                messages[selection_idx] = f"Extracted directory {file_name} to {output_dir}"
+            else:
+                # A selected link is written out as the contents of the file it points to.
+                tarinfo = (self._link_target(tree, member) or member).to_tarinfo()
+                tarinfo.name = os.path.basename(file_name)
+                members.append(tarinfo)
+                messages[selection_idx] = f"Extracted {file_name} to {os.path.join(output_dir, tarinfo.name)}"
+        if not members:
+            return
+        members.sort(key=lambda tarinfo: tarinfo.offset_data)
+        with open_layer_tar(layer_source, progress) as layer_tarfile:
+            layer_tarfile.extractall(path=output_dir, members=members)
+
+    @classmethod
+    def _directory_members(cls, tree, dir_name):
+        """Return TarInfos for a folder, with hard links to files outside it extracted as copies.
+
+        tarfile can only link to a member extracted alongside the link, since a
+        lazily opened layer has no member list to look the target up in.
+        """
+        entries = list(tree.walk(dir_name))
+        names = {entry.name for entry in entries}
+        members = []
+        for entry in entries:
+            target = None
+            if entry.islnk() and posixpath.normpath(entry.linkname).lstrip('/') not in names:
+                target = cls._link_target(tree, entry)
+            if target is None:
+                members.append(entry.to_tarinfo())
+                continue
+            tarinfo = target.to_tarinfo()
+            tarinfo.name = entry.name
+            members.append(tarinfo)
+        return members
+
+    @staticmethod
+    def _link_target(tree, member):
+        """Return the regular file a link member resolves to in its layer, or None."""
+        for _ in range(MAX_LINK_DEPTH):
+            if member.issym():
+                target = posixpath.join(posixpath.dirname(member.name), member.linkname)
+            elif member.islnk():
+                target = member.linkname
+            else:
+                return member if member.isreg() else None
+            member = tree.get(posixpath.normpath(target).lstrip('/'))
+            if member is None:
+                return None
+        return None
+
+    def search_files_across_layers(self, query, mode='substring', on_layer=None, cancel=None, layers=None):
+        """Search for files across all layers, or the layer indexes listed in layers.
+
+        Layers are searched in order, waiting for any that a background load has
+        not indexed yet. on_layer(layer_idx, matches) is called as each layer with
+        matches is done, and setting the cancel event raises OperationCancelled.
+        """
+        path_query = self._path_query(query, mode)
         results = {}
-        mode = 'r:gz' if self.local_image_path.endswith(('.tar.gz', '.tgz')) else 'r'
-        with tarfile.open(self.local_image_path, mode) as tar:
-            for layer_idx, layer_name in enumerate(self.layers):
-                layer_files = [m for m in tar.getmembers() if m.name.startswith(layer_name) and 'layer.tar' in m.name]
-                if layer_files:
-                    layer_tar = tar.extractfile(layer_files[0])
-                    if layer_tar is None:
-                        continue
-                    with tarfile.open(fileobj=layer_tar) as layer_tarfile:
-                        files = layer_tarfile.getmembers()
-                        matches = [f for f in files if query.lower() in f.name.lower()]
-                        if matches:
-                            results[layer_idx] = matches
-        return results
\ No newline at end of file
+        for layer_idx in range(len(self.layers)) if layers is None else layers:
+            matches = self._search_layer(path_query, layer_idx, cancel)
+            if matches:
+                results[layer_idx] = matches
+                if on_layer is not None:
+                    on_layer(layer_idx, matches)
+        return results
+
+    def grep_layers(self, pattern, regex=False, ignore_case=False, max_file_size=DEFAULT_MAX_FILE_SIZE,
+                    on_layer=None, progress=None, cancel=None, layers=None):
+        """Search the contents of every layer's regular files, or those of layers, for a literal or regex pattern.
+
+        Each layer blob is read front to back once, only over the files worth
+        searching: binary files (a NUL byte near the start) and files larger
+        than max_file_size are skipped. Layers of an uncompressed image are
+        spread over the worker processes. on_layer(layer_idx, matches) is
+        called in layer order as each layer with matches is done,
+        progress(byte_count) reports data read, and setting the cancel event
+        raises OperationCancelled. Returns {layer_idx: [ContentMatch]}; an
+        invalid regex raises re.error.
+        """
+        matcher = compile_pattern(pattern, regex, ignore_case)
+        results = {}
+
+        def scanned(byte_count):
+            if cancel is not None and cancel.is_set():
+                raise OperationCancelled("Search cancelled")
+            if progress is not None:
+                progress(byte_count)
+
+        def finish(layer_idx, matches):
+            if matches:
+                results[layer_idx] = matches
+                if on_layer is not None:
+                    on_layer(layer_idx, matches)
+
+        def searched_rows(table):
+            sizes = table.sizes
+            return [row for row in range(table.member_count)
+                    if table.isreg(row) and 0 < sizes[row] <= max_file_size and row not in table.sparse]
+
+        layer_indexes = list(range(len(self.layers)) if layers is None else layers)
+        if self.jobs <= 1 or self._image_source is not self._reader:
+            for layer_idx in layer_indexes:
+                table = self._wait_for_layer(layer_idx, cancel)
+                layer_source = self._layer_sources[layer_idx]
+                matches = []
+                for row in searched_rows(table):
+                    for line_number, line in grep_range(layer_source, table.offsets[row], table.sizes[row],
+                                                        matcher, scanned) or ():
+                        matches.append(ContentMatch(table, row, line_number, line))
+                finish(layer_idx, matches)
+            return results
+
+        found = {layer_idx: [] for layer_idx in layer_indexes}
+        remaining = dict.fromkeys(layer_indexes, 0)  # Unfinished worker tasks of each layer
+        with ProcessPoolExecutor(max_workers=self.jobs, mp_context=POOL_CONTEXT) as pool:
+            try:
+                pending = {}
+                for layer_idx in layer_indexes:
+                    table = self._wait_for_layer(layer_idx, cancel)
+                    members = [(layer_idx, row) for row in searched_rows(table)]
+                    for _, batch, batch_bytes in self._member_batches(members):
+                        ranges = [(table.offsets[row], table.sizes[row]) for _, row in batch]
+                        future = pool.submit(grep_blob_ranges, self.local_image_path, self._layer_blobs[layer_idx],
+                                             ranges, matcher)
+                        pending[future] = (layer_idx, batch, batch_bytes)
+                        remaining[layer_idx] += 1
+
+                next_layer = 0  # Position in layer_indexes of the next layer to report
+                while True:
+                    while next_layer < len(layer_indexes) and not remaining[layer_indexes[next_layer]]:
+                        matches = found[layer_indexes[next_layer]]
+                        # Batches of a layer may finish out of order; report its matches in tar order.
+                        matches.sort(key=lambda match: (match.offset_data, match.line_number))
+                        finish(layer_indexes[next_layer], matches)
+                        next_layer += 1
+                    if not pending:
+                        break
+                    done, _ = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+                    if cancel is not None and cancel.is_set():
+                        raise OperationCancelled("Search cancelled")
+                    for future in done:
+                        layer_idx, batch, batch_bytes = pending.pop(future)
+                        table = self._layer_tables[layer_idx]
+                        for range_idx, line_number, line in future.result():
+                            found[layer_idx].append(ContentMatch(table, batch[range_idx][1], line_number, line))
+                        remaining[layer_idx] -= 1
+                        scanned(batch_bytes)
+            except BaseException:
+                pool.shutdown(wait=False, cancel_futures=True)
+                raise
+        return results
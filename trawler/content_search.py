@@ -0,0 +1,114 @@
+import re
+from trawler.file_table import FileEntry
+from trawler.image_reader import COPY_CHUNK, ImageReader, open_blob
+
+DEFAULT_MAX_FILE_SIZE = 16 * 1024 * 1024  # Larger files are skipped
+BINARY_SNIFF_BYTES = 8192  # A NUL byte this early marks a file as binary, as git and grep do
+MAX_LINE_BYTES = 1024 * 1024  # A line longer than this is searched in pieces
+MAX_MATCHES_PER_FILE = 100
+MAX_LINE_CHARS = 200  # Matching lines are cut to this length for display
+
+
+def parse_content_query(text):
+    """Split a content search prompt into (pattern, regex): 're:' starts a regular expression."""
+    if text.startswith('re:'):
+        return text[3:], True
+    return text, False
+
+
+def compile_pattern(pattern, regex=False, ignore_case=False):
+    """Compile a content search pattern to a bytes regex; raises re.error when invalid."""
+    flags = re.MULTILINE | (re.IGNORECASE if ignore_case else 0)
+    source = pattern.encode('utf-8', 'surrogateescape')
+    return re.compile(source if regex else re.escape(source), flags)
+
+
+class ContentMatch(FileEntry):
+    """A line of a layer file that matched a content search."""
+
+    __slots__ = ('line_number', 'line')
+
+    def __init__(self, table, row, line_number, line):
+        super().__init__(table, row)
+        self.line_number = line_number
+        self.line = line
+
+    def __repr__(self):
+        return f"<ContentMatch {self.name!r}:{self.line_number}>"
+
+
+def _display_line(line):
+    """Decode a matching line for display, with tabs and control characters as spaces."""
+    text = line[:MAX_LINE_CHARS * 4].decode('utf-8', 'replace').rstrip('\r')[:MAX_LINE_CHARS]
+    return ''.join(char if char.isprintable() else ' ' for char in text)
+
+
+def _scan_block(block, pattern, first_line, matches):
+    """Record the matching lines of a block that ends on a line boundary; return the next line number."""
+    line_number = first_line
+    position = 0
+    reported = None
+    for match in pattern.finditer(block):
+        start = match.start()
+        line_number += block.count(b'\n', position, start)
+        position = start
+        if line_number == reported:
+            continue
+        line_start = block.rfind(b'\n', 0, start) + 1
+        line_end = block.find(b'\n', start)
+        line = block[line_start:line_end if line_end != -1 else len(block)]
+        matches.append((line_number, _display_line(line)))
+        reported = line_number
+        if len(matches) >= MAX_MATCHES_PER_FILE:
+            break
+    return first_line + block.count(b'\n')
+
+
+def grep_range(source, offset, size, pattern, progress=None):
+    """Return the (line_number, line) matches of a member's contents, or None if it looks binary.
+
+    The member is read in chunks of COPY_CHUNK; only the unfinished last line
+    of a chunk is carried into the next, so memory stays bounded.
+    """
+    matches = []
+    line_number = 1
+    carry = b''
+    position = 0
+    while position < size and len(matches) < MAX_MATCHES_PER_FILE:
+        chunk = source.pread(offset + position, min(size - position, COPY_CHUNK))
+        if not chunk:
+            break
+        if position == 0 and b'\0' in chunk[:BINARY_SNIFF_BYTES]:
+            return None
+        position += len(chunk)
+        if progress is not None:
+            progress(len(chunk))
+        data = carry + chunk
+        end = data.rfind(b'\n') + 1
+        if not end and len(data) < MAX_LINE_BYTES:
+            carry = data
+            continue
+        if not end:
+            end = len(data)
+        line_number = _scan_block(data[:end], pattern, line_number, matches)
+        carry = data[end:]
+    if carry and len(matches) < MAX_MATCHES_PER_FILE:
+        _scan_block(carry, pattern, line_number, matches)
+    return matches[:MAX_MATCHES_PER_FILE]
+
+
+def grep_blob_ranges(image_path, layer_blob, ranges, pattern):
+    """Search member ranges of one layer blob in a worker process.
+
+    Returns (range_index, line_number, line) for every match, in range order.
+    """
+    reader = ImageReader(image_path)
+    try:
+        layer_source = open_blob(reader, *layer_blob)
+        results = []
+        for range_idx, (offset, size) in enumerate(ranges):
+            for line_number, line in grep_range(layer_source, offset, size, pattern) or ():
+                results.append((range_idx, line_number, line))
+        return results
+    finally:
+        reader.close()
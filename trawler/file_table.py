@@ -0,0 +1,305 @@
+import base64
+import tarfile
+from array import array
+
+ROOT = 0  # Directory id of paths without a slash
+
+_DIRTYPE = ord(tarfile.DIRTYPE)
+_SYMTYPE = ord(tarfile.SYMTYPE)
+_LNKTYPE = ord(tarfile.LNKTYPE)
+_CHRTYPE = ord(tarfile.CHRTYPE)
+_BLKTYPE = ord(tarfile.BLKTYPE)
+_FIFOTYPE = ord(tarfile.FIFOTYPE)
+_REGULAR_TYPES = frozenset(ord(t) for t in tarfile.REGULAR_TYPES)
+_MAX_ID = 0xFFFFFFFF
+
+
+class PathTable:
+    """Interned directory paths and base names shared by the file tables of an image.
+
+    A member path is stored as a (directory id, name id) pair, so a directory
+    that holds thousands of files, or a name such as __init__.py that recurs in
+    every layer, is kept once per image rather than once per member.
+    """
+
+    def __init__(self, dirs=None, names=None):
+        self.dirs = dirs if dirs is not None else [None]
+        self.names = names if names is not None else []
+        self._dir_ids = {path: dir_id for dir_id, path in enumerate(self.dirs)}
+        self._name_ids = {name: name_id for name_id, name in enumerate(self.names)}
+
+    def dir_id(self, path):
+        """Return the id of a directory path, interning it if needed."""
+        dir_id = self._dir_ids.get(path)
+        if dir_id is None:
+            dir_id = self._dir_ids[path] = len(self.dirs)
+            self.dirs.append(path)
+        return dir_id
+
+    def name_id(self, name):
+        """Return the id of a base name, interning it if needed."""
+        name_id = self._name_ids.get(name)
+        if name_id is None:
+            name_id = self._name_ids[name] = len(self.names)
+            self.names.append(name)
+        return name_id
+
+    def find_dir(self, path):
+        """Return the id of a directory path, ROOT for '', or None if it is unknown."""
+        return ROOT if path == '' else self._dir_ids.get(path)
+
+    def find_name(self, name):
+        return self._name_ids.get(name)
+
+    def split(self, path):
+        """Return the (directory id, name id) of a path, interning both."""
+        dir_path, sep, name = path.rpartition('/')
+        return (self.dir_id(dir_path) if sep else ROOT), self.name_id(name)
+
+    def path(self, dir_id, name_id):
+        dir_path = self.dirs[dir_id]
+        name = self.names[name_id]
+        return name if dir_path is None else dir_path + '/' + name
+
+    def to_dict(self):
+        return {'dirs': self.dirs, 'names': self.names}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['dirs'], data['names'])
+
+
+class FileTable:
+    """Columnar member table of one layer tar.
+
+    Each member is a row across typed arrays; rarely set fields such as link
+    targets live in small side tables keyed by row. Rows from member_count
+    onwards are implicit directories: parents that have no member of their own.
+    """
+
+    COLUMNS = (
+        ('dir_ids', 'I'), ('name_ids', 'I'), ('sizes', 'q'), ('mtimes', 'q'), ('modes', 'I'),
+        ('types', 'B'), ('uids', 'I'), ('gids', 'I'), ('owner_ids', 'I'), ('offsets', 'q'),
+    )
+
+    def __init__(self, path_table):
+        self.path_table = path_table
+        for column, typecode in self.COLUMNS:
+            setattr(self, column, array(typecode))
+        self.owners = [('', '')]  # Distinct (uname, gname) pairs
+        self._owner_ids = {('', ''): 0}
+        self.linknames = {}
+        self.devices = {}
+        self.sparse = {}
+        self.member_count = 0
+
+    def __len__(self):
+        return len(self.dir_ids)
+
+    def append(self, member):
+        """Add a TarInfo as a new row."""
+        row = len(self.dir_ids)
+        dir_id, name_id = self.path_table.split(member.name)
+        owner = (member.uname, member.gname)
+        owner_id = self._owner_ids.get(owner)
+        if owner_id is None:
+            owner_id = self._owner_ids[owner] = len(self.owners)
+            self.owners.append(owner)
+        self.dir_ids.append(dir_id)
+        self.name_ids.append(name_id)
+        self.sizes.append(member.size)
+        self.mtimes.append(int(member.mtime))
+        self.modes.append(member.mode & _MAX_ID)
+        self.types.append(member.type[0] if member.type else ord(tarfile.REGTYPE))
+        self.uids.append(min(member.uid, _MAX_ID))
+        self.gids.append(min(member.gid, _MAX_ID))
+        self.owner_ids.append(owner_id)
+        self.offsets.append(member.offset_data)
+        if member.linkname:
+            self.linknames[row] = member.linkname
+        if member.ischr() or member.isblk():
+            self.devices[row] = (member.devmajor, member.devminor)
+        if member.sparse is not None:
+            self.sparse[row] = member.sparse
+        self.member_count = row + 1
+
+    def add_implicit_dirs(self):
+        """Add directory rows for parents that appear only as part of other paths."""
+        path_table = self.path_table
+        present = set(zip(self.dir_ids, self.name_ids))
+        pending = set(self.dir_ids)
+        pending.discard(ROOT)
+        while pending:
+            dir_path = path_table.dirs[pending.pop()]
+            if not dir_path:
+                continue
+            dir_id, name_id = path_table.split(dir_path)
+            if (dir_id, name_id) in present:
+                continue
+            present.add((dir_id, name_id))
+            pending.add(dir_id)
+            for column, value in (('dir_ids', dir_id), ('name_ids', name_id), ('sizes', 0), ('mtimes', 0),
+                                  ('modes', 0o755), ('types', _DIRTYPE), ('uids', 0), ('gids', 0),
+                                  ('owner_ids', 0), ('offsets', -1)):
+                getattr(self, column).append(value)
+            pending.discard(ROOT)
+
+    def rebase(self, path_table):
+        """Re-intern this table's paths into another path table, such as the image-wide one.
+
+        Only the directories and names the table uses are carried over.
+        """
+        dirs = self.path_table.dirs
+        names = self.path_table.names
+        dir_map = {dir_id: path_table.dir_id(dirs[dir_id]) for dir_id in set(self.dir_ids)}
+        name_map = {name_id: path_table.name_id(names[name_id]) for name_id in set(self.name_ids)}
+        self.dir_ids = array('I', [dir_map[dir_id] for dir_id in self.dir_ids])
+        self.name_ids = array('I', [name_map[name_id] for name_id in self.name_ids])
+        self.path_table = path_table
+
+    def path(self, row):
+        return self.path_table.path(self.dir_ids[row], self.name_ids[row])
+
+    def isdir(self, row):
+        return self.types[row] == _DIRTYPE
+
+    def isreg(self, row):
+        return self.types[row] in _REGULAR_TYPES
+
+    def entry(self, row):
+        return FileEntry(self, row)
+
+    def entries(self, rows):
+        return [FileEntry(self, row) for row in rows]
+
+    def to_dict(self):
+        data = {column: base64.b64encode(getattr(self, column).tobytes()).decode('ascii') for column, _ in self.COLUMNS}
+        data.update(
+            owners=self.owners,
+            linknames=list(self.linknames.items()),
+            devices=list(self.devices.items()),
+            sparse=list(self.sparse.items()),
+            member_count=self.member_count,
+        )
+        return data
+
+    @classmethod
+    def from_dict(cls, data, path_table):
+        table = cls(path_table)
+        for column, typecode in cls.COLUMNS:
+            values = array(typecode)
+            values.frombytes(base64.b64decode(data[column]))
+            setattr(table, column, values)
+        table.owners = [tuple(owner) for owner in data['owners']]
+        table.linknames = dict(data['linknames'])
+        table.devices = {row: tuple(device) for row, device in data['devices']}
+        table.sparse = {row: [tuple(block) for block in blocks] for row, blocks in data['sparse']}
+        table.member_count = data['member_count']
+        return table
+
+
+class FileEntry:
+    """Lightweight TarInfo-like view of one row of a FileTable."""
+
+    __slots__ = ('table', 'row')
+
+    def __init__(self, table, row):
+        self.table = table
+        self.row = row
+
+    def __repr__(self):
+        return f"<FileEntry {self.name!r}>"
+
+    @property
+    def name(self):
+        return self.table.path(self.row)
+
+    @property
+    def size(self):
+        return self.table.sizes[self.row]
+
+    @property
+    def mode(self):
+        return self.table.modes[self.row]
+
+    @property
+    def mtime(self):
+        return self.table.mtimes[self.row]
+
+    @property
+    def type(self):
+        return bytes((self.table.types[self.row],))
+
+    @property
+    def linkname(self):
+        return self.table.linknames.get(self.row, '')
+
+    @property
+    def uid(self):
+        return self.table.uids[self.row]
+
+    @property
+    def gid(self):
+        return self.table.gids[self.row]
+
+    @property
+    def uname(self):
+        return self.table.owners[self.table.owner_ids[self.row]][0]
+
+    @property
+    def gname(self):
+        return self.table.owners[self.table.owner_ids[self.row]][1]
+
+    @property
+    def offset_data(self):
+        return self.table.offsets[self.row]
+
+    @property
+    def sparse(self):
+        return self.table.sparse.get(self.row)
+
+    def isreg(self):
+        return self.table.types[self.row] in _REGULAR_TYPES
+
+    isfile = isreg
+
+    def isdir(self):
+        return self.table.types[self.row] == _DIRTYPE
+
+    def issym(self):
+        return self.table.types[self.row] == _SYMTYPE
+
+    def islnk(self):
+        return self.table.types[self.row] == _LNKTYPE
+
+    def ischr(self):
+        return self.table.types[self.row] == _CHRTYPE
+
+    def isblk(self):
+        return self.table.types[self.row] == _BLKTYPE
+
+    def isfifo(self):
+        return self.table.types[self.row] == _FIFOTYPE
+
+    def isdev(self):
+        return self.table.types[self.row] in (_CHRTYPE, _BLKTYPE, _FIFOTYPE)
+
+    def issparse(self):
+        return self.row in self.table.sparse
+
+    def to_tarinfo(self):
+        """Rebuild a TarInfo that tarfile can extract from the layer tar."""
+        member = tarfile.TarInfo(self.name)
+        member.size = self.size
+        member.mode = self.mode
+        member.mtime = self.mtime
+        member.type = self.type
+        member.linkname = self.linkname
+        member.uid = self.uid
+        member.gid = self.gid
+        member.uname = self.uname
+        member.gname = self.gname
+        member.devmajor, member.devminor = self.table.devices.get(self.row, (0, 0))
+        member.offset_data = self.offset_data
+        member.sparse = self.sparse
+        return member
@@ -0,0 +1,119 @@
+import bisect
+import threading
+import zlib
+
+# Uncompressed bytes between saved checkpoints. Each checkpoint holds a copy of the
+# inflater, whose 32 KiB window dominates its size (roughly 35 KiB in total).
+DEFAULT_SPACING = 8 * 1024 * 1024
+READ_SIZE = 32 * 1024  # Compressed bytes fed to the inflater per step, bounding checkpoint placement
+OUTPUT_CHUNK = 1024 * 1024  # Largest uncompressed chunk produced per inflate call
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+class _Checkpoint:
+    __slots__ = ('out_offset', 'in_offset', 'inflater')
+
+    def __init__(self, out_offset, in_offset, inflater):
+        self.out_offset = out_offset
+        self.in_offset = in_offset
+        self.inflater = inflater  # Saved inflater state, or None at the start of a gzip member
+
+
+class _Cursor:
+    __slots__ = ('out_offset', 'in_offset', 'inflater', 'tail', 'pending')
+
+    def __init__(self, checkpoint):
+        self.out_offset = checkpoint.out_offset
+        self.in_offset = checkpoint.in_offset
+        self.inflater = checkpoint.inflater.copy() if checkpoint.inflater is not None else None
+        self.tail = b''  # Compressed input handed to the inflater but not yet consumed
+        self.pending = False  # The inflater may hold output it has not returned yet
+
+
+class GzipIndex:
+    """Random-access reads from a gzip stream, zran style.
+
+    The first pass over the stream saves a copy of the inflater every `spacing`
+    uncompressed bytes. Later reads resume from the nearest checkpoint before the
+    requested offset instead of inflating the stream from its start, and forward
+    reads continue from where the previous read stopped.
+    """
+
+    def __init__(self, source, spacing=DEFAULT_SPACING):
+        self.source = source  # Anything with a pread method over the compressed bytes
+        self.spacing = spacing
+        self.size = None  # Uncompressed size, known once the end of the stream is reached
+        self._checkpoints = [_Checkpoint(0, 0, None)]
+        self._checkpoint_offsets = [0]
+        self._cursor = None
+        self._lock = threading.Lock()
+
+    def pread(self, offset, size):
+        """Read up to size uncompressed bytes starting at offset."""
+        with self._lock:
+            if size <= 0 or (self.size is not None and offset >= self.size):
+                return b''
+            cursor = self._seek(offset)
+            out = bytearray()
+            self._inflate(cursor, offset, offset + size, out)
+            self._cursor = cursor
+            return bytes(out)
+
+    def _seek(self, offset):
+        """Return the cursor closest to offset that does not lie past it."""
+        idx = bisect.bisect_right(self._checkpoint_offsets, offset) - 1
+        checkpoint = self._checkpoints[idx]
+        cursor = self._cursor
+        if cursor is not None and checkpoint.out_offset <= cursor.out_offset <= offset:
+            return cursor
+        return _Cursor(checkpoint)
+
+    def _inflate(self, cursor, start, end, out):
+        """Inflate from the cursor up to end, collecting the bytes from start onwards."""
+        while cursor.out_offset < end:
+            if cursor.inflater is None or cursor.inflater.eof:
+                if not self._start_member(cursor):
+                    self.size = cursor.out_offset
+                    return
+            if not cursor.tail and not cursor.pending:
+                self._checkpoint(cursor)
+                chunk = self.source.pread(cursor.in_offset, READ_SIZE)
+                if not chunk:
+                    raise EOFError("Compressed file ended before the end-of-stream marker was reached")
+                cursor.in_offset += len(chunk)
+                cursor.tail = chunk
+
+            want = min(end - cursor.out_offset, OUTPUT_CHUNK)
+            inflater = cursor.inflater
+            data = inflater.decompress(cursor.tail, want)
+            if inflater.eof:
+                cursor.tail = inflater.unused_data
+                cursor.pending = False
+            else:
+                cursor.tail = inflater.unconsumed_tail
+                cursor.pending = len(data) == want
+
+            skip = start - cursor.out_offset
+            if skip < len(data):
+                out += data[skip:] if skip > 0 else data
+            cursor.out_offset += len(data)
+
+    def _start_member(self, cursor):
+        """Begin inflating the next gzip member, returning False at the end of the stream."""
+        if len(cursor.tail) < len(GZIP_MAGIC):
+            more = self.source.pread(cursor.in_offset, READ_SIZE)
+            cursor.in_offset += len(more)
+            cursor.tail += more
+        # Anything other than another member (such as zero padding) ends the stream, as in gzip.
+        if not cursor.tail.startswith(GZIP_MAGIC):
+            return False
+        cursor.inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        cursor.pending = False
+        return True
+
+    def _checkpoint(self, cursor):
+        """Save the cursor's inflater if it is far enough past the last checkpoint."""
+        if cursor.out_offset >= self._checkpoints[-1].out_offset + self.spacing:
+            self._checkpoints.append(_Checkpoint(cursor.out_offset, cursor.in_offset, cursor.inflater.copy()))
+            self._checkpoint_offsets.append(cursor.out_offset)
@@ -0,0 +1,161 @@
+from trawler.layer_index import OperationCancelled
+from trawler.merged_view import OPAQUE_WHITEOUT, WHITEOUT_PREFIX
+
+SAME, CHANGED, CHECK_CONTENT = range(3)  # Results of compare_entries
+
+
+def shared_layer_count(old_digests, new_digests):
+    """Return how many bottom layers two images have in common, by layer digest."""
+    count = 0
+    for old, new in zip(old_digests, new_digests):
+        if old is None or old != new:
+            break
+        count += 1
+    return count
+
+
+def compare_entries(old, new):
+    """Compare two entries at the same path from their metadata alone.
+
+    Returns SAME, CHANGED, or CHECK_CONTENT for regular files of the same
+    size, mode and owner whose mtimes differ, where only a content hash can
+    tell. Directory mtimes are ignored, as any change inside one bumps it.
+    """
+    if old.type != new.type and not (old.isreg() and new.isreg()):
+        return CHANGED
+    if (old.mode, old.uid, old.gid) != (new.mode, new.uid, new.gid):
+        return CHANGED
+    if old.isdir():
+        return SAME
+    if old.linkname != new.linkname or old.table.devices.get(old.row) != new.table.devices.get(new.row):
+        return CHANGED
+    if not old.isreg():
+        return SAME
+    if old.size != new.size or old.sparse != new.sparse:
+        return CHANGED
+    return SAME if old.mtime == new.mtime else CHECK_CONTENT
+
+
+def changed_paths(tables):
+    """Return the paths the layer tables write and the directories they make opaque or delete."""
+    paths = set()
+    cleared = set()  # Whiteout targets and opaque directories, whose old contents may be gone
+    for table in tables:
+        names = table.path_table.names
+        for row in range(len(table)):
+            path = table.path(row)
+            name = names[table.name_ids[row]]
+            if name == OPAQUE_WHITEOUT:
+                cleared.add(path.rpartition('/')[0])
+            elif name.startswith(WHITEOUT_PREFIX):
+                dir_path, sep, _ = path.rpartition('/')
+                cleared.add(dir_path + sep + name[len(WHITEOUT_PREFIX):])
+            else:
+                paths.add(path)
+    return paths, cleared
+
+
+def merged_pairs(old_view, new_view, paths, cleared=(), cancel=None):
+    """Yield (path, old entry, new entry) for candidate paths of two merged views, None where absent.
+
+    Below a directory in cleared, or one that only one side has, every path
+    of either side is compared too, since the layers that made the change
+    do not list them.
+    """
+    def live(entry):
+        return entry if entry is not None and entry.deleted_by is None else None
+
+    cleared = set(cleared)
+    seen = set(paths) | cleared
+    pending = sorted(seen, reverse=True)
+    while pending:
+        if cancel is not None and cancel.is_set():
+            raise OperationCancelled("Diff cancelled")
+        path = pending.pop()
+        old = live(old_view.get(path))
+        new = live(new_view.get(path))
+        old_dir = old is not None and old.isdir()
+        new_dir = new is not None and new.isdir()
+        if path in cleared or old_dir != new_dir:
+            for view, is_dir in ((old_view, old_dir), (new_view, new_dir)):
+                if not is_dir:
+                    continue
+                for child in view.children(path):
+                    name = child.name
+                    if child.isdir():
+                        cleared.add(name)
+                    if name not in seen:
+                        seen.add(name)
+                        pending.append(name)
+        if old is not None or new is not None:
+            yield path, old, new
+
+
+def layer_pairs(old_table, new_table):
+    """Yield (path, old entry, new entry) for every path of two layer tables, None where absent."""
+    old_rows = {old_table.path(row): row for row in range(len(old_table))}
+    new_rows = {new_table.path(row): row for row in range(len(new_table))}
+    for path in sorted(old_rows.keys() | new_rows.keys()):
+        old_row = old_rows.get(path)
+        new_row = new_rows.get(path)
+        yield (path, None if old_row is None else old_table.entry(old_row),
+               None if new_row is None else new_table.entry(new_row))
+
+
+class DiffEntry:
+    """A path that differs between two images or layers: 'added', 'removed' or 'modified'."""
+
+    __slots__ = ('path', 'status', 'old', 'new')
+
+    def __init__(self, path, status, old=None, new=None):
+        self.path = path
+        self.status = status
+        self.old = old
+        self.new = new
+
+    def __repr__(self):
+        return f"<DiffEntry {self.status} {self.path!r}>"
+
+    @property
+    def size_delta(self):
+        """Change in regular file bytes at this path."""
+        old_size = self.old.size if self.old is not None and self.old.isreg() else 0
+        new_size = self.new.size if self.new is not None and self.new.isreg() else 0
+        return new_size - old_size
+
+
+class ImageDiff:
+    """Differences between two images or layers, sorted by path."""
+
+    def __init__(self, entries, shared_layers=0):
+        self.entries = sorted(entries, key=lambda entry: entry.path)
+        self.shared_layers = shared_layers  # Bottom layers with equal digests, skipped without reading
+
+    def _with_status(self, status):
+        return [entry for entry in self.entries if entry.status == status]
+
+    @property
+    def added(self):
+        return self._with_status('added')
+
+    @property
+    def removed(self):
+        return self._with_status('removed')
+
+    @property
+    def modified(self):
+        return self._with_status('modified')
+
+    @property
+    def size_delta(self):
+        return sum(entry.size_delta for entry in self.entries)
+
+    def to_dict(self):
+        return {
+            'added': len(self.added),
+            'removed': len(self.removed),
+            'modified': len(self.modified),
+            'size_delta': self.size_delta,
+            'shared_layers': self.shared_layers,
+        }
+
@@ -0,0 +1,196 @@
+import io
+import os
+import bz2
+import lzma
+import threading
+from trawler.gzip_index import GzipIndex
+
+BUFFER_SIZE = 64 * 1024
+COPY_CHUNK = 1024 * 1024  # Largest piece of a member held in memory or handed to the kernel at once
+
+# Magic numbers of the compressed blob formats tarfile knows how to read.
+COMPRESSION_MAGIC = (
+    ('gzip', b'\x1f\x8b'),
+    ('bz2', b'BZh'),
+    ('xz', b'\xfd7zXZ\x00'),
+)
+
+# These formats are only seekable by decompressing forward, unlike gzip (see GzipIndex).
+STREAM_OPENERS = {
+    'bz2': bz2.BZ2File,
+    'xz': lzma.LZMAFile,
+}
+
+
+class ImageReader:
+    """Positional reads from an image file, without a shared file offset."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._lock = threading.Lock()
+        self.size = os.fstat(self._file.fileno()).st_size
+
+    def fileno(self):
+        return self._file.fileno()
+
+    def pread(self, offset, size):
+        """Read up to size bytes starting at offset."""
+        if hasattr(os, 'pread'):
+            chunks = []
+            while size > 0:
+                chunk = os.pread(self._file.fileno(), size, offset)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                offset += len(chunk)
+                size -= len(chunk)
+            return b''.join(chunks)
+        with self._lock:
+            self._file.seek(offset)
+            return self._file.read(size)
+
+    def copy_to_fd(self, out_fd, offset, size, progress=None):
+        """Copy a byte range of the image to a file descriptor inside the kernel.
+
+        Uses copy_file_range, then sendfile, and returns how many bytes were
+        copied before neither was available; the caller copies the rest.
+        """
+        copied = 0
+        for kernel_copy in (_copy_file_range, _sendfile):
+            try:
+                while copied < size:
+                    count = kernel_copy(self.fileno(), out_fd, offset + copied, min(size - copied, COPY_CHUNK))
+                    if not count:
+                        raise EOFError("Image file ended before the requested range")
+                    copied += count
+                    if progress is not None:
+                        progress(count)
+                break
+            except (AttributeError, OSError):
+                # Missing on this platform, or refused for this pair of files (e.g. EXDEV, EINVAL).
+                continue
+        return copied
+
+    def close(self):
+        self._file.close()
+
+
+def _copy_file_range(in_fd, out_fd, offset, count):
+    return os.copy_file_range(in_fd, out_fd, count, offset)
+
+
+def _sendfile(in_fd, out_fd, offset, count):
+    return os.sendfile(out_fd, in_fd, offset, count)
+
+
+class StreamSource:
+    """Positional reads over a seekable stream such as a decompressing file object."""
+
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self._lock = threading.Lock()
+        self.size = None
+
+    def pread(self, offset, size):
+        with self._lock:
+            self._fileobj.seek(offset)
+            return self._fileobj.read(size)
+
+
+class RangeFile(io.RawIOBase):
+    """Read-only file object over a byte range of a source with a pread method."""
+
+    def __init__(self, source, offset=0, size=None):
+        super().__init__()
+        self.source = source
+        self.offset = offset
+        self.size = size
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            pos += self._pos
+        elif whence == io.SEEK_END:
+            if self.size is None:
+                raise io.UnsupportedOperation("size of range is unknown")
+            pos += self.size
+        if pos < 0:
+            raise ValueError("negative seek position")
+        self._pos = pos
+        return pos
+
+    def pread(self, offset, size):
+        if self.size is not None:
+            size = max(0, min(size, self.size - offset))
+        return self.source.pread(self.offset + offset, size) if size else b''
+
+    def readinto(self, buffer):
+        data = self.pread(self._pos, len(buffer))
+        buffer[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+
+def copy_range(source, out, offset, size, progress=None):
+    """Copy a byte range of a source to a binary file in chunks of at most COPY_CHUNK.
+
+    Ranges that resolve to bytes stored as-is in an image file are copied by
+    the kernel when out has a file descriptor. progress(byte_count) is called
+    after each chunk and may raise to stop the copy.
+    """
+    while isinstance(source, RangeFile):
+        offset += source.offset
+        source = source.source
+    if isinstance(source, ImageReader):
+        try:
+            out_fd = out.fileno()
+        except (AttributeError, io.UnsupportedOperation):
+            out_fd = None
+        if out_fd is not None:
+            out.flush()
+            copied = source.copy_to_fd(out_fd, offset, size, progress)
+            offset += copied
+            size -= copied
+    while size > 0:
+        chunk = source.pread(offset, min(size, COPY_CHUNK))
+        if not chunk:
+            raise EOFError("Source ended before the requested range")
+        out.write(chunk)
+        offset += len(chunk)
+        size -= len(chunk)
+        if progress is not None:
+            progress(len(chunk))
+
+
+def open_range(source, offset=0, size=None):
+    """Return a buffered file object over a byte range of a source."""
+    return io.BufferedReader(RangeFile(source, offset, size), BUFFER_SIZE)
+
+
+def blob_compression(source, offset):
+    """Return the compression format of a blob from its magic number, or None if stored as-is."""
+    head = source.pread(offset, 6)
+    for compression, magic in COMPRESSION_MAGIC:
+        if head.startswith(magic):
+            return compression
+    return None
+
+
+def open_blob(source, offset, size, compression=None):
+    """Return a random-access source over the uncompressed contents of a blob."""
+    blob = RangeFile(source, offset, size)
+    if compression == 'gzip':
+        return GzipIndex(blob)
+    if compression:
+        return StreamSource(STREAM_OPENERS[compression](open_range(blob)))
+    return blob
@@ -0,0 +1,156 @@
+import threading
+from trawler.container_image_inspector import ContainerImageInspector
+from trawler.content_search import DEFAULT_MAX_FILE_SIZE
+from trawler.file_table import PathTable
+from trawler.layer_index import OperationCancelled
+from trawler.search_index import SearchIndex
+
+
+class LayerStore:
+    """File tables shared by the images of a session, one per layer digest.
+
+    Every table is interned in one PathTable and added to one SearchIndex.
+    An image claims a layer before indexing it, so images loading at the
+    same time never parse a shared layer twice: the others wait for it.
+    """
+
+    def __init__(self):
+        self.path_table = PathTable()
+        self.search_index = SearchIndex(self.path_table)
+        self.search_lock = threading.Lock()  # Held by inspectors adding layers to search_index
+        self._tables = {}  # Layer digest -> FileTable
+        self._claimed = set()  # Digests an image is indexing
+        self._state = threading.Condition()
+
+    def __len__(self):
+        return len(self._tables)
+
+    def get(self, digest):
+        with self._state:
+            return self._tables.get(digest)
+
+    def claim(self, digest, wait=True, cancel=None):
+        """Return (table, claimed) for a layer digest.
+
+        table is the layer's FileTable once any image has indexed it. Until
+        then, claimed is True when the caller has to index the layer and hand
+        it to add, or to release on failure. Without wait, a layer another
+        image is indexing gives (None, False) at once; with wait, the call
+        blocks until that image adds or releases it.
+        """
+        with self._state:
+            while True:
+                table = self._tables.get(digest)
+                if table is not None:
+                    return table, False
+                if digest not in self._claimed:
+                    self._claimed.add(digest)
+                    return None, True
+                if not wait:
+                    return None, False
+                if cancel is not None and cancel.is_set():
+                    raise OperationCancelled("Loading cancelled")
+                self._state.wait(0.1)
+
+    def add(self, digest, table):
+        """Store a layer's table, interned with intern, and return the table kept for the digest."""
+        with self._state:
+            table = self._tables.setdefault(digest, table)
+            self._claimed.discard(digest)
+            self._state.notify_all()
+            return table
+
+    def release(self, digest):
+        """Give up a claim without adding a table, letting another image index the layer."""
+        with self._state:
+            self._claimed.discard(digest)
+            self._state.notify_all()
+
+    def intern(self, table):
+        """Move a table indexed with its own path table into the shared one."""
+        with self._state:  # PathTable interning is not safe to run from several threads at once
+            table.rebase(self.path_table)
+
+
+class ImageSession:
+    """Several images inspected together, indexing the layers they share only once.
+
+    Layers are identified by digest (the config's rootfs.diff_ids). With more
+    than one image, the inspectors share a LayerStore, so a base layer found
+    in every image is parsed, held in memory and added to the search index
+    once. Searches run once per distinct layer and report every image and
+    layer index holding each hit.
+    """
+
+    def __init__(self, image_paths, index_cache=None, jobs=1, background=False):
+        self.layer_store = LayerStore() if len(image_paths) > 1 else None
+        self.images = [ContainerImageInspector(path, index_cache=index_cache, jobs=jobs, background=background,
+                                               layer_store=self.layer_store)
+                       for path in image_paths]
+
+    def unique_layers(self):
+        """Return [(key, [(image_idx, layer_idx), ...])] for each distinct layer, in order of first appearance.
+
+        key is the layer digest, or (image_idx, layer_idx) for a layer without
+        one. A single image keeps every layer apart, as its inspector does.
+        """
+        holders = {}
+        for image_idx, image in enumerate(self.images):
+            image.wait_for_layer_list()
+            for layer_idx, digest in enumerate(image.layer_digests):
+                shared = digest is not None and self.layer_store is not None
+                key = digest if shared else (image_idx, layer_idx)
+                holders.setdefault(key, []).append((image_idx, layer_idx))
+        return list(holders.items())
+
+    def _per_unique_layer(self, search, on_layer=None):
+        """Run search(image, layer_indexes, on_layer) once per distinct layer, on the first image holding it.
+
+        Returns [(holders, matches)] in image and layer order, where holders
+        lists the (image_idx, layer_idx) of every copy of the layer.
+        """
+        holders_of = {}
+        owned = [[] for _ in self.images]
+        for _, holders in self.unique_layers():
+            image_idx, layer_idx = holders[0]
+            holders_of[(image_idx, layer_idx)] = holders
+            owned[image_idx].append(layer_idx)
+
+        results = []
+        for image_idx, image in enumerate(self.images):
+            def found(layer_idx, matches, image_idx=image_idx):
+                holders = holders_of[(image_idx, layer_idx)]
+                results.append((holders, matches))
+                if on_layer is not None:
+                    on_layer(holders, matches)
+            if owned[image_idx]:
+                search(image, owned[image_idx], found)
+        return results
+
+    def search_files(self, query, mode='substring', on_layer=None, cancel=None):
+        """Search paths in every distinct layer; see ContainerImageInspector.search_files_across_layers.
+
+        on_layer(holders, matches) is called as each layer with matches is done.
+        """
+        return self._per_unique_layer(
+            lambda image, layers, found: image.search_files_across_layers(query, mode, found, cancel, layers),
+            on_layer)
+
+    def grep(self, pattern, regex=False, ignore_case=False, max_file_size=DEFAULT_MAX_FILE_SIZE, on_layer=None,
+             progress=None, cancel=None):
+        """Search file contents in every distinct layer; see ContainerImageInspector.grep_layers."""
+        return self._per_unique_layer(
+            lambda image, layers, found: image.grep_layers(pattern, regex, ignore_case, max_file_size, found,
+                                                           progress, cancel, layers),
+            on_layer)
+
+    def cancel_loading(self, wait=False):
+        for image in self.images:
+            image.cancel_loading()
+        if wait:
+            for image in self.images:
+                image.cancel_loading(wait=True)
+
+    def close(self):
+        for image in self.images:
+            image.close()
@@ -0,0 +1,152 @@
+import os
+import json
+import time
+import zlib
+import sqlite3
+import hashlib
+
+CACHE_VERSION = 3
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+DIGEST_ROW_BYTES = 256  # Space a stored content digest takes in the database file, with its key index
+PARTIAL_HASH_BYTES = 1024 * 1024  # Bytes hashed from each end of the image file
+
+
+def default_cache_dir():
+    """Return the per-user cache directory, honouring TRAWLER_CACHE_DIR and XDG_CACHE_HOME."""
+    if os.environ.get('TRAWLER_CACHE_DIR'):
+        return os.environ['TRAWLER_CACHE_DIR']
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'trawler')
+
+
+def image_cache_key(reader):
+    """Fingerprint an image file by its size, mtime and a hash of its first and last megabyte."""
+    stat = os.fstat(reader.fileno())
+    digest = hashlib.sha256(f"{stat.st_size}:{stat.st_mtime_ns}:".encode())
+    digest.update(reader.pread(0, PARTIAL_HASH_BYTES))
+    digest.update(reader.pread(max(0, stat.st_size - PARTIAL_HASH_BYTES), PARTIAL_HASH_BYTES))
+    return digest.hexdigest()
+
+
+class IndexCache:
+    """Size-bounded SQLite store of image indexes, evicting the least recently used first.
+
+    It also keeps the SHA-256 of file contents by layer digest and member
+    offset, which stay valid for any image sharing the layer. The digests of
+    a layer count against the same budget and are evicted together, in the
+    same least recently used order as the indexes.
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir or default_cache_dir()
+        self.path = os.path.join(self.cache_dir, 'index.sqlite3')
+        self.max_bytes = max_bytes
+
+    def _connect(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30)
+        # Must precede table creation to take effect; lets evictions shrink the file.
+        conn.execute("PRAGMA auto_vacuum = FULL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS indexes ("
+            "key TEXT PRIMARY KEY, data BLOB NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS digests ("
+            "layer TEXT NOT NULL, offset INTEGER NOT NULL, digest TEXT NOT NULL, PRIMARY KEY (layer, offset))"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS digest_layers ("
+            "layer TEXT PRIMARY KEY, size INTEGER NOT NULL, accessed REAL NOT NULL)"
+        )
+        return conn
+
+    def get(self, key):
+        """Return the cached index for key, or None on a miss or an unreadable cache."""
+        try:
+            conn = self._connect()
+            try:
+                with conn:
+                    row = conn.execute("SELECT data FROM indexes WHERE key = ?", (key,)).fetchone()
+                    if row is None:
+                        return None
+                    conn.execute("UPDATE indexes SET accessed = ? WHERE key = ?", (time.time(), key))
+            finally:
+                conn.close()
+            index = json.loads(zlib.decompress(row[0]))
+        except (OSError, sqlite3.Error, zlib.error, ValueError):
+            return None
+        if index.get('version') != CACHE_VERSION:
+            return None
+        return index
+
+    def put(self, key, index):
+        """Store an index for key, then evict old entries until the cache fits its budget."""
+        data = zlib.compress(json.dumps(dict(index, version=CACHE_VERSION), separators=(',', ':')).encode())
+        try:
+            conn = self._connect()
+            try:
+                with conn:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO indexes (key, data, size, accessed) VALUES (?, ?, ?, ?)",
+                        (key, data, len(data), time.time()),
+                    )
+                    self._evict(conn)
+            finally:
+                conn.close()
+        except (OSError, sqlite3.Error):
+            pass
+
+    def _evict(self, conn):
+        total = conn.execute("SELECT (SELECT COALESCE(SUM(size), 0) FROM indexes)"
+                             " + (SELECT COALESCE(SUM(size), 0) FROM digest_layers)").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        entries = conn.execute("SELECT 'index', key, size, accessed FROM indexes UNION ALL "
+                               "SELECT 'digests', layer, size, accessed FROM digest_layers ORDER BY 4").fetchall()
+        for kind, key, size, _ in entries:
+            if kind == 'index':
+                conn.execute("DELETE FROM indexes WHERE key = ?", (key,))
+            else:
+                conn.execute("DELETE FROM digests WHERE layer = ?", (key,))
+                conn.execute("DELETE FROM digest_layers WHERE layer = ?", (key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def get_digests(self, layer_digest, offsets):
+        """Return {offset: content digest} for the members of a layer hashed before."""
+        found = {}
+        try:
+            conn = self._connect()
+            try:
+                offsets = list(offsets)
+                for start in range(0, len(offsets), 500):  # Stay under SQLite's bound parameter limit
+                    batch = offsets[start:start + 500]
+                    query = f"SELECT offset, digest FROM digests WHERE layer = ? AND offset IN ({','.join('?' * len(batch))})"
+                    found.update(conn.execute(query, [layer_digest] + batch).fetchall())
+                if found:
+                    with conn:
+                        conn.execute("UPDATE digest_layers SET accessed = ? WHERE layer = ?", (time.time(), layer_digest))
+            finally:
+                conn.close()
+        except (OSError, sqlite3.Error):
+            pass
+        return found
+
+    def put_digests(self, layer_digest, digests):
+        """Store {offset: content digest} for members of a layer, then evict old entries until the cache fits."""
+        try:
+            conn = self._connect()
+            try:
+                with conn:
+                    conn.executemany("INSERT OR REPLACE INTO digests (layer, offset, digest) VALUES (?, ?, ?)",
+                                     [(layer_digest, offset, digest) for offset, digest in digests.items()])
+                    count = conn.execute("SELECT COUNT(*) FROM digests WHERE layer = ?", (layer_digest,)).fetchone()[0]
+                    conn.execute("INSERT OR REPLACE INTO digest_layers (layer, size, accessed) VALUES (?, ?, ?)",
+                                 (layer_digest, count * DIGEST_ROW_BYTES, time.time()))
+                    self._evict(conn)
+            finally:
+                conn.close()
+        except (OSError, sqlite3.Error):
+            pass
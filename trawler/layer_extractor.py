@@ -0,0 +1,28 @@
+import tarfile
+from trawler.image_reader import copy_range, open_range
+
+
+class LayerTarFile(tarfile.TarFile):
+    """TarFile that writes regular members by copying them straight from the layer source.
+
+    tarfile handles directories, links and file attributes as usual; only the
+    data copy is replaced, so member contents are streamed in bounded chunks
+    and, for layers stored as-is in the image, copied by the kernel.
+    """
+
+    layer_source = None
+    progress = None  # Called with the size of each copied chunk
+
+    def makefile(self, tarinfo, targetpath):
+        if tarinfo.sparse is not None or self.layer_source is None:
+            return super().makefile(tarinfo, targetpath)
+        with open(targetpath, 'wb') as target:
+            copy_range(self.layer_source, target, tarinfo.offset_data, tarinfo.size, self.progress)
+
+
+def open_layer_tar(layer_source, progress=None):
+    """Open a layer tar for extraction; only its first header is read."""
+    layer_tarfile = LayerTarFile.open(fileobj=open_range(layer_source), mode='r:')
+    layer_tarfile.layer_source = layer_source
+    layer_tarfile.progress = progress
+    return layer_tarfile
@@ -0,0 +1,93 @@
+import tarfile
+from array import array
+from trawler.file_table import FileTable, PathTable
+from trawler.image_reader import ImageReader, open_blob, open_range
+
+
+class OperationCancelled(Exception):
+    """Raised when a long-running operation is stopped through its cancel event."""
+
+
+def read_table(layer_source, path_table, cancel=None):
+    """Parse the member table of a layer tar once into a FileTable.
+
+    cancel is an optional threading.Event checked between members.
+    """
+    table = FileTable(path_table)
+    if layer_source is None:
+        return table
+    with tarfile.open(fileobj=open_range(layer_source), mode='r:') as layer_tarfile:
+        while True:
+            if cancel is not None and cancel.is_set():
+                raise OperationCancelled("Indexing cancelled")
+            member = layer_tarfile.next()
+            if member is None:
+                break
+            table.append(member)
+            # TarFile keeps every member it has read; the table is all we need.
+            layer_tarfile.members.clear()
+    table.add_implicit_dirs()
+    return table
+
+
+def index_layer_blob(image_path, offset, size, compression):
+    """Index one layer blob of an uncompressed image in a worker process.
+
+    The worker reads only its own byte range of the image file and returns a
+    FileTable with its own path table, to be rebased onto the image's.
+    """
+    reader = ImageReader(image_path)
+    try:
+        layer_source = open_blob(reader, offset, size, compression)
+        return read_table(layer_source, PathTable())
+    finally:
+        reader.close()
+
+
+class DirectoryTree:
+    """Rows of every directory in a layer's file table, pre-sorted in listing order."""
+
+    def __init__(self, table):
+        self.table = table
+        children = {}
+        for row, dir_id in enumerate(table.dir_ids):
+            children.setdefault(dir_id, []).append(row)
+        names = table.path_table.names
+        name_ids = table.name_ids
+        for dir_id, rows in children.items():
+            rows.sort(key=lambda row: (not table.isdir(row), names[name_ids[row]].lower()))
+            children[dir_id] = array('I', rows)
+        self._children = children
+
+    def _rows(self, path):
+        dir_id = self.table.path_table.find_dir(path.rstrip('/'))
+        return self._children.get(dir_id, ()) if dir_id is not None else ()
+
+    def get(self, name):
+        """Return the entry at a path, or None."""
+        dir_path, _, base_name = name.rpartition('/')
+        name_id = self.table.path_table.find_name(base_name)
+        if name_id is None:
+            return None
+        # As with TarFile.getmember, the last occurrence of a duplicated path wins.
+        for row in sorted(self._rows(dir_path), reverse=True):
+            if self.table.name_ids[row] == name_id:
+                return self.table.entry(row)
+        return None
+
+    def children(self, path=''):
+        """Return the entries directly inside a directory."""
+        return self.table.entries(self._rows(path))
+
+    def walk(self, path):
+        """Yield the entry at a path followed by everything below it, parents first."""
+        entry = self.get(path)
+        if entry is None:
+            return
+        yield entry
+        stack = [entry]
+        while stack:
+            for child in self.children(stack.pop().name):
+                yield child
+                if child.isdir():
+                    stack.append(child)
@@ -0,0 +1,94 @@
+import hashlib
+from trawler.image_reader import ImageReader, copy_range, open_blob
+
+HASH_BATCH_BYTES = 64 * 1024 * 1024  # Data hashed per worker task in stored layers
+
+
+def format_size(size):
+    """Return a byte count as a short human-readable string."""
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1000 or unit == 'GB':
+            return f"{size:.0f} {unit}" if unit == 'B' else f"{size:.1f} {unit}"
+        size /= 1000
+
+
+class _HashWriter:
+    def __init__(self):
+        self.digest = hashlib.sha256()
+
+    def write(self, data):
+        self.digest.update(data)
+
+
+def hash_range(source, offset, size, progress=None):
+    """Return the SHA-256 hex digest of a byte range of a source, read in chunks."""
+    writer = _HashWriter()
+    copy_range(source, writer, offset, size, progress)
+    return writer.digest.hexdigest()
+
+
+def hash_blob_ranges(image_path, layer_blob, ranges):
+    """Hash member ranges of one layer blob in a worker process, in the order given."""
+    reader = ImageReader(image_path)
+    try:
+        layer_source = open_blob(reader, *layer_blob)
+        return [hash_range(layer_source, offset, size) for offset, size in ranges]
+    finally:
+        reader.close()
+
+
+class LayerStats:
+    """Size and wasted space of one layer.
+
+    shadowed_bytes are files overwritten or deleted by later layers, and
+    duplicate_bytes are files still visible whose content an earlier file
+    already holds.
+    """
+
+    def __init__(self, size=0, file_count=0, shadowed_bytes=0, duplicate_bytes=0):
+        self.size = size
+        self.file_count = file_count
+        self.shadowed_bytes = shadowed_bytes
+        self.duplicate_bytes = duplicate_bytes
+
+    @property
+    def wasted_bytes(self):
+        return self.shadowed_bytes + self.duplicate_bytes
+
+    def to_dict(self):
+        return {
+            'size': self.size,
+            'file_count': self.file_count,
+            'shadowed_bytes': self.shadowed_bytes,
+            'duplicate_bytes': self.duplicate_bytes,
+            'wasted_bytes': self.wasted_bytes,
+        }
+
+
+class ImageStats:
+    """Per-layer stats of an image and its efficiency score."""
+
+    def __init__(self, layers):
+        self.layers = layers
+
+    @property
+    def total_bytes(self):
+        return sum(layer.size for layer in self.layers)
+
+    @property
+    def wasted_bytes(self):
+        return sum(layer.wasted_bytes for layer in self.layers)
+
+    @property
+    def efficiency(self):
+        """Share of the image's file bytes that are not wasted, from 0.0 to 1.0."""
+        total = self.total_bytes
+        return 1.0 - self.wasted_bytes / total if total else 1.0
+
+    def to_dict(self):
+        return {
+            'total_bytes': self.total_bytes,
+            'wasted_bytes': self.wasted_bytes,
+            'efficiency': round(self.efficiency, 4),
+            'layers': [layer.to_dict() for layer in self.layers],
+        }
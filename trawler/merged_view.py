@@ -0,0 +1,236 @@
+from array import array
+from trawler.file_table import FileEntry
+
+WHITEOUT_PREFIX = '.wh.'
+OPAQUE_WHITEOUT = '.wh..wh..opq'
+
+# Merged entries are packed into one int: the row that provides the entry, the
+# layer of that row, the layer that added the path and the layer that deleted it.
+_LAYER_BITS = 10
+_LAYER_MASK = (1 << _LAYER_BITS) - 1
+_LAYER_SHIFT = 32
+_ADDED_SHIFT = _LAYER_SHIFT + _LAYER_BITS
+_DELETED_SHIFT = _ADDED_SHIFT + _LAYER_BITS
+_ROW_MASK = (1 << _LAYER_SHIFT) - 1
+_NOT_DELETED = _LAYER_MASK << _DELETED_SHIFT
+_ABSENT = (1 << 64) - 1  # Undo log value of a path that did not exist before
+MAX_LAYERS = _LAYER_MASK
+
+
+def _pack(row, layer_idx, added_by):
+    return row | layer_idx << _LAYER_SHIFT | added_by << _ADDED_SHIFT | _NOT_DELETED
+
+
+def _is_deleted(value):
+    return value & _NOT_DELETED != _NOT_DELETED
+
+
+def _delete(value, layer_idx):
+    return value & ~_NOT_DELETED | layer_idx << _DELETED_SHIFT
+
+
+class MergedEntry(FileEntry):
+    """A path of the merged filesystem, seen through the layer row that last wrote it."""
+
+    __slots__ = ('layer', 'added_by', 'deleted_by')
+
+    def __init__(self, table, row, layer, added_by, deleted_by=None):
+        super().__init__(table, row)
+        self.layer = layer  # Layer whose member provides the entry's contents and metadata
+        self.added_by = added_by
+        self.deleted_by = deleted_by
+
+    def __repr__(self):
+        return f"<MergedEntry {self.name!r} {self.status} in layer {self.changed_by}>"
+
+    @property
+    def status(self):
+        """'deleted', 'added' or 'modified', relative to the layers below."""
+        if self.deleted_by is not None:
+            return 'deleted'
+        return 'added' if self.added_by == self.layer else 'modified'
+
+    @property
+    def changed_by(self):
+        """The layer behind status."""
+        return self.deleted_by if self.deleted_by is not None else self.layer
+
+
+class _UndoLog:
+    """Previous merged values of the paths one layer wrote, to step back below it."""
+
+    def __init__(self):
+        self.dir_ids = array('I')
+        self.name_ids = array('I')
+        self.values = array('Q')
+
+    def append(self, dir_id, name_id, previous):
+        self.dir_ids.append(dir_id)
+        self.name_ids.append(name_id)
+        self.values.append(previous)
+
+
+class MergedView:
+    """The filesystem a container sees, overlaying layers in order with whiteouts applied.
+
+    The view holds the union of layers 0 to top. Moving up applies one layer's
+    delta: its whiteouts hide paths from the layers below, then its members are
+    written over them. Each applied layer keeps an undo log of the values it
+    replaced, so moving down reverts deltas instead of rebuilding. Deleted paths
+    stay in the view as tombstones recording the layer that removed them.
+    """
+
+    def __init__(self, path_table, layer_table):
+        self.path_table = path_table
+        self._layer_table = layer_table  # Returns the FileTable of a layer index
+        self._tables = []  # FileTable of each applied layer
+        self._undo_logs = []
+        self._entries = {}  # dir_id -> {name_id: packed entry}
+        self.top = -1
+
+    def seek(self, layer_idx):
+        """Make the view cover layers 0 to layer_idx."""
+        if layer_idx >= MAX_LAYERS:
+            raise ValueError(f"Merged views support at most {MAX_LAYERS} layers")
+        while self.top > layer_idx:
+            self._revert()
+        while self.top < layer_idx:
+            self._apply(self.top + 1)
+
+    def _isdir(self, value):
+        return self._tables[value >> _LAYER_SHIFT & _LAYER_MASK].isdir(value & _ROW_MASK)
+
+    def _entry(self, value):
+        deleted_by = value >> _DELETED_SHIFT & _LAYER_MASK
+        layer_idx = value >> _LAYER_SHIFT & _LAYER_MASK
+        return MergedEntry(self._tables[layer_idx], value & _ROW_MASK, layer_idx,
+                           value >> _ADDED_SHIFT & _LAYER_MASK, None if deleted_by == _LAYER_MASK else deleted_by)
+
+    def _write(self, dir_id, name_id, value, undo_log):
+        children = self._entries.get(dir_id)
+        if children is None:
+            children = self._entries[dir_id] = {}
+        undo_log.append(dir_id, name_id, children.get(name_id, _ABSENT))
+        children[name_id] = value
+
+    def _delete_tree(self, dir_id, name_id, layer_idx, undo_log):
+        """Mark a path and, for a directory, everything below it as deleted by a layer."""
+        value = self._entries.get(dir_id, {}).get(name_id)
+        if value is None or _is_deleted(value):
+            return
+        self._write(dir_id, name_id, _delete(value, layer_idx), undo_log)
+        if self._isdir(value):
+            self._delete_children(self.path_table.find_dir(self.path_table.path(dir_id, name_id)), layer_idx, undo_log)
+
+    def _delete_children(self, dir_id, layer_idx, undo_log):
+        pending = [dir_id]
+        while pending:
+            dir_id = pending.pop()
+            children = self._entries.get(dir_id)
+            if dir_id is None or not children:
+                continue
+            for name_id, value in list(children.items()):
+                if _is_deleted(value):
+                    continue
+                self._write(dir_id, name_id, _delete(value, layer_idx), undo_log)
+                if self._isdir(value):
+                    pending.append(self.path_table.find_dir(self.path_table.path(dir_id, name_id)))
+
+    def _apply(self, layer_idx):
+        table = self._layer_table(layer_idx)
+        self._tables.append(table)
+        undo_log = _UndoLog()
+        path_table = self.path_table
+        names = path_table.names
+        dir_ids = table.dir_ids
+        name_ids = table.name_ids
+
+        # Whiteouts only hide paths of lower layers, so they are applied before any member.
+        whiteouts = {name_id for name_id in set(name_ids) if names[name_id].startswith(WHITEOUT_PREFIX)}
+        for row in range(table.member_count) if whiteouts else ():
+            name_id = name_ids[row]
+            if name_id not in whiteouts:
+                continue
+            name = names[name_id]
+            if name == OPAQUE_WHITEOUT:
+                self._delete_children(dir_ids[row], layer_idx, undo_log)
+                continue
+            target_id = path_table.find_name(name[len(WHITEOUT_PREFIX):])
+            if target_id is not None:
+                self._delete_tree(dir_ids[row], target_id, layer_idx, undo_log)
+
+        entries = self._entries
+        member_count = table.member_count
+        for row in range(len(table)):
+            name_id = name_ids[row]
+            if name_id in whiteouts:
+                continue
+            dir_id = dir_ids[row]
+            children = entries.get(dir_id)
+            if children is None:
+                children = entries[dir_id] = {}
+            previous = children.get(name_id)
+            if previous is None or _is_deleted(previous):
+                added_by = layer_idx
+            else:
+                previous_isdir = self._isdir(previous)
+                if row >= member_count and previous_isdir:
+                    continue  # An implicit parent leaves an existing directory as it is.
+                added_by = previous >> _ADDED_SHIFT & _LAYER_MASK
+                if previous_isdir and not table.isdir(row):
+                    # A file over a directory hides everything that was below it.
+                    self._delete_children(path_table.find_dir(path_table.path(dir_id, name_id)), layer_idx, undo_log)
+            undo_log.append(dir_id, name_id, _ABSENT if previous is None else previous)
+            children[name_id] = _pack(row, layer_idx, added_by)
+
+        self._undo_logs.append(undo_log)
+        self.top = layer_idx
+
+    def _revert(self):
+        undo_log = self._undo_logs.pop()
+        entries = self._entries
+        for i in range(len(undo_log.values) - 1, -1, -1):
+            dir_id = undo_log.dir_ids[i]
+            previous = undo_log.values[i]
+            if previous == _ABSENT:
+                children = entries[dir_id]
+                del children[undo_log.name_ids[i]]
+                if not children:
+                    del entries[dir_id]
+            else:
+                entries[dir_id][undo_log.name_ids[i]] = previous
+        self._tables.pop()
+        self.top -= 1
+
+    def visible_rows(self):
+        """Return a bytearray per applied layer flagging the rows that provide a live entry."""
+        flags = [bytearray(len(table)) for table in self._tables]
+        for children in self._entries.values():
+            for value in children.values():
+                if not _is_deleted(value):
+                    flags[value >> _LAYER_SHIFT & _LAYER_MASK][value & _ROW_MASK] = 1
+        return flags
+
+    def get(self, path):
+        """Return the merged entry at a path, deleted or not, or None."""
+        dir_path, sep, name = path.rstrip('/').rpartition('/')
+        dir_id = self.path_table.find_dir(dir_path)
+        name_id = self.path_table.find_name(name)
+        if dir_id is None or name_id is None:
+            return None
+        value = self._entries.get(dir_id, {}).get(name_id)
+        return self._entry(value) if value is not None else None
+
+    def children(self, path='', include_deleted=False):
+        """Return the entries directly inside a merged directory, directories first."""
+        dir_id = self.path_table.find_dir(path.rstrip('/'))
+        children = self._entries.get(dir_id) if dir_id is not None else None
+        if not children:
+            return []
+        names = self.path_table.names
+        listing = sorted(
+            (not self._isdir(value), names[name_id].lower(), value)
+            for name_id, value in children.items()
+            if include_deleted or not _is_deleted(value)
+        )
+        return [self._entry(value) for _, _, value in listing]
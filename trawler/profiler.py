@@ -0,0 +1,291 @@
+import os
+import sys
+import json
+import time
+import atexit
+import functools
+import threading
+from trawler.layer_stats import format_size
+
+PROFILE_ENV = 'TRAWLER_PROFILE'  # Set to a trace file path (or 1 for the default) to profile without --profile
+DEFAULT_TRACE_PATH = 'trawler-profile.json'
+MAX_TRACE_EVENTS = 100000  # Later calls still count towards the totals but are left out of the trace
+# Cheap inspector accessors the interface polls on every frame; timing them would only add noise.
+UNTIMED_METHODS = ('layer_ready', 'indexed_layer_count', 'get_layer_command', 'cancel_loading', 'close')
+
+_profiler = None
+
+
+class Profiler:
+    """Counters and timed calls collected while profiling is on.
+
+    Counters are bytes read from the image, bytes decompressed, tar members
+    parsed and index cache hits and misses. Calls are kept as totals per name
+    and as Chrome trace events, which chrome://tracing or Perfetto can open,
+    each with the counts its thread added while it ran. Only this process is
+    measured: layers indexed by worker processes show up as time spent in the
+    inspector call that waited for them.
+    """
+
+    def __init__(self, trace_path=None):
+        self.trace_path = trace_path
+        self.counters = {'bytes_read': 0, 'bytes_decompressed': 0, 'members_parsed': 0,
+                         'cache_hits': 0, 'cache_misses': 0}
+        self.calls = {}  # name -> [count, total seconds, longest seconds, {counter: total}]
+        self.events = []
+        self.last_call = None  # (name, seconds, counts) of the last inspector call to finish
+        self.last_frame = None  # Seconds taken to draw the last UI frame
+        self._lock = threading.Lock()
+        self._local = threading.local()  # Per thread counters, so concurrent calls don't share counts
+        self._start = time.perf_counter()
+        self._patches = []  # (owner, attribute, original) to undo in uninstall
+
+    def _thread_counters(self):
+        counters = getattr(self._local, 'counters', None)
+        if counters is None:
+            counters = self._local.counters = dict.fromkeys(self.counters, 0)
+        return counters
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+        self._thread_counters()[name] += amount
+
+    def snapshot(self):
+        """Return the counts of the calling thread so far, to pass to counted_since."""
+        return dict(self._thread_counters())
+
+    def counted_since(self, snapshot):
+        """Return what the calling thread has counted since snapshot was taken."""
+        return {name: value - snapshot[name] for name, value in self._thread_counters().items()}
+
+    def record(self, name, start, end, category='inspector', counts=None):
+        """Add a finished call that ran from start to end, as given by time.perf_counter.
+
+        counts maps counter names to what the call added, see counted_since.
+        """
+        seconds = end - start
+        with self._lock:
+            totals = self.calls.setdefault(name, [0, 0.0, 0.0, dict.fromkeys(self.counters, 0)])
+            totals[0] += 1
+            totals[1] += seconds
+            totals[2] = max(totals[2], seconds)
+            for counter, value in (counts or {}).items():
+                totals[3][counter] += value
+            if category == 'ui':
+                self.last_frame = seconds
+            else:
+                self.last_call = (name, seconds, counts)
+            if len(self.events) < MAX_TRACE_EVENTS:
+                event = {
+                    'name': name, 'cat': category, 'ph': 'X', 'pid': os.getpid(), 'tid': threading.get_ident(),
+                    'ts': (start - self._start) * 1e6, 'dur': seconds * 1e6,
+                }
+                if counts is not None:
+                    event['args'] = counts
+                self.events.append(event)
+
+    def timed(self, name, function, category='inspector'):
+        """Return function wrapped to record each call under name, with the counts it added."""
+        @functools.wraps(function)
+        def timed_call(*args, **kwargs):
+            snapshot = self.snapshot()
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.record(name, start, time.perf_counter(), category, self.counted_since(snapshot))
+        return timed_call
+
+    def _patch(self, owner, attribute, make_wrapper):
+        original = owner.__dict__[attribute]
+        self._patches.append((owner, attribute, original))
+        setattr(owner, attribute, functools.wraps(original)(make_wrapper(original)))
+
+    def install(self):
+        """Wrap the hot paths and every public inspector method with counting and timing code."""
+        from trawler.container_image_inspector import ContainerImageInspector
+        from trawler.file_table import FileTable
+        from trawler.gzip_index import GzipIndex
+        from trawler.image_reader import ImageReader, StreamSource
+        from trawler.index_cache import IndexCache
+        count = self.count
+
+        def counted_read(counter):
+            def make_wrapper(pread):
+                def pread_counted(source, offset, size):
+                    data = pread(source, offset, size)
+                    count(counter, len(data))
+                    return data
+                return pread_counted
+            return make_wrapper
+
+        def copy_counted(copy_to_fd):
+            def copy_to_fd_counted(reader, out_fd, offset, size, progress=None):
+                copied = copy_to_fd(reader, out_fd, offset, size, progress)
+                count('bytes_read', copied)
+                return copied
+            return copy_to_fd_counted
+
+        def inflate_counted(inflate):
+            def inflate_and_count(index, cursor, start, end, out):
+                out_offset = cursor.out_offset
+                try:
+                    return inflate(index, cursor, start, end, out)
+                finally:
+                    count('bytes_decompressed', cursor.out_offset - out_offset)
+            return inflate_and_count
+
+        def append_counted(append):
+            def append_and_count(table, member):
+                count('members_parsed')
+                return append(table, member)
+            return append_and_count
+
+        def read_timed(read_file):
+            """Time read_file over the reads of the chunks it returns, which happen after the call."""
+            def read_file_timed(inspector, *args, **kwargs):
+                snapshot = self.snapshot()
+                start = time.perf_counter()
+                try:
+                    entry, chunks = read_file(inspector, *args, **kwargs)
+                except BaseException:
+                    self.record('read_file', start, time.perf_counter(), counts=self.counted_since(snapshot))
+                    raise
+                busy = time.perf_counter() - start  # Time spent in the inspector, not waiting for the consumer
+
+                def timed_chunks():
+                    nonlocal busy
+                    try:
+                        while True:
+                            resumed = time.perf_counter()
+                            try:
+                                chunk = next(chunks)
+                            except StopIteration:
+                                return
+                            finally:
+                                busy += time.perf_counter() - resumed
+                            yield chunk
+                    finally:
+                        chunks.close()
+                        self.record('read_file', start, start + busy, counts=self.counted_since(snapshot))
+                return entry, timed_chunks()
+            return read_file_timed
+
+        def get_counted(get):
+            def get_and_count(cache, key):
+                index = get(cache, key)
+                count('cache_misses' if index is None else 'cache_hits')
+                return index
+            return get_and_count
+
+        self._patch(ImageReader, 'pread', counted_read('bytes_read'))
+        self._patch(ImageReader, 'copy_to_fd', copy_counted)
+        self._patch(StreamSource, 'pread', counted_read('bytes_decompressed'))
+        self._patch(GzipIndex, '_inflate', inflate_counted)
+        self._patch(FileTable, 'append', append_counted)
+        self._patch(IndexCache, 'get', get_counted)
+        names = [name for name, value in vars(ContainerImageInspector).items()
+                 if callable(value) and not isinstance(value, staticmethod) and name not in UNTIMED_METHODS
+                 and (not name.startswith('_') or name == '_load_local_image') and name != 'read_file']
+        for name in names:
+            self._patch(ContainerImageInspector, name,
+                        lambda method, name=name: self.timed(name.lstrip('_'), method))
+        self._patch(ContainerImageInspector, 'read_file', read_timed)
+
+    def uninstall(self):
+        while self._patches:
+            owner, attribute, original = self._patches.pop()
+            setattr(owner, attribute, original)
+
+    @staticmethod
+    def _describe(counts, skip_zero=False):
+        parts = []
+        if not skip_zero or counts['bytes_read']:
+            parts.append(f"read {format_size(counts['bytes_read'])}")
+        if not skip_zero or counts['bytes_decompressed']:
+            parts.append(f"inflated {format_size(counts['bytes_decompressed'])}")
+        if not skip_zero or counts['members_parsed']:
+            parts.append(f"{counts['members_parsed']} members")
+        if not skip_zero or counts['cache_hits'] or counts['cache_misses']:
+            parts.append(f"cache {counts['cache_hits']} hit/{counts['cache_misses']} miss")
+        return parts
+
+    def status_line(self):
+        """Return a one-line summary for a debug status bar: the totals, then the last call and what it did."""
+        parts = self._describe(self.counters)
+        if self.last_call is not None:
+            name, seconds, counts = self.last_call
+            call = f"{name} {seconds * 1000:.1f} ms"
+            done = self._describe(counts, skip_zero=True) if counts else []
+            parts.append(f"{call} ({', '.join(done)})" if done else call)
+        if self.last_frame is not None:
+            parts.append(f"frame {self.last_frame * 1000:.1f} ms")
+        return "profile: " + ", ".join(parts)
+
+    def summary(self):
+        with self._lock:
+            return {
+                'counters': dict(self.counters),
+                'calls': {name: {'count': totals[0], 'total_seconds': totals[1], 'max_seconds': totals[2],
+                                 **totals[3]}
+                          for name, totals in sorted(self.calls.items())},
+            }
+
+    def write_trace(self, path=None):
+        """Write the calls as a Chrome trace, with the totals under otherData."""
+        path = path or self.trace_path
+        with self._lock:
+            events = list(self.events)
+            events.append({'name': 'counters', 'ph': 'C', 'pid': os.getpid(), 'tid': threading.get_ident(),
+                           'ts': (time.perf_counter() - self._start) * 1e6, 'args': dict(self.counters)})
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms', 'otherData': self.summary()}, f)
+
+
+def current_profiler():
+    """Return the active Profiler, or None when profiling is off."""
+    return _profiler
+
+
+def start_profiling(trace_path=None):
+    """Turn profiling on; with a trace_path, the trace is written there when the process exits."""
+    global _profiler
+    if _profiler is None:
+        _profiler = Profiler(trace_path)
+        _profiler.install()
+        if trace_path:
+            atexit.register(_write_trace_at_exit, _profiler)
+    return _profiler
+
+
+def stop_profiling():
+    """Turn profiling off, restoring the uninstrumented code, and return the Profiler that was active.
+
+    A trace asked for in start_profiling is written now rather than at exit.
+    """
+    global _profiler
+    profiler, _profiler = _profiler, None
+    if profiler is not None:
+        profiler.uninstall()
+        if profiler.trace_path:
+            atexit.unregister(_write_trace_at_exit)
+            _write_trace_at_exit(profiler)
+    return profiler
+
+
+def _write_trace_at_exit(profiler):
+    try:
+        profiler.write_trace()
+    except OSError as e:
+        print(f"trawler: could not write profile to {profiler.trace_path}: {e}", file=sys.stderr)
+        return
+    print(f"trawler: {profiler.status_line()}; trace written to {profiler.trace_path}", file=sys.stderr)
+
+
+def profile_path_from_env():
+    """Return the trace path requested through PROFILE_ENV, or None."""
+    value = os.environ.get(PROFILE_ENV, '')
+    if value.lower() in ('', '0', 'false', 'no'):
+        return None
+    return DEFAULT_TRACE_PATH if value.lower() in ('1', 'true', 'yes') else value
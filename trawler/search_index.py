@@ -0,0 +1,205 @@
+import re
+import bisect
+import fnmatch
+import threading
+from array import array
+from trawler.file_table import ROOT
+
+SEARCH_MODES = ('substring', 'glob', 'regex')
+GLOB_SPECIAL = re.compile(r'\[[^\]]*\]|[*?]')
+
+
+def parse_query(text):
+    """Split a search prompt into a (mode, pattern) pair.
+
+    're:' starts a regular expression, a pattern containing *, ? or [...] is a
+    glob matched against the full path, and anything else is a substring.
+    """
+    if text.startswith('re:'):
+        return 'regex', text[3:]
+    if GLOB_SPECIAL.search(text):
+        return 'glob', text
+    return 'substring', text
+
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class TrigramIndex:
+    """Trigram postings over a growing list of lowercase strings."""
+
+    def __init__(self):
+        self.strings = []
+        self._postings = {}
+
+    def extend(self, strings):
+        postings = self._postings
+        for string_id, string in enumerate(strings, len(self.strings)):
+            for gram in trigrams(string):
+                posting = postings.get(gram)
+                if posting is None:
+                    posting = postings[gram] = array('I')
+                posting.append(string_id)
+        self.strings.extend(strings)
+
+    def find(self, literal, predicate, start=0):
+        """Return the ids from start onwards of strings containing literal that satisfy predicate.
+
+        Literals of three characters or more intersect posting lists, shortest
+        first; shorter ones fall back to testing every string.
+        """
+        strings = self.strings
+        if len(literal) < 3 or start:
+            return [string_id for string_id in range(start, len(strings)) if predicate(strings[string_id])]
+        postings = sorted((self._postings.get(gram, ()) for gram in trigrams(literal)), key=len)
+        candidates = set(postings[0])
+        for posting in postings[1:]:
+            if not candidates:
+                break
+            candidates.intersection_update(posting)
+        return [string_id for string_id in candidates if predicate(strings[string_id])]
+
+
+class _LayerRows:
+    """Member rows of one layer ordered by directory id and by name id, for bisection."""
+
+    __slots__ = ('table', 'dir_order', 'dir_keys', 'name_order', 'name_keys')
+
+    def __init__(self, table):
+        self.table = table
+        members = range(table.member_count)
+        self.dir_order = array('I', sorted(members, key=table.dir_ids.__getitem__))
+        self.dir_keys = array('I', map(table.dir_ids.__getitem__, self.dir_order))
+        self.name_order = array('I', sorted(members, key=table.name_ids.__getitem__))
+        self.name_keys = array('I', map(table.name_ids.__getitem__, self.name_order))
+
+    @staticmethod
+    def _lookup(order, keys, ids):
+        rows = []
+        for value in ids:
+            lo = bisect.bisect_left(keys, value)
+            hi = bisect.bisect_right(keys, value, lo)
+            rows.extend(order[lo:hi])
+        return rows
+
+    def in_dirs(self, dir_ids):
+        if len(dir_ids) > len(self.dir_keys) // 8:
+            table_dirs = self.table.dir_ids
+            return [row for row in range(self.table.member_count) if table_dirs[row] in dir_ids]
+        return self._lookup(self.dir_order, self.dir_keys, dir_ids)
+
+    def with_names(self, name_ids):
+        if len(name_ids) > len(self.name_keys) // 8:
+            table_names = self.table.name_ids
+            return [row for row in range(self.table.member_count) if table_names[row] in name_ids]
+        return self._lookup(self.name_order, self.name_keys, name_ids)
+
+
+class SearchIndex:
+    """Substring, glob and regex path search over the file tables of an image.
+
+    Trigram indexes cover the image's distinct lowercased directory paths and
+    base names. Each layer is added once, with its rows ordered by directory
+    and by name, so matching strings map straight back to member rows and a
+    query touches only the rows it returns. Layers can be added while others
+    are still being indexed.
+    """
+
+    def __init__(self, path_table):
+        self.path_table = path_table
+        self._dirs = TrigramIndex()
+        self._names = TrigramIndex()
+        self._layers = {}
+        self._lock = threading.Lock()
+
+    def has_layer(self, layer_idx):
+        return layer_idx in self._layers
+
+    def add_layer(self, layer_idx, table):
+        """Index a layer's file table for searching."""
+        layer_rows = _LayerRows(table)
+        with self._lock:
+            self._sync_strings()
+            self._layers[layer_idx] = layer_rows
+
+    def _sync_strings(self):
+        dirs = self.path_table.dirs
+        names = self.path_table.names
+        self._dirs.extend([(path or '').lower() for path in dirs[len(self._dirs.strings):]])
+        self._names.extend([name.lower() for name in names[len(self._names.strings):]])
+
+    def query(self, pattern, mode='substring'):
+        """Compile a search, raising re.error for an invalid pattern."""
+        if mode not in SEARCH_MODES:
+            raise ValueError(f"Unknown search mode: {mode}")
+        return PathQuery(self, pattern, mode)
+
+
+class PathQuery:
+    """A compiled search that yields matching rows one layer at a time."""
+
+    def __init__(self, index, pattern, mode):
+        self.index = index
+        self.mode = mode
+        self.regex = None
+        self.literal = None
+        if mode == 'regex':
+            self.regex = re.compile(pattern, re.IGNORECASE)
+        elif mode == 'glob':
+            self.regex = re.compile(fnmatch.translate(pattern.lower()))
+            literal = max((part for part in GLOB_SPECIAL.split(pattern.lower()) if '[' not in part), key=len, default='')
+            self.literal = literal if len(literal) >= 3 else None
+        else:
+            self.literal = pattern.lower()
+        self._dir_count = 0
+        self._name_count = 0
+        self._containing_dirs = set()
+        self._containing_names = set()
+        self._head_dirs = set()
+        self._tail_names = set()
+
+    def _match_strings(self):
+        """Match the literal against strings interned since the last call."""
+        literal = self.literal
+        dirs = self.index._dirs
+        names = self.index._names
+        with self.index._lock:
+            dir_start, name_start = self._dir_count, self._name_count
+            self._dir_count, self._name_count = len(dirs.strings), len(names.strings)
+            self._containing_dirs.update(dirs.find(literal, lambda path: literal in path, dir_start))
+            if '/' not in literal:
+                self._containing_names.update(names.find(literal, lambda name: literal in name, name_start))
+                return
+            # A match spanning the last separator ends a directory and starts a base name.
+            head, _, tail = literal.rpartition('/')
+            self._head_dirs.update(dirs.find(head, lambda path: path.endswith(head), dir_start))
+            self._head_dirs.discard(ROOT)
+            self._tail_names.update(names.find(tail, lambda name: name.startswith(tail), name_start))
+
+    def rows(self, layer_idx):
+        """Return the sorted member rows of an added layer that match."""
+        layer_rows = self.index._layers[layer_idx]
+        table = layer_rows.table
+        if self.literal is None:
+            path = table.path
+            if self.mode == 'glob':
+                return [row for row in range(table.member_count) if self.regex.match(path(row).lower())]
+            return [row for row in range(table.member_count) if self.regex.search(path(row))]
+
+        self._match_strings()
+        rows = set(layer_rows.in_dirs(self._containing_dirs))
+        if '/' not in self.literal:
+            rows.update(layer_rows.with_names(self._containing_names))
+        else:
+            table_names = table.name_ids
+            table_dirs = table.dir_ids
+            # Walk whichever side is smaller and check the other side's id.
+            if len(self._head_dirs) <= len(self._tail_names):
+                rows.update(row for row in layer_rows.in_dirs(self._head_dirs) if table_names[row] in self._tail_names)
+            else:
+                rows.update(row for row in layer_rows.with_names(self._tail_names) if table_dirs[row] in self._head_dirs)
+        if self.mode == 'glob':
+            path = table.path
+            return sorted(row for row in rows if self.regex.match(path(row).lower()))
+        return sorted(rows)
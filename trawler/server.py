@@ -0,0 +1,359 @@
+import re
+import sys
+import json
+import asyncio
+import threading
+from http import HTTPStatus
+from urllib.parse import parse_qs, urlsplit
+from concurrent.futures import ThreadPoolExecutor
+from trawler.cli import DEFAULT_PORT, entry_record, holder_record, merged_record, normalize_path
+from trawler.content_search import DEFAULT_MAX_FILE_SIZE, compile_pattern
+from trawler.layer_index import OperationCancelled
+from trawler.search_index import parse_query
+
+DEFAULT_HOST = '127.0.0.1'  # Only local clients can connect
+DEFAULT_WORKERS = 8  # Threads running inspector calls, so a long grep never holds up a listing
+NDJSON = 'application/x-ndjson'
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+def _head(status, content_type, length=None):
+    """Return the status line and headers of a response; without a length the body is sent chunked."""
+    lines = [f"HTTP/1.1 {status} {HTTPStatus(status).phrase}", f"Content-Type: {content_type}", "Connection: close"]
+    lines.append(f"Content-Length: {length}" if length is not None else "Transfer-Encoding: chunked")
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+
+def _chunk(data):
+    return b'%x\r\n%s\r\n' % (len(data), data)
+
+
+def _int_param(params, name, default=None):
+    value = params.get(name)
+    if value is None or value == '':
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise HTTPError(400, f"{name} must be an integer, not {value!r}")
+
+
+def _flag(params, name):
+    return params.get(name, '').lower() in ('1', 'true', 'yes')
+
+
+def _required(params, name):
+    value = params.get(name)
+    if not value:
+        raise HTTPError(400, f"Missing parameter: {name}")
+    return value
+
+
+def _check_layer(inspector, layer_idx):
+    layer_count = len(inspector.wait_for_layer_list())
+    if layer_idx is not None and not 0 <= layer_idx < layer_count:
+        raise HTTPError(404, f"Layer {layer_idx} does not exist; the image has {layer_count} layers")
+
+
+class InspectionServer:
+    """Serves the images of an ImageSession over a local HTTP/JSON API.
+
+    One event loop parses requests and writes responses; every inspector
+    call, which may wait for indexing or read and decompress layers, runs on
+    a thread pool. All clients share the session's indexes, so an image is
+    indexed once however many people query it. Searches stream their hits as
+    NDJSON while they run and stop when the client goes away.
+    """
+
+    def __init__(self, session, workers=DEFAULT_WORKERS):
+        self.session = session
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='trawler-serve')
+        self._stats_locks = [asyncio.Lock() for _ in session.images]  # One image_stats run per image at a time
+        self._cancels = set()  # Cancel events of running requests, set on shutdown
+        self._routes = {
+            '/images': self.images,
+            '/layers': self.layers,
+            '/ls': self.ls,
+            '/find': self.find,
+            '/grep': self.grep,
+            '/stats': self.stats,
+            '/extract': self.extract,
+        }
+
+    async def handle(self, reader, writer):
+        """Answer one request on a connection, then close it."""
+        try:
+            try:
+                method, target = await self._read_request(reader)
+                if method != 'GET':
+                    raise HTTPError(405, f"{method} is not supported")
+                url = urlsplit(target)
+                route = self._routes.get(url.path.rstrip('/') or '/images')
+                if route is None:
+                    raise HTTPError(404, f"No such endpoint: {url.path}")
+                params = {name: values[-1] for name, values in parse_qs(url.query, keep_blank_values=True).items()}
+                await route(reader, writer, params)
+            except HTTPError as e:
+                await self._send_json(writer, {'error': e.message}, e.status)
+            except re.error as e:
+                await self._send_json(writer, {'error': f"Invalid pattern: {e}"}, 400)
+            except FileNotFoundError as e:
+                await self._send_json(writer, {'error': str(e)}, 404)
+            except (IsADirectoryError, ValueError) as e:
+                await self._send_json(writer, {'error': str(e)}, 400)
+            except ConnectionError:
+                raise
+            except Exception as e:
+                await self._send_json(writer, {'error': str(e)}, 500)
+        except ConnectionError:
+            pass  # The client went away
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _read_request(reader):
+        """Return the method and target of a request; headers are skipped, as no endpoint takes a body."""
+        try:
+            parts = (await reader.readline()).decode('latin-1').split()
+            while (await reader.readline()).strip():
+                pass
+        except ValueError:  # A line longer than the stream's limit
+            raise HTTPError(400, "Request too long")
+        if len(parts) != 3:
+            raise HTTPError(400, "Malformed request line")
+        return parts[0], parts[1]
+
+    @staticmethod
+    async def _send_json(writer, body, status=200):
+        data = json.dumps(body).encode() + b'\n'
+        writer.write(_head(status, 'application/json', len(data)) + data)
+        await writer.drain()
+
+    async def _run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.pool, function, *args)
+
+    async def _stream_records(self, reader, writer, produce):
+        """Run produce(emit, cancel) on the pool, sending each list of records it emits as an NDJSON chunk.
+
+        Records go out as soon as they are emitted. The cancel event is set
+        when the client disconnects, which is noticed from the end of its
+        request stream even while nothing is being written; an error after the
+        response has started is sent as a last {"error": ...} record.
+        """
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        cancel = threading.Event()
+
+        def emit(records):
+            data = ''.join(json.dumps(record) + '\n' for record in records).encode()
+            if data:
+                loop.call_soon_threadsafe(queue.put_nowait, data)
+
+        def finished(future):
+            if not future.cancelled():
+                future.exception()  # Retrieved here, so an abandoned request logs nothing
+            queue.put_nowait(None)
+
+        self._cancels.add(cancel)
+        done = loop.run_in_executor(self.pool, produce, emit, cancel)
+        done.add_done_callback(finished)
+        disconnected = asyncio.ensure_future(reader.read())  # Requests have no body, so this ends at EOF
+        disconnected.add_done_callback(lambda future: future.cancelled() or future.exception())
+        try:
+            writer.write(_head(200, NDJSON))
+            while True:
+                data = asyncio.ensure_future(queue.get())
+                await asyncio.wait([data, disconnected], return_when=asyncio.FIRST_COMPLETED)
+                if not data.done():
+                    data.cancel()
+                    raise ConnectionResetError("Client disconnected")
+                if data.result() is None:
+                    break
+                writer.write(_chunk(data.result()))
+                await writer.drain()
+            try:
+                await done
+            except OperationCancelled:
+                pass
+            except Exception as e:
+                writer.write(_chunk(json.dumps({'error': str(e)}).encode() + b'\n'))
+            writer.write(b'0\r\n\r\n')
+            await writer.drain()
+        finally:
+            disconnected.cancel()
+            cancel.set()
+            self._cancels.discard(cancel)
+
+    def _image(self, params):
+        image_idx = _int_param(params, 'image', 0)
+        if not 0 <= image_idx < len(self.session.images):
+            raise HTTPError(404, f"Image {image_idx} does not exist; {len(self.session.images)} are served")
+        return image_idx, self.session.images[image_idx]
+
+    async def images(self, reader, writer, params):
+        """The served images and how far their indexing has got."""
+        await self._send_json(writer, {'images': [
+            {'image': image_idx, 'path': inspector.local_image_path, 'layers': len(inspector.layers),
+             'indexed': inspector.indexed_layer_count(), 'loading': inspector.loading,
+             'error': None if inspector.load_error is None else str(inspector.load_error)}
+            for image_idx, inspector in enumerate(self.session.images)]})
+
+    async def layers(self, reader, writer, params):
+        """The layers of an image with their commands, digests and sizes, as the layers command lists them."""
+        _, inspector = self._image(params)
+
+        def layer_records():
+            records = []
+            for layer_idx, layer_name in enumerate(inspector.wait_for_layer_list()):
+                summary = inspector.layer_summary(layer_idx)
+                records.append({'layer': layer_idx, 'id': layer_name, 'digest': inspector.layer_digests[layer_idx],
+                                'command': inspector.get_layer_command(layer_name), 'size': summary.size,
+                                'file_count': summary.file_count})
+            return records
+
+        await self._send_json(writer, await self._run(layer_records))
+
+    async def ls(self, reader, writer, params):
+        """A directory of the final image, or of one layer with layer=N, as a list of entries."""
+        _, inspector = self._image(params)
+        path = normalize_path(params.get('path', ''))
+        layer_idx = _int_param(params, 'layer')
+        include_deleted = _flag(params, 'deleted')
+
+        def entry_records():
+            _check_layer(inspector, layer_idx)
+            if layer_idx is not None:
+                list_dir = lambda dir_path: inspector.list_files_in_layer(layer_idx, dir_path)
+                to_record = lambda entry: entry_record(layer_idx, entry)
+            else:
+                list_dir = lambda dir_path: inspector.list_merged_files(dir_path, include_deleted=include_deleted)
+                to_record = merged_record
+            if path:
+                entry = next((e for e in list_dir(path.rpartition('/')[0]) if e.name == path), None)
+                if entry is None:
+                    raise FileNotFoundError(f"{path}: no such file or directory")
+                if not entry.isdir():
+                    return [to_record(entry)]
+            return [to_record(entry) for entry in list_dir(path)]
+
+        await self._send_json(writer, await self._run(entry_records))
+
+    async def find(self, reader, writer, params):
+        """Stream paths matching q from every image, or from one layer of an image with layer=N."""
+        mode, pattern = parse_query(_required(params, 'q'))
+        if mode == 'regex':
+            re.compile(pattern)
+        layer_idx = _int_param(params, 'layer')
+        session = self.session
+        if layer_idx is not None:
+            _, inspector = self._image(params)
+
+        def search(emit, cancel):
+            if layer_idx is not None:
+                _check_layer(inspector, layer_idx)
+                emit(entry_record(layer_idx, entry)
+                     for entry in inspector.search_files_in_layer(layer_idx, pattern, mode=mode))
+            else:
+                # Each layer is searched once, however many of the images hold it.
+                session.search_files(pattern, mode, cancel=cancel, on_layer=lambda holders, entries: emit(
+                    holder_record(session, holders, entry_record(holders[0][1], entry)) for entry in entries))
+
+        await self._stream_records(reader, writer, search)
+
+    async def grep(self, reader, writer, params):
+        """Stream lines of file contents matching pattern, from every image."""
+        pattern = _required(params, 'pattern')
+        regex = _flag(params, 'regex')
+        ignore_case = _flag(params, 'ignore_case')
+        max_size = _int_param(params, 'max_size', DEFAULT_MAX_FILE_SIZE)
+        compile_pattern(pattern, regex, ignore_case)
+        session = self.session
+
+        def search(emit, cancel):
+            def on_layer(holders, matches):
+                emit(holder_record(session, holders, {'layer': holders[0][1], 'path': match.name,
+                                                      'line_number': match.line_number, 'line': match.line})
+                     for match in matches)
+
+            session.grep(pattern, regex, ignore_case, max_size, on_layer=on_layer, cancel=cancel)
+
+        await self._stream_records(reader, writer, search)
+
+    async def stats(self, reader, writer, params):
+        """Each layer's size, file count and wasted bytes, and the image efficiency."""
+        image_idx, inspector = self._image(params)
+
+        def image_stats():
+            layers = inspector.wait_for_layer_list()
+            stats = inspector.image_stats()
+            summary = stats.to_dict()
+            summary['layers'] = [dict(layer=layer_idx, id=layers[layer_idx],
+                                      command=inspector.get_layer_command(layers[layer_idx]), **layer.to_dict())
+                                 for layer_idx, layer in enumerate(stats.layers)]
+            return dict(image=inspector.local_image_path, **summary)
+
+        # Clients asking at the same time wait for one analysis rather than each hashing the image.
+        async with self._stats_locks[image_idx]:
+            body = await self._run(image_stats)
+        await self._send_json(writer, body)
+
+    async def extract(self, reader, writer, params):
+        """Stream the contents of a file: from the layer providing it in the final image, or from layer=N."""
+        _, inspector = self._image(params)
+        path = normalize_path(_required(params, 'path'))
+        layer_idx = _int_param(params, 'layer')
+        cancel = threading.Event()
+
+        def open_file():
+            _check_layer(inspector, layer_idx)
+            file_layer = layer_idx
+            if file_layer is None:
+                entry = inspector.merged_entry(path)
+                if entry is None or entry.status == 'deleted':
+                    raise FileNotFoundError(f"{path} is not in the image")
+                file_layer = entry.layer
+            return inspector.read_file(file_layer, path, cancel)
+
+        entry, chunks = await self._run(open_file)
+        self._cancels.add(cancel)
+        try:
+            writer.write(_head(200, 'application/octet-stream', entry.size))
+            while (data := await self._run(next, chunks, None)) is not None:
+                writer.write(data)
+                await writer.drain()
+        except (OSError, EOFError, OperationCancelled):
+            pass  # Closing the connection short of Content-Length tells the client the copy failed
+        finally:
+            cancel.set()
+            self._cancels.discard(cancel)
+            await self._run(chunks.close)
+
+    def close(self):
+        """Stop the requests still running and the pool."""
+        for cancel in list(self._cancels):
+            cancel.set()
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+async def _serve_forever(server, host, port):
+    listener = await asyncio.start_server(server.handle, host, port)
+    host, port = listener.sockets[0].getsockname()[:2]
+    print(f"Serving {len(server.session.images)} image(s) on http://{host}:{port}/ (Ctrl-C to stop)",
+          file=sys.stderr, flush=True)
+    async with listener:
+        await listener.serve_forever()
+
+
+def serve(session, port=DEFAULT_PORT, host=DEFAULT_HOST, workers=DEFAULT_WORKERS):
+    """Serve a session's images until interrupted; see InspectionServer for the endpoints."""
+    server = InspectionServer(session, workers)
+    try:
+        asyncio.run(_serve_forever(server, host, port))
+    finally:
+        server.close()
@@ -1,8 +1,101 @@
+import re
+import time
 import curses
+import threading
+from trawler.content_search import ContentMatch, compile_pattern, parse_content_query
+from trawler.layer_index import OperationCancelled
+from trawler.layer_stats import format_size
+from trawler.profiler import current_profiler
+from trawler.search_index import parse_query
+
+KEY_ESCAPE = 27
+POLL_INTERVAL_MS = 100  # getch timeout, so progress from background work keeps the screen fresh
+
+
+def truncate(text, width):
+    return (text[:width - 4] + '...') if len(text) > width - 4 else text
+
+
+class Screen:
+    """Draws whole frames as (text, attr) lines, writing only the lines that changed since the last frame.
+
+    Moving the selection in a long list rewrites two lines rather than the
+    screen, and each frame goes out in one doupdate, which keeps scrolling
+    smooth over slow terminals and SSH links.
+    """
+
+    def __init__(self, stdscr):
+        self.stdscr = stdscr
+        self.size = stdscr.getmaxyx()
+        self.lines = []  # (text, attr) of each line as last drawn
+        self.overlay = None  # Called for a (text, attr) replacing the last line, see the profiler
+
+    def reset(self):
+        """Clear the screen and redraw every line of the next frame, after drawing outside draw."""
+        self.stdscr.erase()
+        self.lines = []
+
+    def invalidate(self, y):
+        """Redraw line y in the next frame."""
+        if y < len(self.lines):
+            self.lines[y] = None
+
+    def draw(self, lines):
+        size = self.stdscr.getmaxyx()
+        if size != self.size:
+            self.size = size
+            self.reset()
+        max_y, max_x = size
+        lines = list(lines[:max_y]) + [('', 0)] * (max_y - len(lines))
+        if self.overlay is not None:
+            lines[-1] = self.overlay()
+        for y, (text, attr) in enumerate(lines):
+            lines[y] = (truncate(text, max_x), attr)
+            if y < len(self.lines) and self.lines[y] == lines[y]:
+                continue
+            self.stdscr.move(y, 0)
+            self.stdscr.clrtoeol()
+            if text:
+                self.stdscr.addstr(y, 0, lines[y][0], attr)
+        self.lines = lines
+        self.stdscr.noutrefresh()
+        curses.doupdate()
+
+
+def navigate(key, selected, offset, count, height):
+    """Return the (selected, offset) a navigation key moves a list of count rows to, or None for other keys.
+
+    height is the number of rows shown; offset is the first of them.
+    """
+    if key == curses.KEY_UP:
+        selected -= 1
+    elif key == curses.KEY_DOWN:
+        selected += 1
+    elif key == curses.KEY_PPAGE:
+        selected -= height
+        offset -= height
+    elif key == curses.KEY_NPAGE:
+        selected += height
+        offset += height
+    elif key == curses.KEY_HOME:
+        selected = 0
+    elif key == curses.KEY_END:
+        selected = count - 1
+    else:
+        return None
+    selected = max(0, min(selected, count - 1))
+    offset = max(0, min(offset, count - height, selected), selected - height + 1)
+    return selected, offset
+
+
+def run_curses_ui(inspector, images=None):
+    """Browse an image; with images, the inspectors of a session, 'i' switches between them."""
+    images = images or [inspector]
 
-def run_curses_ui(inspector):
     def main(stdscr):
+        nonlocal inspector
         curses.curs_set(0)
+        stdscr.timeout(POLL_INTERVAL_MS)
         curses.start_color()
         curses.init_pair(1, curses.COLOR_BLACK, curses.COLOR_WHITE)
         curses.init_pair(2, curses.COLOR_BLUE, curses.COLOR_BLACK)
@@ -19,87 +112,243 @@ def run_curses_ui(inspector):
         search_results = []
         max_y, max_x = stdscr.getmaxyx()
         search_across_layers = False
+        search_task = None  # Background search across layers, see start_search
+        marked = {}  # (layer_idx, path) of entries marked for extraction, in the order they were marked
+        extract_task = None  # Background extraction, see start_extraction
+        merged_top = 0  # Top layer of the merged view
+        merged_path = ''
+        merged_files = []
+        show_deleted = False
+        stats_task = None  # Background size and waste analysis, started once every layer is indexed
         prev_screen = ''
 
         total_layers = len(inspector.layers)
 
+        screen = Screen(stdscr)
+
         def update_size():
             nonlocal max_y, max_x
             max_y, max_x = stdscr.getmaxyx()
-        
+
+        def list_height():
+            return max(max_y - 3, 1)  # Rows between the title and the status and help lines
+
+        def list_frame(title, rows, status, help_line):
+            """Draw a frame of a title, the visible rows of a list, a status line and the key help."""
+            rows = rows[:list_height()]
+            screen.draw([(title, curses.A_BOLD)] + rows + [('', 0)] * (max_y - 3 - len(rows))
+                        + [status, (help_line, curses.A_DIM)])
+
+        def input_pending():
+            """Return True when a key is waiting to be read, leaving it queued."""
+            stdscr.nodelay(True)
+            try:
+                key = stdscr.getch()
+            finally:
+                stdscr.timeout(POLL_INTERVAL_MS)
+            if key == -1:
+                return False
+            curses.ungetch(key)
+            return True
+
         def truncate_addstr(y, x, prtstring, formatting=None):
-            trunc_prtstring = (prtstring[:max_x - 4] + '...') if len(prtstring) > max_x - 4 else prtstring
+            trunc_prtstring = truncate(prtstring, max_x)
             if formatting:
                 stdscr.addstr(y, x, trunc_prtstring, formatting)
             else:
                 stdscr.addstr(y, x, trunc_prtstring)
+            screen.invalidate(y)
+
+        def prompt(text):
+            """Read a line of input at the bottom of the screen, blocking until Enter."""
+            truncate_addstr(max_y - 2, 0, text)
+            stdscr.clrtoeol()
+            curses.echo()
+            stdscr.timeout(-1)
+            try:
+                return stdscr.getstr(max_y - 2, len(text)).decode('utf-8').strip()
+            finally:
+                stdscr.timeout(POLL_INTERVAL_MS)
+                curses.noecho()
+
+        def start_search(query, mode):
+            """Search every layer on a worker thread; hits are appended as each layer finishes.
+
+            mode 'content' searches file contents for query, a literal or a 're:' regex.
+            """
+            task = {'hits': [], 'scanned': 0, 'done': False, 'error': None, 'cancel': threading.Event()}
+
+            def add_hits(layer_idx, matches):
+                task['hits'].extend((layer_idx, f) for f in matches)
+
+            def progress(byte_count):
+                task['scanned'] += byte_count
+
+            def run():
+                try:
+                    if mode == 'content':
+                        pattern, regex = parse_content_query(query)
+                        inspector.grep_layers(pattern, regex, on_layer=add_hits, progress=progress, cancel=task['cancel'])
+                    else:
+                        inspector.search_files_across_layers(query, mode, on_layer=add_hits, cancel=task['cancel'])
+                except Exception as e:
+                    task['error'] = e
+                finally:
+                    task['done'] = True
+
+            threading.Thread(target=run, daemon=True).start()
+            return task
+
+        def mark_prefix(layer_idx, file):
+            return '* ' if (layer_idx, file.name) in marked else ''
+
+        def toggle_mark(layer_idx, file):
+            entry_key = (layer_idx, file.name)
+            if entry_key in marked:
+                del marked[entry_key]
+            else:
+                marked[entry_key] = True
+            return f"{len(marked)} marked for extraction" if marked else ""
+
+        def start_extraction(selections, output_dir):
+            """Extract the selections on a worker thread in one ordered pass over the image."""
+            task = {'count': len(selections), 'copied': 0, 'messages': [], 'done': False, 'error': None,
+                    'output_dir': output_dir, 'cancel': threading.Event()}
+
+            def progress(byte_count):
+                task['copied'] += byte_count
+
+            def run():
+                try:
+                    task['messages'] = inspector.extract_files(selections, output_dir, progress, task['cancel'])
+                except Exception as e:
+                    task['error'] = e
+                finally:
+                    task['done'] = True
+
+            threading.Thread(target=run, daemon=True).start()
+            return task
+
+        def extract_selection(layer_idx, file):
+            """Extract the marked entries, or the entry under the cursor when nothing is marked."""
+            nonlocal extract_task
+            if extract_task is not None:
+                return "An extraction is already running (Esc to cancel)"
+            output_dir = prompt("Enter output directory (default: current): ")
+            if not output_dir:
+                output_dir = '.'
+            selections = list(marked) if marked else [(layer_idx, file.name)]
+            extract_task = start_extraction(selections, output_dir)
+            return f"Extracting to {output_dir}..."
+
+        def start_stats():
+            task = {'stats': None, 'hashed': 0, 'done': False, 'error': None, 'cancel': threading.Event()}
+
+            def progress(byte_count):
+                task['hashed'] += byte_count
+
+            def run():
+                try:
+                    task['stats'] = inspector.image_stats(progress, task['cancel'])
+                except Exception as e:
+                    task['error'] = e
+                finally:
+                    task['done'] = True
+
+            threading.Thread(target=run, daemon=True).start()
+            return task
+
+        def loading_status():
+            if inspector.load_error is not None:
+                return f"Indexing stopped: {inspector.load_error}"
+            if inspector.loading and total_layers:
+                return f"Indexing layers: {inspector.indexed_layer_count()}/{total_layers} done (Esc to cancel)"
+            if stats_task is not None and not stats_task['done']:
+                return f"Analysing layer sizes: {format_size(stats_task['hashed'])} hashed for duplicates (Esc to cancel)"
+            return ""
 
         def display_layers():
-            stdscr.clear()
             update_size()
-            truncate_addstr(0, 0, "=== Docker Image Layers ===", curses.A_BOLD)
-            display_limit = max_y - 3
-
-            for idx in range(display_limit):
-                layer_idx = layer_offset + idx
-                if layer_idx >= total_layers:
-                    break
+            stats = stats_task['stats'] if stats_task is not None else None
+            title = "=== Docker Image Layers ==="
+            if len(images) > 1:
+                title = (f"=== Docker Image Layers: {inspector.local_image_path} "
+                         f"({images.index(inspector) + 1}/{len(images)}) ===")
+            if stats is not None:
+                title += (f" efficiency {stats.efficiency:.1%}, "
+                          f"{format_size(stats.wasted_bytes)} wasted of {format_size(stats.total_bytes)}")
+
+            if not total_layers:
+                rows = [("Reading image manifest...", curses.A_DIM)] if inspector.loading else []
+                list_frame(title, rows, (status_message or loading_status(), curses.color_pair(4)), "'q' to quit")
+                return
+
+            rows = []
+            for layer_idx in range(layer_offset, min(layer_offset + list_height(), total_layers)):
                 layer_name = inspector.layers[layer_idx]
                 command = inspector.get_layer_command(layer_name)
-
-                if layer_idx == selected_layer:
-                    stdscr.attron(curses.color_pair(1))
-                    truncate_addstr(idx + 1, 0, f"Layer {layer_idx}: {command}")
-                    stdscr.attroff(curses.color_pair(1))
-                else:
-                    truncate_addstr(idx + 1, 0, f"Layer {layer_idx}: {command}")
-
-            full_command = inspector.get_layer_command(inspector.layers[selected_layer])
-            truncated_full_command = (full_command[:max_x - 1] + '...') if len(full_command) > max_x - 1 else full_command
-            if status_message:
-                truncate_addstr(max_y - 2, 0, status_message, curses.color_pair(4))
+                if not inspector.layer_ready(layer_idx):
+                    command += " [indexing...]" if inspector.loading else " [not indexed]"
+                if stats is not None:
+                    layer = stats.layers[layer_idx]
+                    command = (f"{format_size(layer.size):>9} {layer.file_count:>7} files "
+                               f"{format_size(layer.wasted_bytes):>9} wasted  {command}")
+                rows.append((f"Layer {layer_idx}: {command}",
+                             curses.color_pair(1) if layer_idx == selected_layer else curses.A_NORMAL))
+
+            if status_message or loading_status():
+                status = (status_message or loading_status(), curses.color_pair(4))
             else:
-                truncate_addstr(max_y - 2, 0, f"Layer {selected_layer} created by: {truncated_full_command}", curses.A_DIM)
-            truncate_addstr(max_y - 1, 0, "Navigate with ↑/↓, Enter to select, 's' to search, 'q' to quit", curses.A_DIM)
-            stdscr.refresh()
+                full_command = inspector.get_layer_command(inspector.layers[selected_layer])
+                status = (f"Layer {selected_layer} created by: {full_command}", curses.A_DIM)
+            help_line = "Navigate with ↑/↓, Enter to select, 'm' for the merged view, 's' to search, 'g' to grep contents, 'q' to quit"
+            if len(images) > 1:
+                help_line = help_line.replace(", 'q' to quit", ", 'i' for the next image, 'q' to quit")
+            list_frame(title, rows, status, help_line)
 
         def display_quit():
-            stdscr.clear()
             update_size()
-            truncate_addstr(0, 0, "=== Are you sure you want to quit? ===", curses.A_BOLD)
-            truncate_addstr(max_y - 2, 0, status_message, curses.color_pair(4))
-            truncate_addstr(max_y - 1, 0, "press 'q/Enter' to confirm, any other key to cancel", curses.A_DIM)
-            stdscr.refresh()
+            list_frame("=== Are you sure you want to quit? ===", [], (status_message, curses.color_pair(4)),
+                       "press 'q/Enter' to confirm, any other key to cancel")
+
+        def file_row(display_name, file, selected):
+            if selected:
+                return display_name, curses.color_pair(1)
+            return display_name, curses.color_pair(2) if file.isdir() else curses.color_pair(3)
 
         def display_files(files, layer_idx):
-            stdscr.clear()
             update_size()
-            truncate_addstr(0, 0, f"=== Files in Layer {layer_idx} ({current_path}) ===", curses.A_BOLD)
-            display_limit = max_y - 3
+            rows = []
+            for file_idx in range(file_offset, min(file_offset + list_height(), len(files))):
+                file = files[file_idx]
+                display_name = mark_prefix(layer_idx, file) + file.name + ('/' if file.isdir() else '')
+                rows.append(file_row(display_name, file, file_idx == selected_file))
+            list_frame(f"=== Files in Layer {layer_idx} ({current_path}) ===", rows,
+                       (status_message, curses.color_pair(4)),
+                       "Navigate with ↑/↓, Enter to open, Space to mark, 'e' to extract, 'b/←' to go back, 'q' to return")
 
-            for idx in range(display_limit):
-                file_idx = file_offset + idx
-                if file_idx >= len(files):
-                    break
+        def display_merged(files):
+            update_size()
+            rows = []
+            for file_idx in range(file_offset, min(file_offset + list_height(), len(files))):
                 file = files[file_idx]
-                display_name = file.name
-                if file.isdir():
-                    display_name += '/'
-                    stdscr.attron(curses.color_pair(2))
-                else:
-                    stdscr.attron(curses.color_pair(3))
-                if file_idx == selected_file:
-                    stdscr.attron(curses.color_pair(1))
-                    truncate_addstr(idx + 1, 0, display_name)
-                    stdscr.attroff(curses.color_pair(1))
+                display_name = mark_prefix(file.layer, file) + file.name + ('/' if file.isdir() else '')
+                display_name += f"  [{file.status} in layer {file.changed_by}]"
+                if file.status == 'deleted' and file_idx != selected_file:
+                    rows.append((display_name, curses.A_DIM))
                 else:
-                    truncate_addstr(idx + 1, 0, display_name)
-                stdscr.attroff(curses.color_pair(2))
-                stdscr.attroff(curses.color_pair(3))
-
-            truncate_addstr(max_y - 2, 0, status_message, curses.color_pair(4))
-            truncate_addstr(max_y - 1, 0, "Navigate with ↑/↓, Enter to open, 'e' to extract, 'b/←' to go back, 'q' to return", curses.A_DIM)
-            stdscr.refresh()
+                    rows.append(file_row(display_name, file, file_idx == selected_file))
+            list_frame(f"=== Merged filesystem of Layers 0-{merged_top} (/{merged_path}) ===", rows,
+                       (status_message, curses.color_pair(4)),
+                       f"Navigate with ↑/↓, Enter to open, Space to mark, 'e' to extract, "
+                       f"'d' to {'hide' if show_deleted else 'show'} deleted, 'b/←' to go back, 'q' to return")
+
+        def open_merged(path):
+            nonlocal merged_path, merged_files, selected_file, file_offset
+            merged_path = path
+            merged_files = inspector.list_merged_files(path, merged_top, show_deleted)
+            selected_file = 0
+            file_offset = 0
 
         def navigate_directory(file):
             nonlocal current_path, selected_file, file_offset
@@ -110,86 +359,116 @@ def run_curses_ui(inspector):
             return files
 
         def display_search_results(files, query):
-            stdscr.clear()
             update_size()
-            truncate_addstr(0, 0, f"=== Search Results for '{query}' ===", curses.A_BOLD)
-            display_limit = max_y - 3
-
-            for idx in range(display_limit):
-                file_idx = file_offset + idx
-                if file_idx >= len(files):
-                    break
+            rows = []
+            for file_idx in range(file_offset, min(file_offset + list_height(), len(files))):
                 file = files[file_idx]
-                display_name = file.name  # Show full path of the file
-                if file.isdir():
-                    display_name += '/'
-                    stdscr.attron(curses.color_pair(2))
-                else:
-                    stdscr.attron(curses.color_pair(3))
-                if file_idx == selected_file:
-                    stdscr.attron(curses.color_pair(1))
-                    truncate_addstr(idx + 1, 0, display_name)
-                    stdscr.attroff(curses.color_pair(1))
-                else:
-                    truncate_addstr(idx + 1, 0, display_name)
-                stdscr.attroff(curses.color_pair(2))
-                stdscr.attroff(curses.color_pair(3))
-
-            truncate_addstr(max_y - 2, 0, status_message, curses.color_pair(4))
-            truncate_addstr(max_y - 1, 0, "Navigate with ↑/↓, Enter to open, 'b' to go back, 'q' to return", curses.A_DIM)
-            stdscr.refresh()
+                display_name = mark_prefix(selected_layer, file) + file.name + ('/' if file.isdir() else '')
+                rows.append(file_row(display_name, file, file_idx == selected_file))
+            list_frame(f"=== Search Results for '{query}' ===", rows, (status_message, curses.color_pair(4)),
+                       "Navigate with ↑/↓, Enter to open, Space to mark, 'e' to extract, 'b' to go back, 'q' to return")
 
-        def display_search_results_across_layers(results, query, selected_file, file_offset):
-            stdscr.clear()
+        def display_search_results_across_layers(results, query):
             update_size()
-            truncate_addstr(0, 0, f"=== Search Results for '{query}' ===", curses.A_BOLD)
-
-            # Count total number of results
-            total_results = [(layer_idx, file) for layer_idx, files in results.items() for file in files]
-            total_files = len(total_results)
-
-            # Display results with scroll support
-            display_limit = max_y - 3  # Limit the number of lines we can display
-            start_idx = file_offset
-            end_idx = min(start_idx + display_limit, total_files)
-
-            # Render only the visible portion
-            current_line = 1
-            for i in range(start_idx, end_idx):
-                layer_idx, file = total_results[i]
-                display_name = f"Layer {layer_idx}: {file.name}"
-
+            # Hits arrive layer by layer while the search runs; only the visible slice of those found so far is drawn.
+            rows = []
+            for file_idx in range(file_offset, min(file_offset + list_height(), len(results))):
+                layer_idx, file = results[file_idx]
+                display_name = f"{mark_prefix(layer_idx, file)}Layer {layer_idx}: {file.name}"
+                if isinstance(file, ContentMatch):
+                    display_name += f":{file.line_number}: {file.line}"
                 if file.isdir():
                     display_name += '/'
-                    stdscr.attron(curses.color_pair(2))
-                else:
-                    stdscr.attron(curses.color_pair(3))
-
-                if i == selected_file:
-                    stdscr.attron(curses.color_pair(1))
-                    truncate_addstr(current_line, 0, display_name)
-                    stdscr.attroff(curses.color_pair(1))
-                else:
-                    truncate_addstr(current_line, 0, display_name)
-
-                stdscr.attroff(curses.color_pair(2))
-                stdscr.attroff(curses.color_pair(3))
-                current_line += 1
-
-            # Status message at the bottom
-            truncate_addstr(max_y - 2, 0, status_message, curses.color_pair(4))
-            truncate_addstr(max_y - 1, 0, "Navigate with ↑/↓, Enter to open, 'b' to go back, 'q' to return", curses.A_DIM)
-            stdscr.refresh()
-
+                rows.append(file_row(display_name, file, file_idx == selected_file))
+            list_frame(f"=== Search Results for '{query}' ===", rows, (status_message, curses.color_pair(4)),
+                       "Navigate with ↑/↓, Enter to open, Space to mark, 'e' to extract, 'b' to go back, 'q' to return")
+
+        def skip_while_typing(display):
+            """Draw no frame while keys are queued, so a held key moves through a list without drawing every step."""
+            def display_when_idle(*args):
+                if not input_pending():
+                    display(*args)
+            return display_when_idle
+
+        profiler = current_profiler()
+        if profiler is not None:
+            def profiled(name, display):
+                """Time each frame drawn by display and show the profiling counters in place of the key help."""
+                def display_profiled(*args):
+                    start = time.perf_counter()
+                    display(*args)
+                    profiler.record(f"frame:{name}", start, time.perf_counter(), category='ui')
+                return display_profiled
+
+            screen.overlay = lambda: (profiler.status_line(), curses.A_REVERSE)
+            display_quit = profiled('quit', display_quit)
+            display_layers = profiled('layers', display_layers)
+            display_files = profiled('files', display_files)
+            display_merged = profiled('merged', display_merged)
+            display_search_results = profiled('search', display_search_results)
+            display_search_results_across_layers = profiled('search', display_search_results_across_layers)
+
+        display_quit = skip_while_typing(display_quit)
+        display_layers = skip_while_typing(display_layers)
+        display_files = skip_while_typing(display_files)
+        display_merged = skip_while_typing(display_merged)
+        display_search_results = skip_while_typing(display_search_results)
+        display_search_results_across_layers = skip_while_typing(display_search_results_across_layers)
 
         while True:
+            total_layers = len(inspector.layers)
+
+            if stats_task is None and total_layers and not inspector.loading and inspector.load_error is None:
+                stats_task = start_stats()
+            if stats_task is not None and stats_task['done'] and stats_task['error'] is not None:
+                if not isinstance(stats_task['error'], OperationCancelled):
+                    status_message = f"Layer analysis failed: {stats_task['error']}"
+                stats_task['error'] = None
+
+            if search_task is not None and not search_task['done'] and search_task['scanned']:
+                status_message = (f"Searching contents for '{search_query}': {format_size(search_task['scanned'])} read, "
+                                  f"{len(search_results)} matches (Esc to cancel)")
+            if search_task is not None and search_task['done']:
+                # Report how a background search ended once it finishes.
+                if isinstance(search_task['error'], OperationCancelled):
+                    status_message = f"Search cancelled, {len(search_results)} results for '{search_query}'"
+                elif search_task['error'] is not None:
+                    status_message = f"Search failed: {search_task['error']}"
+                elif search_results:
+                    status_message = f"Search results for '{search_query}'"
+                else:
+                    status_message = f"No results found for '{search_query}'"
+                if not search_results and current_screen == 'search':
+                    current_screen = 'layers'
+                search_task = None
+
+            if extract_task is not None:
+                if not extract_task['done']:
+                    status_message = (f"Extracting {extract_task['count']} item(s): "
+                                      f"{extract_task['copied'] / (1024 * 1024):.1f} MiB copied (Esc to cancel)")
+                elif isinstance(extract_task['error'], OperationCancelled):
+                    status_message = "Extraction cancelled"
+                elif extract_task['error'] is not None:
+                    status_message = f"Extraction failed: {extract_task['error']}"
+                else:
+                    messages = extract_task['messages']
+                    failed = [m for m in messages if not m.startswith("Extracted")]
+                    if len(messages) == 1:
+                        status_message = messages[0]
+                    elif failed:
+                        status_message = f"Extracted {len(messages) - len(failed)} of {len(messages)} items: {failed[0]}"
+                    else:
+                        status_message = f"Extracted {len(messages)} items to {extract_task['output_dir']}"
+                    marked.clear()
+                if extract_task['done']:
+                    extract_task = None
 
             if current_screen == 'quit':
                 display_quit()
                 key = stdscr.getch()
                 if key in [curses.KEY_ENTER, 10, 13, ord('q')]:
                     break
-                elif key:
+                elif key != -1:
                     if prev_screen:
                         current_screen = prev_screen
                     else:
@@ -198,51 +477,102 @@ def run_curses_ui(inspector):
             elif current_screen == 'layers':
                 display_layers()
                 key = stdscr.getch()
-                if key == curses.KEY_UP:
-                    if selected_layer > 0:
-                        selected_layer -= 1
-                    if selected_layer < layer_offset:
-                        layer_offset -= 1
-                    status_message = ""
-                elif key == curses.KEY_DOWN:
-                    if selected_layer < total_layers - 1:
-                        selected_layer += 1
-                    if selected_layer >= layer_offset + (max_y - 2):
-                        layer_offset += 1
+                moved = navigate(key, selected_layer, layer_offset, total_layers, list_height())
+                if moved is not None:
+                    selected_layer, layer_offset = moved
                     status_message = ""
                 elif key in [curses.KEY_ENTER, 10, 13]:
+                    if not total_layers:
+                        continue
+                    if not inspector.layer_ready(selected_layer):
+                        if inspector.loading:
+                            status_message = f"Layer {selected_layer} is still being indexed."
+                        else:
+                            status_message = f"Layer {selected_layer} was not indexed."
+                        continue
                     current_path = ''
                     files = inspector.list_files_in_layer(selected_layer, current_path)
                     if not files:
                         status_message = f"No files found in Layer {selected_layer}."
-                        stdscr.clear()
+                        screen.reset()
                         truncate_addstr(0, 0, status_message, curses.color_pair(4))
                         truncate_addstr(2, 0, "Press any key to continue.")
                         stdscr.refresh()
+                        stdscr.timeout(-1)
                         stdscr.getch()
+                        stdscr.timeout(POLL_INTERVAL_MS)
+                        screen.reset()
                         status_message = ""
                         continue
                     current_screen = 'files'
                     selected_file = 0
                     file_offset = 0
                     status_message = ""
-                elif key == ord('s'):
-                    stdscr.clear()
-                    truncate_addstr(max_y - 2, 0, "Enter search query: ")
-                    stdscr.clrtoeol()
-                    curses.echo()
-                    search_query = stdscr.getstr(max_y - 2, len("Enter search query: ")).decode('utf-8').strip()
-                    curses.noecho()
-                    search_results = inspector.search_files_across_layers(search_query)
-                    if search_results:
+                elif key == ord('s') and total_layers:
+                    screen.reset()
+                    search_query = prompt("Enter search query: ")
+                    search_mode, search_pattern = parse_query(search_query)
+                    try:
+                        if search_mode == 'regex':
+                            re.compile(search_pattern)
+                    except re.error as e:
+                        status_message = f"Invalid pattern '{search_pattern}': {e}"
+                    else:
+                        search_task = start_search(search_pattern, search_mode)
+                        search_results = search_task['hits']
                         current_screen = 'search'
                         search_across_layers = True
                         selected_file = 0
                         file_offset = 0
-                        status_message = f"Search results for '{search_query}'"
-                        display_search_results_across_layers(search_results, search_query, selected_file, file_offset)
+                        status_message = f"Searching '{search_query}'... (Esc to cancel)"
+                elif key == ord('g') and total_layers:
+                    screen.reset()
+                    search_query = prompt("Search file contents (re: for a regex): ")
+                    try:
+                        compile_pattern(*parse_content_query(search_query))
+                    except re.error as e:
+                        status_message = f"Invalid pattern '{search_query}': {e}"
                     else:
-                        status_message = f"No results found for '{search_query}'"
+                        if not search_query:
+                            continue
+                        search_task = start_search(search_query, 'content')
+                        search_results = search_task['hits']
+                        current_screen = 'search'
+                        search_across_layers = True
+                        selected_file = 0
+                        file_offset = 0
+                        status_message = f"Searching contents for '{search_query}'... (Esc to cancel)"
+                elif key == ord('m') and total_layers:
+                    if not all(inspector.layer_ready(layer_idx) for layer_idx in range(selected_layer + 1)):
+                        status_message = f"Layers 0-{selected_layer} are not all indexed yet."
+                        continue
+                    truncate_addstr(max_y - 2, 0, "Building merged view...", curses.color_pair(4))
+                    stdscr.clrtoeol()
+                    stdscr.refresh()
+                    merged_top = selected_layer
+                    open_merged('')
+                    current_screen = 'merged'
+                    status_message = ""
+                elif key == ord('i') and len(images) > 1:
+                    if search_task is not None or extract_task is not None:
+                        status_message = "Wait for the running search or extraction to finish (Esc to cancel it)."
+                        continue
+                    if stats_task is not None and not stats_task['done']:
+                        stats_task['cancel'].set()
+                    # Layers shared with other images are already indexed, so switching costs little.
+                    inspector = images[(images.index(inspector) + 1) % len(images)]
+                    total_layers = len(inspector.layers)
+                    selected_layer = 0
+                    layer_offset = 0
+                    stats_task = None
+                    search_results = []
+                    marked.clear()
+                    status_message = ""
+                elif key == KEY_ESCAPE and inspector.loading:
+                    inspector.cancel_loading()
+                    status_message = "Cancelling indexing..."
+                elif key == KEY_ESCAPE and stats_task is not None and not stats_task['done']:
+                    stats_task['cancel'].set()
                 elif key == ord('q'):
                     prev_screen = current_screen
                     current_screen = 'quit'
@@ -251,16 +581,9 @@ def run_curses_ui(inspector):
             elif current_screen == 'files':
                 display_files(files, selected_layer)
                 key = stdscr.getch()
-                if key == curses.KEY_UP:
-                    if selected_file > 0:
-                        selected_file -= 1
-                    if selected_file < file_offset:
-                        file_offset -= 1
-                elif key == curses.KEY_DOWN:
-                    if selected_file < len(files) - 1:
-                        selected_file += 1
-                    if selected_file >= file_offset + (max_y - 3):
-                        file_offset += 1
+                moved = navigate(key, selected_file, file_offset, len(files), list_height())
+                if moved is not None:
+                    selected_file, file_offset = moved
                 elif key in [curses.KEY_ENTER, 10, 13]:
                     if len(files):
                         file = files[selected_file]
@@ -269,31 +592,30 @@ def run_curses_ui(inspector):
                             files = navigate_directory(file)
                         else:
                             status_message = f"{file.name} is a file, press 'e' to extract."
-                elif key == ord('e'):
-                    file = files[selected_file]
-                    truncate_addstr(max_y - 2, 0, "Enter output directory (default: current): ")
-                    stdscr.clrtoeol()
-                    curses.echo()
-                    output_dir = stdscr.getstr(max_y - 2, len("Enter output directory: ")).decode('utf-8').strip()
-                    curses.noecho()
-                    if not output_dir:
-                        output_dir = '.'
-                    status_message = inspector.extract_file_from_layer(selected_layer, file.name, output_dir)
+                elif key == ord(' ') and files:
+                    status_message = toggle_mark(selected_layer, files[selected_file])
+                elif key == ord('e') and files:
+                    status_message = extract_selection(selected_layer, files[selected_file])
+                elif key == KEY_ESCAPE and extract_task is not None:
+                    extract_task['cancel'].set()
                 elif key == ord('s'):
-                    stdscr.clear()
-                    truncate_addstr(max_y - 2, 0, "Enter search query: ")
-                    stdscr.clrtoeol()
-                    curses.echo()
-                    search_query = stdscr.getstr(max_y - 2, len("Enter search query: ")).decode('utf-8').strip()
-                    curses.noecho()
-                    search_results = inspector.search_files_in_layer(selected_layer, search_query, current_path)
-                    if search_results:
-                        current_screen = 'search'
-                        selected_file = 0
-                        file_offset = 0
-                        status_message = f"Search results for '{search_query}'"
+                    screen.reset()
+                    search_query = prompt("Enter search query: ")
+                    search_mode, search_pattern = parse_query(search_query)
+                    try:
+                        search_results = inspector.search_files_in_layer(selected_layer, search_pattern, current_path, search_mode)
+                    except re.error as e:
+                        search_results = []
+                        status_message = f"Invalid pattern '{search_pattern}': {e}"
                     else:
-                        status_message = f"No results found for '{search_query}'"
+                        if search_results:
+                            current_screen = 'search'
+                            search_across_layers = False
+                            selected_file = 0
+                            file_offset = 0
+                            status_message = f"Search results for '{search_query}'"
+                        else:
+                            status_message = f"No results found for '{search_query}'"
                 elif key in [curses.KEY_LEFT, ord('b')]:
                     if current_path:
                         current_path = '/'.join(current_path.strip('/').split('/')[:-1])
@@ -308,37 +630,62 @@ def run_curses_ui(inspector):
                     current_screen = 'quit'
                     status_message = ""
 
+            elif current_screen == 'merged':
+                display_merged(merged_files)
+                key = stdscr.getch()
+                file = merged_files[selected_file] if merged_files else None
+                moved = navigate(key, selected_file, file_offset, len(merged_files), list_height())
+                if moved is not None:
+                    selected_file, file_offset = moved
+                elif key in [curses.KEY_ENTER, 10, 13] and file is not None:
+                    if file.isdir():
+                        status_message = ""
+                        open_merged(file.name)
+                    else:
+                        status_message = f"{file.name} comes from layer {file.layer}, press 'e' to extract."
+                elif key in [ord(' '), ord('e')] and file is not None:
+                    if file.isdir():
+                        status_message = "Open a directory to extract files from the merged view."
+                    elif key == ord(' '):
+                        status_message = toggle_mark(file.layer, file)
+                    else:
+                        status_message = extract_selection(file.layer, file)
+                elif key == ord('d'):
+                    show_deleted = not show_deleted
+                    open_merged(merged_path)
+                elif key == KEY_ESCAPE and extract_task is not None:
+                    extract_task['cancel'].set()
+                elif key in [curses.KEY_LEFT, ord('b')]:
+                    if merged_path:
+                        open_merged(merged_path.rpartition('/')[0])
+                    else:
+                        current_screen = 'layers'
+                        status_message = ""
+                elif key == ord('q'):
+                    current_screen = 'layers'
+                    status_message = ""
+
             elif current_screen == 'search':
+                # Results are kept flat, in layer order, so drawing and paging only touch the visible rows.
                 if search_across_layers:
-                    # Flatten the search results across layers for navigation
-                    total_results = [(layer_idx, file) for layer_idx, files in search_results.items() for file in files]
-                    display_search_results_across_layers(search_results, search_query, selected_file, file_offset)
+                    display_search_results_across_layers(search_results, search_query)
                 else:
-                    # Search results within a single layer (list)
-                    total_results = search_results
                     display_search_results(search_results, search_query)
-
                 key = stdscr.getch()
-
-                if key == curses.KEY_UP:
-                    if selected_file > 0:
-                        selected_file -= 1
-                    if selected_file < file_offset:
-                        file_offset -= 1
-                elif key == curses.KEY_DOWN:
-                    if selected_file < len(total_results) - 1:
-                        selected_file += 1
-                    if selected_file >= file_offset + (max_y - 3):
-                        file_offset += 1
+                moved = navigate(key, selected_file, file_offset, len(search_results), list_height())
+                if moved is not None:
+                    selected_file, file_offset = moved
                 elif key in [curses.KEY_ENTER, 10, 13]:
+                    if not search_results:
+                        continue
                     if search_across_layers:
                         # Navigate to the file in its layer when searching across layers
-                        layer_idx, file = total_results[selected_file]
+                        layer_idx, file = search_results[selected_file]
                         selected_layer = layer_idx
                         file_path = file.name
                     else:
                         # Navigate to the file within the same layer
-                        file = total_results[selected_file]
+                        file = search_results[selected_file]
                         file_path = file.name
 
                     # Get the directory path by removing the file name from the path
@@ -356,15 +703,37 @@ def run_curses_ui(inspector):
                         selected_file = 0  # Fallback if the file is not found in the directory
 
                     # Switch to 'files' screen to display the folder contents and highlight the file
+                    if search_task is not None:
+                        search_task['cancel'].set()
+                        search_task = None
                     current_screen = 'files'
-                    file_offset = max(0, selected_file - (max_y - 3) // 2)  # Center the selected file in the view
+                    file_offset = max(0, selected_file - list_height() // 2)  # Center the selected file in the view
                     status_message = ""
+                elif key in [ord(' '), ord('e')] and search_results:
+                    if search_across_layers:
+                        layer_idx, file = search_results[selected_file]
+                    else:
+                        layer_idx, file = selected_layer, search_results[selected_file]
+                    if key == ord(' '):
+                        status_message = toggle_mark(layer_idx, file)
+                    else:
+                        status_message = extract_selection(layer_idx, file)
+                elif key == KEY_ESCAPE and search_task is not None:
+                    search_task['cancel'].set()
+                elif key == KEY_ESCAPE and extract_task is not None:
+                    extract_task['cancel'].set()
                 elif key in [curses.KEY_LEFT, ord('b')]:
+                    if search_task is not None:
+                        search_task['cancel'].set()
+                        search_task = None
                     current_screen = 'layers'
                     search_results = []
                     search_query = ""
                     status_message = ""
                 elif key == ord('q'):
+                    if search_task is not None:
+                        search_task['cancel'].set()
+                        search_task = None
                     if search_across_layers:
                         current_screen = 'layers'
                     else:
@@ -373,4 +742,7 @@ def run_curses_ui(inspector):
                     search_query = ""
                     status_message = ""
 
+    if hasattr(curses, 'set_escdelay'):
+        # Esc cancels background work; don't wait the default second for an escape sequence.
+        curses.set_escdelay(25)
     curses.wrapper(main)